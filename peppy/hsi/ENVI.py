@@ -7,7 +7,7 @@ the HSI module to set up the correct parameters for reading the raw
 data contained in the corresponding data file.
 """
 
-import os, os.path, sys, re, csv, textwrap, copy
+import os, os.path, sys, re, csv, textwrap, copy, time
 
 import peppy.vfs as vfs
 from peppy.debug import *
@@ -15,6 +15,7 @@ from peppy.debug import *
 import numpy
 
 from common import *
+from loader import FileKeyCache
 
 from cStringIO import StringIO
 
@@ -73,17 +74,53 @@ def getCanonicalHeader(filename):
         return name + ".hdr"
     return filename + ".hdr"
 
+# Directory path -> (modification time, set of names in the directory)
+_directory_listings = {}
+
+def getDirectoryNames(url):
+    """Get the names of the files in the directory containing the url.
+    
+    The listing is reused until the modification time of the directory
+    changes, so checking for headers of all the files in a directory only
+    lists the directory once.  Listings of directories modified in the last
+    few seconds aren't reused, in case the modification time doesn't have
+    enough resolution to show a change.
+    
+    @return: set of names, or None if the url isn't a local file or the
+    directory can't be listed
+    """
+    if url.scheme != 'file':
+        return None
+    try:
+        dirname = os.path.dirname(unicode(url.path))
+        mtime = os.stat(dirname).st_mtime
+        listing = _directory_listings.get(dirname, None)
+        if listing is None or listing[0] != mtime or time.time() - mtime < 2.0:
+            if len(_directory_listings) > 100:
+                _directory_listings.clear()
+            listing = (mtime, set(os.listdir(dirname)))
+            _directory_listings[dirname] = listing
+    except (OSError, UnicodeError):
+        return None
+    return listing[1]
+
 def findHeaders(url):
+    names = getDirectoryNames(vfs.normalize(url))
+    def exists(header):
+        if names is None:
+            return vfs.exists(header)
+        return os.path.basename(unicode(header.path)) in names
+    
     urls = []
     for ext in _header_extensions:
         header = vfs.normalize(str(url)+ext)
-        if vfs.exists(header):
+        if exists(header):
             urls.append(header)
 
     name,ext = os.path.splitext(str(url))
     for ext in _header_extensions:
         header = vfs.normalize(name+ext)
-        if vfs.exists(header):
+        if exists(header):
             urls.append(header)
 
     return urls
@@ -102,6 +139,9 @@ class Header(dict,MetadataMixin):
     format_name="ENVI Datacube"
     extensions=['.bil','.bip','.bsq','.sli']
 
+    #: Parsed key/value pairs of recently read header files
+    parsed_headers = FileKeyCache(256)
+
     def __init__(self, filename=None, **kwargs):
         if 'debug' in kwargs:
             self.debug = kwargs['debug']
@@ -150,7 +190,10 @@ class Header(dict,MetadataMixin):
                 self.getCubeAttributes(filename)
             else:
                 filename = vfs.normalize(filename)
-                self.headerurl, self.cubeurl = self.getFilePair(filename)
+                pair = kwargs.get('identity', None)
+                if not isinstance(pair, tuple):
+                    pair = self.getFilePair(filename)
+                self.headerurl, self.cubeurl = pair
                 self.open(self.headerurl)
         else:
             self.headerurl = None
@@ -182,14 +225,49 @@ class Header(dict,MetadataMixin):
         except:
             pass
         return False
+    
+    @classmethod
+    def identifyHeader(cls, url, header):
+        """Identify a data file by looking for its header.
+        
+        @return: tuple of (header url, data url) if the url is a data file
+        with a matching header, otherwise False.  The url of the header file
+        itself isn't identified because there's no data in it.
+        """
+        if header[0:4] == 'ENVI':
+            return False
+        for headerurl in findHeaders(url):
+            fh = vfs.open(headerurl)
+            try:
+                if fh.read(4) == 'ENVI':
+                    return (headerurl, url)
+            finally:
+                fh.close()
+        return False
+    
+    @classmethod
+    def getIdentifyDependencies(cls, url, info):
+        return [info[0]]
         
     def open(self,filename=None):
-        """Open the header file, and if successful parse it."""
+        """Open the header file, and if successful parse it.
+        
+        Parsed headers are cached, so reopening a cube doesn't parse the
+        header again unless it has been changed.
+        """
         if self.headerurl:
+            key = self.parsed_headers.getKey(self.headerurl)
+            if key is not None:
+                parsed = self.parsed_headers.get(key)
+                if parsed is not None:
+                    self.update(parsed)
+                    return
             fh = vfs.open(self.headerurl)
             if fh:
                 self.read(fh)
                 fh.close()
+                if key is not None:
+                    self.parsed_headers.put(key, dict(self))
             else:
                 eprint("Couldn't open %s for reading.\n" % self.headerurl)
 
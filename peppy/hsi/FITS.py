@@ -5,12 +5,17 @@
 U{FITS<http://fits.gsfc.nasa.gov>} is a simple file format that allows storage
 of multiple datasets in a single file.  It is commonly used in astronomy, but
 can be used to store arbitrary multi-dimensional arrays.
+
+Files are indexed by reading only the headers of the HDUs, skipping over
+the data units, and each image HDU is accessed through a memory mapped cube
+reader, so opening a file with many extensions is quick.
 """
 
 import os,os.path,sys,re,struct,stat
 from cStringIO import StringIO
 
 import peppy.hsi.common as HSI
+from peppy.hsi.loader import FileKeyCache
 import peppy.vfs as vfs
 from peppy.debug import *
 
@@ -18,14 +23,21 @@ import numpy
 
 class FITSHDU(debugmixin):
     """Header Data Unit (HDU) parser for FITS files.
+    
+    Only the header is read; the location and size of the data unit are
+    calculated from the header keywords so that the data can be skipped
+    without reading it.
     """
     def __init__(self, fh):
         """Create a HDU object from a file handle.
         
         The file handle should point to an open file at the start of a 2880
-        byte record.
+        byte record.  On return, the file handle points to the start of the
+        next HDU.
         """
         self.keywords = {}
+        self.header_offset = 0
+        self.data_size = 0
         self.image_size = 0
         self.image_axes = []
         self.image_bpp = 0
@@ -42,6 +54,7 @@ class FITSHDU(debugmixin):
     def parse(self, fh):
         """Parse a single HDU block
         """
+        self.header_offset = fh.tell()
         while True:
             chunk = fh.read(2880)
             if not chunk:
@@ -49,12 +62,12 @@ class FITSHDU(debugmixin):
             end = self.parseKeywords(chunk)
             if end:
                 break
+        self.image_offset = fh.tell()
         size = self.calcSize()
+        blocks = (size + 2879) / 2880
         if size:
-            self.image_offset = fh.tell()
-            blocks = (size + 2879) / 2880
-            fh.seek(blocks * 2880, 1)
-            self.image_end = fh.tell() - 1
+            self.image_end = self.image_offset + blocks * 2880 - 1
+        fh.seek(self.image_offset + blocks * 2880)
     
     def parseKeywords(self, chunk):
         """Parse a 2880 byte header record for keywords
@@ -101,21 +114,56 @@ class FITSHDU(debugmixin):
                 value = int(text)
         return value
     
+    def getString(self, keyword, default=None):
+        """Get the value of a string keyword without the quotes and any
+        trailing comment
+        """
+        value = self.keywords.get(keyword, None)
+        if not isinstance(value, str):
+            return default
+        match = re.match("'((?:[^']|'')*)'", value)
+        if not match:
+            return default
+        return match.group(1).replace("''", "'").rstrip()
+    
+    def isImage(self):
+        """Return True if the HDU is the primary array or an image extension
+        that contains data
+        """
+        if 'XTENSION' in self.keywords:
+            if self.getString('XTENSION') != 'IMAGE':
+                return False
+        elif self.keywords.get('GROUPS', False):
+            # random groups primary array
+            return False
+        return self.keywords.get('NAXIS', 0) > 0
+    
     def calcSize(self):
-        """Calculate the image size, if there is an image in this HDU
+        """Calculate the size of the data unit, and the image size if the HDU
+        holds an image
+        
+        The size follows the FITS standard, which includes the parameter and
+        group counts of table and random groups extensions.
         """
-        if self.keywords['NAXIS'] > 0:
-            self.image_bpp = abs(self.keywords['BITPIX'])
-            size = self.image_bpp / 8
-            self.image_axes = []
-            for i in range(self.keywords['NAXIS']):
-                k = 'NAXIS%d' % (i + 1)
-                axis = self.keywords[k]
-                self.image_axes.append(axis)
-                size *= axis
-            self.image_size = size
-            return size
-        return 0
+        naxis = self.keywords.get('NAXIS', 0)
+        if naxis == 0:
+            return 0
+        bpp = abs(self.keywords['BITPIX'])
+        axes = [self.keywords['NAXIS%d' % (i + 1)] for i in range(naxis)]
+        if self.isImage():
+            self.image_bpp = bpp
+            self.image_axes = axes
+        elif axes[0] == 0:
+            # random groups don't include the first axis
+            axes = axes[1:]
+        count = 1
+        for axis in axes:
+            count *= axis
+        count = self.keywords.get('GCOUNT', 1) * (self.keywords.get('PCOUNT', 0) + count)
+        self.data_size = (bpp / 8) * count
+        if self.image_axes:
+            self.image_size = self.data_size
+        return self.data_size
     
     def getNumPyDataType(self):
         """Convenience function to return the numpy data type of the image
@@ -153,11 +201,18 @@ class FITSDataset(HSI.MetadataMixin):
     def identify(cls, url, filename=None):
         fh = vfs.open(url)
         line=fh.read(160)
-        cls.dprint(repr(line))
-        if line[0:30] =='SIMPLE  =                    T' and line[80:90] == 'BITPIX  = ':
+        return cls.identifyHeader(url, line)
+
+    @classmethod
+    def identifyHeader(cls, url, header):
+        cls.dprint(repr(header[0:160]))
+        if header[0:30] =='SIMPLE  =                    T' and header[80:90] == 'BITPIX  = ':
             return True
         return False
 
+    #: Index of the HDUs of recently opened files
+    index_cache = FileKeyCache(100)
+
     def __init__(self, filename=None, **kwargs):
         self.url = None
         self.hdus = []
@@ -180,25 +235,51 @@ class FITSDataset(HSI.MetadataMixin):
             self.url = None
 
     def open(self, url=None):
-        """Open the header file, and if successful parse it."""
+        """Open the file and index its HDUs
+        
+        Only the headers are read; the data units are skipped using the
+        sizes calculated from the headers.  The index is cached on the url,
+        size and modification time of the file so reopening the file doesn't
+        read it at all.
+        """
         if url:
             self.setURL(url)
 
         if self.url:
+            key = self.index_cache.getKey(self.url)
+            if key is not None:
+                hdus = self.index_cache.get(key)
+                if hdus is not None:
+                    self.hdus = hdus
+                    return
             #fh=self.url.getReader()
             fh = vfs.open(self.url)
             if fh:
                 self.read(fh)
                 fh.close()
+                if key is not None:
+                    self.index_cache.put(key, self.hdus)
 
     def read(self, fh):
+        hdus = []
         while True:
             try:
                 hdu = FITSHDU(fh)
             except IOError:
                 break
-            print("Found HDU %s" % hdu)
-            self.hdus.append(hdu)
+            self.dprint("Found HDU %s" % hdu)
+            hdus.append(hdu)
+        self.hdus = hdus
+    
+    def getImageHDUs(self):
+        return [hdu for hdu in self.hdus if hdu.isImage()]
+    
+    def getCubeNames(self):
+        names = []
+        for i, hdu in enumerate(self.hdus):
+            if hdu.isImage():
+                names.append(hdu.getString('EXTNAME') or "HDU %d" % i)
+        return names
     
     def save(self,filename=None):
         if filename:
@@ -212,7 +293,10 @@ class FITSDataset(HSI.MetadataMixin):
 
     def setCubeAttributes(self, cube, hdu):
         cube.samples = hdu.image_axes[0]
-        cube.lines = hdu.image_axes[1]
+        if len(hdu.image_axes) > 1:
+            cube.lines = hdu.image_axes[1]
+        else:
+            cube.lines = 1
         if len(hdu.image_axes) > 2:
             cube.bands = hdu.image_axes[2]
         else:
@@ -228,19 +312,18 @@ class FITSDataset(HSI.MetadataMixin):
     def getCube(self, filename=None, index=0, progress=None, options=None):
         if filename is None:
             filename = self.url
-        hdu = None
-        i = 0
-        for h in self.hdus:
-            if h.image_size > 0:
-                if index == i:
-                    hdu = h
-                    break
-                i += 1
-        if not hdu:
+        images = self.getImageHDUs()
+        if index < 0 or index >= len(images):
             raise IndexError("HDU index out of range")
+        hdu = images[index]
         cube = HSI.newCube(hdu.getInterleave(), progress=progress)
         self.setCubeAttributes(cube, hdu)
         cube.verifyAttributes()
+        
+        # The data units are contiguous and uncompressed, so memory map them
+        # regardless of size.  The cube falls back to direct file access if
+        # the mapping fails.
+        cube.mmap_size_limit = -1
         if filename:
             try:
                 cube.open(filename)
@@ -0,0 +1,274 @@
+# peppy Copyright (c) 2006-2010 Rob McMullen
+# Licenced under the GPLv2; see http://peppy.flipturn.org for more info
+"""Band math expressions.
+
+Derived bands like normalized differences or band ratios are described by
+an arithmetic expression in which the bands of the cube are referenced as
+C{b[N]}, e.g. C{(b[54]-b[32])/(b[54]+b[32])}.
+
+The expression is parsed once into a short program of numpy ufunc calls.
+The program is run on each block of focal planes of the cube, writing every
+intermediate result in place into a small set of preallocated block-sized
+buffers, so no full-band temporary arrays are ever created.
+"""
+
+import _ast
+
+import numpy
+
+from peppy.debug import *
+
+import cube as HSI
+
+
+class BandMath(debugmixin):
+    """Parsed band math expression.
+
+    Supported are numbers, band references C{b[N]}, the operators + - * /
+    and **, unary minus, and the functions listed in L{functions}.  Numbers
+    that can be calculated without reference to a band are folded into a
+    single constant when the expression is parsed.
+    """
+    #: Memory budget in bytes of the buffers used to evaluate each block, or
+    #: None to use the budget of the cube
+    block_bytes = None
+
+    #: Type of the intermediate results and the output cube
+    dtype = numpy.float32
+
+    binary = {
+        _ast.Add: numpy.add,
+        _ast.Sub: numpy.subtract,
+        _ast.Mult: numpy.multiply,
+        _ast.Div: numpy.true_divide,
+        _ast.Pow: numpy.power,
+        }
+
+    unary = {
+        _ast.USub: numpy.negative,
+        }
+
+    functions = {
+        'abs': numpy.absolute,
+        'sqrt': numpy.sqrt,
+        'exp': numpy.exp,
+        'log': numpy.log,
+        'log10': numpy.log10,
+        'min': numpy.minimum,
+        'max': numpy.maximum,
+        }
+
+    def __init__(self, text, band_offset=0):
+        """Parse the expression
+
+        @param text: the expression
+
+        @param band_offset: number subtracted from the band numbers in the
+        expression to get the index of the band in the cube, e.g.  1 if the
+        user numbers the bands starting from 1
+
+        @raises ValueError: if the expression can't be parsed
+        """
+        self.text = text
+        self.band_offset = band_offset
+
+        # Registers hold the intermediate results.  The first registers are
+        # the bands loaded from the cube, which are never overwritten
+        # because a band can be used more than once.
+        self.bands = []
+        self.registers = 0
+        self.free = []
+        self.program = []
+        try:
+            # The ast module isn't available until python 2.6, but the
+            # compiler can return the same tree since 2.5
+            tree = compile(text.strip(), '<expr>', 'eval', _ast.PyCF_ONLY_AST)
+        except SyntaxError, e:
+            raise ValueError("Invalid expression %s: %s" % (text, e))
+        band_nodes = []
+        self.findBands(tree.body, band_nodes)
+        for node in band_nodes:
+            band = self.getBandIndex(node)
+            if band not in self.bands:
+                self.bands.append(band)
+        self.registers = len(self.bands)
+        self.result = self.compileNode(tree.body)
+
+    def __str__(self):
+        return self.text
+
+    def findBands(self, node, found):
+        if self.isBand(node):
+            found.append(node)
+        else:
+            for child in self.iterChildNodes(node):
+                self.findBands(child, found)
+
+    def iterChildNodes(self, node):
+        for name in node._fields:
+            field = getattr(node, name, None)
+            if isinstance(field, _ast.AST):
+                yield field
+            elif isinstance(field, list):
+                for item in field:
+                    if isinstance(item, _ast.AST):
+                        yield item
+
+    def isBand(self, node):
+        return isinstance(node, _ast.Subscript) and isinstance(node.value, _ast.Name) and node.value.id == 'b'
+
+    def getBandIndex(self, node):
+        if not isinstance(node.slice, _ast.Index) or not isinstance(node.slice.value, _ast.Num) or not isinstance(node.slice.value.n, (int, long)):
+            raise ValueError("Band references must be integers, e.g. b[10]")
+        return node.slice.value.n - self.band_offset
+
+    def getTemporary(self):
+        if self.free:
+            return self.free.pop()
+        index = self.registers
+        self.registers += 1
+        return index
+
+    def release(self, operands):
+        for kind, value in operands:
+            if kind == 'temp' and value not in self.free:
+                self.free.append(value)
+
+    def compileNode(self, node):
+        """Add the instructions to calculate the node to the program
+
+        @return: tuple of ('const', number), ('band', register) or ('temp',
+        register) describing where the result is found
+        """
+        if isinstance(node, _ast.Num):
+            return ('const', float(node.n))
+        elif self.isBand(node):
+            return ('band', self.bands.index(self.getBandIndex(node)))
+        elif isinstance(node, _ast.BinOp) and node.op.__class__ in self.binary:
+            func = self.binary[node.op.__class__]
+            args = [node.left, node.right]
+        elif isinstance(node, _ast.UnaryOp) and node.op.__class__ in self.unary:
+            func = self.unary[node.op.__class__]
+            args = [node.operand]
+        elif isinstance(node, _ast.UnaryOp) and isinstance(node.op, _ast.UAdd):
+            return self.compileNode(node.operand)
+        elif isinstance(node, _ast.Call) and isinstance(node.func, _ast.Name) and node.func.id in self.functions and not node.keywords and not node.starargs and not node.kwargs:
+            func = self.functions[node.func.id]
+            args = node.args
+            if len(args) != func.nin:
+                raise ValueError("%s takes %d arguments" % (node.func.id, func.nin))
+        else:
+            raise ValueError("Unsupported expression %s" % node.__class__.__name__)
+
+        operands = [self.compileNode(arg) for arg in args]
+        if not [kind for kind, value in operands if kind != 'const']:
+            return ('const', float(func(*[value for kind, value in operands])))
+        # The result can overwrite one of the temporary operands, so only
+        # as many buffers are used as the depth of the expression
+        self.release(operands)
+        out = self.getTemporary()
+        self.program.append((func, operands, out))
+        return ('temp', out)
+
+    def getLinesPerBlock(self, cube):
+        # each line of the block holds the bands read from the cube in
+        # addition to the registers and the output.  BSQ cubes are read one
+        # referenced band at a time, but the other interleaves have to read
+        # all the bands of each line.
+        line_bytes = (self.registers + 1) * cube.samples * numpy.dtype(self.dtype).itemsize
+        if cube.interleave == 'bsq':
+            line_bytes += len(self.bands) * cube.samples * cube.itemsize
+        else:
+            line_bytes += cube.bands * cube.samples * cube.itemsize
+        return cube.getLinesPerBlock(line_bytes, self.block_bytes)
+
+    def checkBands(self, cube):
+        for band in self.bands:
+            if band < 0 or band >= cube.bands:
+                raise ValueError("Band %d isn't in the cube" % (band + self.band_offset))
+
+    def evaluate(self, planes, out, registers):
+        """Evaluate the expression on a block of lines
+
+        @param planes: list of (lines x samples) arrays, one for each of the
+        referenced bands in the same order as L{bands}
+
+        @param out: array of (lines x samples) that receives the result
+
+        @param registers: list of buffers at least as large as out
+        """
+        lines = out.shape[0]
+        regs = [r[0:lines] for r in registers]
+        for i, plane in enumerate(planes):
+            regs[i][:] = plane
+        kind, value = self.result
+        last = len(self.program) - 1
+        for i, (func, operands, index) in enumerate(self.program):
+            args = []
+            for operand_kind, operand in operands:
+                if operand_kind == 'const':
+                    args.append(operand)
+                else:
+                    args.append(regs[operand])
+            if i == last and kind == 'temp':
+                # the last instruction writes directly into the output
+                args.append(out)
+            else:
+                args.append(regs[index])
+            func(*args)
+        if kind == 'band':
+            out[:] = regs[value]
+        elif kind == 'const':
+            out[:] = value
+
+    def iterPlanes(self, cube, count):
+        """Iterate over blocks of lines, reading only the referenced bands
+
+        BSQ cubes read each referenced band separately because the lines of
+        a band are contiguous.  The other interleaves store the bands of a
+        line together, so whole focal planes are read and the referenced
+        bands are sliced out of the block.
+
+        @return: tuple of (first line, one past the last line, list of
+        (lines x samples) arrays in the same order as L{bands})
+        """
+        if cube.interleave == 'bsq':
+            for line in range(0, cube.lines, count):
+                end = min(line + count, cube.lines)
+                planes = [cube.getBandLinesRaw(band, line, end) for band in self.bands]
+                yield line, end, planes
+        else:
+            for line, block in cube.iterFocalPlaneBlocks(count):
+                planes = [block[:, band, :] for band in self.bands]
+                yield line, line + block.shape[0], planes
+
+    def apply(self, cube, progress=None):
+        """Evaluate the expression over the whole cube
+
+        @param cube: L{Cube} providing the bands
+
+        @param progress: optional callable taking the percent complete
+
+        @return: single band float32 cube of the same lines and samples as
+        the source cube
+        """
+        self.checkBands(cube)
+        output = HSI.createCube('bsq', cube.lines, cube.samples, 1, self.dtype)
+        output.band_names = [self.text]
+        result = output.getBandRaw(0)
+        kind, value = self.result
+        if kind == 'const':
+            # no bands are referenced, so all of the expression was folded
+            result[:] = value
+            return output
+        count = self.getLinesPerBlock(cube)
+        registers = [numpy.empty((count, cube.samples), dtype=self.dtype) for i in range(self.registers)]
+        saved = numpy.seterr(divide='ignore', invalid='ignore', over='ignore')
+        try:
+            for line, end, planes in self.iterPlanes(cube, count):
+                self.evaluate(planes, result[line:end], registers)
+                if progress:
+                    progress((end * 100) / max(cube.lines, 1))
+        finally:
+            numpy.seterr(**saved)
+        return output
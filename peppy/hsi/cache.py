@@ -0,0 +1,274 @@
+# peppy Copyright (c) 2006-2010 Rob McMullen
+# Licenced under the GPLv2; see http://peppy.flipturn.org for more info
+"""Memory-limited cache of data read from HSI cubes.
+
+Cube readers that use direct file access (as opposed to memory mapping) have
+to go back to the file every time a band or focal plane is requested.  The
+cache in this module sits between L{Cube} and those readers so that
+recently used planes can be returned without touching the file again.
+
+The L{MemoryBudget} limits the other direction: the memory used by cubes
+created in memory during a session (band math results, classifications,
+subsets, etc.) by creating them in temporary memory mapped files once the
+budget is used up.
+"""
+
+import threading, heapq, weakref, tempfile
+
+import numpy
+
+from peppy.debug import *
+
+
+class TileCache(debugmixin):
+    """Least-recently-used cache of numpy arrays limited by total size.
+
+    Entries are keyed by a tuple of (reader, axis, index, tile), where reader
+    is the L{CubeReader} instance that produced the data, axis is a string
+    describing the type of data (e.g. 'band' or 'focalplane'), index is the
+    band or line number, and tile is either None to represent the full plane
+    or a tuple describing the subset of the plane.
+
+    Arrays stored in the cache are marked read-only because they are shared
+    among all the callers that request the same data.
+
+    All methods are thread safe so that the cache may be filled by background
+    threads.
+    """
+    def __init__(self, max_bytes=256*1024*1024):
+        self.max_bytes = max_bytes
+        self.lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        """Remove all entries and reset the statistics"""
+        self.lock.acquire()
+        try:
+            # key -> [last access stamp, array]
+            self.entries = {}
+            
+            # heap of (access stamp, key) used to find the least recently
+            # used entry.  Entries are not removed from the heap when they
+            # are accessed again, so stale items whose stamp doesn't match
+            # the current stamp of the entry are skipped during eviction.
+            self.order = []
+            self.current_bytes = 0
+            self.stamp = 0
+            self.hits = 0
+            self.misses = 0
+        finally:
+            self.lock.release()
+
+    def setMaxBytes(self, max_bytes):
+        """Change the size limit of the cache, evicting entries if necessary"""
+        self.lock.acquire()
+        try:
+            self.max_bytes = max_bytes
+            self.evict(0)
+        finally:
+            self.lock.release()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """Return the cached array for the key, or None if not in the cache"""
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.touch(key, entry)
+            return entry[1]
+        finally:
+            self.lock.release()
+
+    def put(self, key, data):
+        """Store an array in the cache.
+
+        Arrays that are larger than the entire cache are not stored.
+        """
+        nbytes = data.nbytes
+        if nbytes > self.max_bytes:
+            return
+        data.flags.writeable = False
+        self.lock.acquire()
+        try:
+            self.remove(key)
+            self.evict(nbytes)
+            entry = [0, data]
+            self.entries[key] = entry
+            self.touch(key, entry)
+            self.current_bytes += nbytes
+        finally:
+            self.lock.release()
+    
+    def touch(self, key, entry):
+        """Mark the entry as the most recently used"""
+        self.stamp += 1
+        entry[0] = self.stamp
+        heapq.heappush(self.order, (self.stamp, key))
+        if len(self.order) > 4 * len(self.entries) + 64:
+            # rebuild the heap to get rid of the stale items
+            self.order = [(e[0], k) for k, e in self.entries.iteritems()]
+            heapq.heapify(self.order)
+
+    def remove(self, key):
+        """Remove a single entry if it exists"""
+        self.lock.acquire()
+        try:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.current_bytes -= entry[1].nbytes
+        finally:
+            self.lock.release()
+
+    def removeReader(self, reader):
+        """Remove all entries that were produced by the specified reader"""
+        self.lock.acquire()
+        try:
+            for key in self.entries.keys():
+                if key[0] is reader:
+                    self.remove(key)
+        finally:
+            self.lock.release()
+
+    def evict(self, needed):
+        """Remove least recently used entries until there is enough space.
+
+        @param needed: number of bytes that must be available after eviction
+        """
+        while self.entries and self.current_bytes + needed > self.max_bytes:
+            stamp, key = heapq.heappop(self.order)
+            entry = self.entries.get(key, None)
+            if entry is not None and entry[0] == stamp:
+                self.dprint("evicting %s" % str(key[1:]))
+                self.remove(key)
+
+    def getStats(self):
+        """Return a dict containing the cache usage statistics"""
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self.entries),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                }
+
+
+class MemoryBudget(debugmixin):
+    """Limit on the total size of the cubes created in memory.
+
+    The raw arrays of the cubes created by L{createCube} and
+    L{createCubeLike} are allocated through L{allocate}.  While the total
+    size of the in-memory cubes is within the budget, the arrays are
+    ordinary numpy arrays.  Past the budget, new cubes are created in
+    temporary memory mapped files so the operating system can page their
+    data out to disk instead of running out of memory.
+
+    Cubes that already exist are never moved, because other code (e.g.  a
+    background calculation filling the cube) may hold views of their
+    arrays.  Memory is returned to the budget when an in-memory cube is
+    garbage collected.
+
+    The temporary files are deleted as soon as they are created, so their
+    space is reclaimed when the cube is garbage collected or the application
+    exits.
+    """
+    def __init__(self, max_bytes=1024*1024*1024, temp_dir=None):
+        self.max_bytes = max_bytes
+        
+        #: Directory for the temporary files, or None for the system default
+        self.temp_dir = temp_dir
+        self.lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        """Stop tracking all cubes and reset the statistics"""
+        self.lock.acquire()
+        try:
+            # id(cube) -> [weakref to cube, size in bytes]
+            self.entries = {}
+            self.current_bytes = 0
+            self.on_disk = 0
+        finally:
+            self.lock.release()
+
+    def setMaxBytes(self, max_bytes):
+        """Change the size of the budget.
+        
+        Existing cubes are left where they are; the new size only affects
+        cubes created afterwards.
+        """
+        self.max_bytes = max_bytes
+
+    def __contains__(self, cube):
+        return id(cube) in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def allocate(self, cube, count, dtype):
+        """Allocate a zero-filled one dimensional array for the data of a cube
+
+        @param cube: the L{Cube} that will use the array
+
+        @param count: number of elements
+
+        @param dtype: numpy data type of the elements
+
+        @return: numpy array, or numpy memmap if the array doesn't fit within
+        the budget
+        """
+        nbytes = count * numpy.dtype(dtype).itemsize
+        if nbytes == 0:
+            return numpy.zeros((count,), dtype=dtype)
+        self.lock.acquire()
+        try:
+            if self.current_bytes + nbytes <= self.max_bytes:
+                raw = numpy.zeros((count,), dtype=dtype)
+                self.add(cube, nbytes)
+                return raw
+            self.dprint("%d byte cube doesn't fit in budget; creating on disk" % nbytes)
+            self.on_disk += 1
+        finally:
+            self.lock.release()
+        return self.createTemporaryArray((count,), dtype)
+
+    def createTemporaryArray(self, shape, dtype):
+        """Create a zero-filled memory mapped array in a temporary file"""
+        fh = tempfile.TemporaryFile(prefix="peppy-", suffix=".raw", dir=self.temp_dir)
+        try:
+            return numpy.memmap(fh, dtype=dtype, mode="w+", shape=shape)
+        finally:
+            # The memory map holds its own handle on the file
+            fh.close()
+
+    def add(self, cube, nbytes):
+        key = id(cube)
+        def removed(ref, key=key):
+            self.remove(key)
+        self.entries[key] = [weakref.ref(cube, removed), nbytes]
+        self.current_bytes += nbytes
+
+    def remove(self, key):
+        """Stop tracking the cube with the specified id"""
+        self.lock.acquire()
+        try:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.current_bytes -= entry[1]
+        finally:
+            self.lock.release()
+
+    def getStats(self):
+        """Return a dict containing the budget usage statistics"""
+        return {'entries': len(self.entries),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'on_disk': self.on_disk,
+                }
@@ -0,0 +1,400 @@
+# peppy Copyright (c) 2006-2010 Rob McMullen
+# Licenced under the GPLv2; see http://peppy.flipturn.org for more info
+"""Chunked, compressed cube files.
+
+Derived products like classification cubes and masks are mostly made of long
+runs of the same values, but the raw ENVI formats store every pixel.  The
+chunked format divides the cube into tiles of a group of lines by a group of
+bands, compresses each tile separately, and stores an index of the tiles so
+that any tile can be read without decompressing the rest of the file.
+
+The file layout is::
+
+    magic, format version
+    compressed tiles
+    JSON encoded metadata
+    index of (offset, size) of each tile
+    offset of the metadata, magic
+
+Tiles are stored in line group order, and within each line group in band
+group order.  The data of a tile is in BIL order, i.e.  (lines x bands x
+samples).
+"""
+
+import struct, zlib
+
+try:
+    import json
+except ImportError:
+    json = None
+
+try:
+    import lz4.block as lz4
+except ImportError:
+    lz4 = None
+
+import numpy
+
+import peppy.vfs as vfs
+from peppy.debug import *
+
+import peppy.hsi.common as HSI
+
+
+class ChunkedFormat(object):
+    """Description of the layout and compression of a chunked cube file"""
+    magic = "PPYCHUNK"
+    version = 1
+
+    #: Compression methods that can be used by the writer
+    compressors = ['zlib', 'none']
+    if lz4 is not None:
+        compressors.append('lz4')
+
+    #: Names of the L{Cube} attributes saved with the data
+    attributes = ['description', 'wavelengths', 'wavelength_units', 'fwhm',
+                  'bbl', 'band_names', 'spectra_names', 'scale_factor']
+
+    def __init__(self, lines, samples, bands, dtype, tile_lines, tile_bands, compression='zlib'):
+        self.lines = lines
+        self.samples = samples
+        self.bands = bands
+        self.dtype = numpy.dtype(dtype)
+        self.tile_lines = max(min(tile_lines, lines), 1)
+        self.tile_bands = max(min(tile_bands, bands), 1)
+        self.compression = compression
+        self.line_groups = (lines + self.tile_lines - 1) / self.tile_lines
+        self.band_groups = (bands + self.tile_bands - 1) / self.tile_bands
+        self.metadata = {}
+
+    def getTileIndex(self, line_group, band_group):
+        return line_group * self.band_groups + band_group
+
+    def getTileShape(self, line_group, band_group):
+        lines = min(self.tile_lines, self.lines - line_group * self.tile_lines)
+        bands = min(self.tile_bands, self.bands - band_group * self.tile_bands)
+        return (lines, bands, self.samples)
+
+    def compress(self, data, level=6):
+        if self.compression == 'zlib':
+            return zlib.compress(data, level)
+        elif self.compression == 'lz4':
+            return lz4.compress(data)
+        return data
+
+    def decompress(self, data):
+        if self.compression == 'zlib':
+            return zlib.decompress(data)
+        elif self.compression == 'lz4':
+            if lz4 is None:
+                raise IOError("lz4 module required to read this file")
+            return lz4.decompress(data)
+        return data
+
+    def toJSON(self):
+        info = {
+            'lines': self.lines,
+            'samples': self.samples,
+            'bands': self.bands,
+            'dtype': self.dtype.str,
+            'tile_lines': self.tile_lines,
+            'tile_bands': self.tile_bands,
+            'compression': self.compression,
+            'metadata': self.metadata,
+            }
+        return json.dumps(info)
+
+    @classmethod
+    def fromJSON(cls, text):
+        info = json.loads(text)
+        layout = cls(info['lines'], info['samples'], info['bands'],
+                     str(info['dtype']), info['tile_lines'], info['tile_bands'],
+                     str(info['compression']))
+        layout.metadata = info.get('metadata', {})
+        return layout
+
+    @classmethod
+    def identify(cls, fh):
+        return fh.read(len(cls.magic)) == cls.magic
+
+    @classmethod
+    def read(cls, fh):
+        """Read the metadata and the index from the end of the file
+
+        @return: tuple of L{ChunkedFormat}, index array of (tiles x 2)
+        holding the offset and size of each tile
+        """
+        trailer = 8 + len(cls.magic)
+        fh.seek(-trailer, 2)
+        data = fh.read(trailer)
+        if len(data) != trailer or data[8:] != cls.magic:
+            raise IOError("Not a chunked cube file or the file is truncated")
+        start = struct.unpack("<Q", data[0:8])[0]
+        fh.seek(start)
+        size = struct.unpack("<I", fh.read(4))[0]
+        layout = cls.fromJSON(fh.read(size))
+        count = layout.line_groups * layout.band_groups
+        index = numpy.fromstring(fh.read(count * 16), dtype='<u8')
+        if len(index) != count * 2:
+            raise IOError("Index of chunked cube file is truncated")
+        return layout, index.reshape(count, 2).astype(numpy.int64)
+
+
+class ChunkedCubeReader(HSI.CubeReader):
+    """Random tile access to a chunked cube file.
+
+    Only the tiles that overlap the requested data are read and
+    decompressed.  The most recently used tiles are kept by the reader so
+    that pixel and spectrum lookups in the same area don't decompress the
+    same tile repeatedly.
+    """
+    use_tile_cache = True
+
+    #: Number of decompressed tiles kept by the reader
+    cached_tiles = 4
+
+    def __init__(self, cube, url=None, array=None):
+        HSI.CubeReader.__init__(self)
+        self.fh = vfs.open(url)
+        self.getSizeFromCube(cube)
+        self.layout, self.index = ChunkedFormat.read(self.fh)
+        self.data_type = self.layout.dtype
+        self.itemsize = self.data_type.itemsize
+        self.recent = []
+
+    def getInterleave(self):
+        return 'bil'
+
+    def getTile(self, line_group, band_group):
+        """Return the decompressed (lines x bands x samples) tile"""
+        key = (line_group, band_group)
+        for i, (tile_key, tile) in enumerate(self.recent):
+            if tile_key == key:
+                if i > 0:
+                    del self.recent[i]
+                    self.recent.insert(0, (key, tile))
+                return tile
+        layout = self.layout
+        offset, size = self.index[layout.getTileIndex(line_group, band_group)]
+        self.fh.seek(offset)
+        data = layout.decompress(self.fh.read(size))
+        tile = numpy.fromstring(data, dtype=self.data_type)
+        tile = tile.reshape(layout.getTileShape(line_group, band_group))
+        self.recent.insert(0, (key, tile))
+        del self.recent[self.cached_tiles:]
+        return tile
+
+    def iterTiles(self, line1, line2, band1, band2):
+        """Iterate over the tiles overlapping the range of lines and bands
+
+        @return: tuple of (first line of tile, first band of tile, tile)
+        """
+        layout = self.layout
+        for line_group in range(line1 / layout.tile_lines, (line2 + layout.tile_lines - 1) / layout.tile_lines):
+            for band_group in range(band1 / layout.tile_bands, (band2 + layout.tile_bands - 1) / layout.tile_bands):
+                yield (line_group * layout.tile_lines, band_group * layout.tile_bands,
+                       self.getTile(line_group, band_group))
+
+    def getBlock(self, line1, line2, band1, band2, sample1=0, sample2=None):
+        """Get an array of (lines x bands x samples) assembled from the tiles"""
+        if sample2 is None:
+            sample2 = self.samples
+        s = numpy.empty((line2 - line1, band2 - band1, sample2 - sample1), dtype=self.data_type)
+        for l, b, tile in self.iterTiles(line1, line2, band1, band2):
+            tl1 = max(line1 - l, 0)
+            tl2 = min(line2 - l, tile.shape[0])
+            tb1 = max(band1 - b, 0)
+            tb2 = min(band2 - b, tile.shape[1])
+            s[l + tl1 - line1:l + tl2 - line1, b + tb1 - band1:b + tb2 - band1, :] = tile[tl1:tl2, tb1:tb2, sample1:sample2]
+        return s
+
+    def getPixel(self, line, sample, band):
+        return self.getBlock(line, line + 1, band, band + 1, sample, sample + 1)[0, 0, 0]
+
+    def getBandRaw(self, band, use_progress=True):
+        """Get an array of (lines x samples) at the specified band"""
+        return self.getBlock(0, self.lines, band, band + 1)[:, 0, :]
+
+    def getBandTile(self, line1, line2, sample1, sample2, band):
+        """Get an array of (lines x samples) at the specified band"""
+        line1, line2, step = slice(line1, line2).indices(self.lines)
+        sample1, sample2, step = slice(sample1, sample2).indices(self.samples)
+        return self.getBlock(line1, max(line1, line2), band, band + 1, sample1, max(sample1, sample2))[:, 0, :]
+
+    def getBandsRaw(self, band1, band2):
+        """Get an array of (bands x lines x samples) for a range of bands"""
+        return self.getBlock(0, self.lines, band1, band2).transpose(1, 0, 2)
+
+    def getFocalPlaneRaw(self, line, use_progress=True):
+        """Get an array of (bands x samples) at the given line"""
+        return self.getBlock(line, line + 1, 0, self.bands)[0]
+
+    def getFocalPlanesRaw(self, line1, line2):
+        """Get an array of (lines x bands x samples) for a range of lines"""
+        return self.getBlock(line1, line2, 0, self.bands)
+
+    def getFocalPlaneDepthRaw(self, sample, band):
+        """Get an array of (lines) at the given sample and band"""
+        return self.getBlock(0, self.lines, band, band + 1, sample, sample + 1)[:, 0, 0]
+
+    def getSpectraRaw(self, line, sample):
+        """Get the spectra (bands) at the given pixel"""
+        return self.getBlock(line, line + 1, 0, self.bands, sample, sample + 1)[0, :, 0]
+
+    def getLineOfSpectraCopy(self, line):
+        """Get the spectra (samples x bands) along the given line"""
+        return self.getFocalPlaneRaw(line).T.copy()
+
+    def locationToFlat(self, line, sample, band):
+        return -1
+
+
+class ChunkedDataset(HSI.MetadataMixin):
+    """Chunked, compressed cube file.
+
+    Used both to read chunked cube files and to export any cube in the
+    chunked format.
+    """
+    format_id = "Chunked"
+    format_name = "Chunked compressed cube"
+    extensions = ['.pcc']
+
+    #: Approximate size in bytes of the uncompressed data of each tile
+    tile_bytes = 256 * 1024
+
+    #: Maximum number of bands in each tile
+    tile_bands = 32
+
+    #: zlib compression level
+    level = 6
+
+    def __init__(self, filename=None, **kwargs):
+        self.url = None
+        self.layout = None
+        if filename:
+            self.open(filename)
+
+    @classmethod
+    def identify(cls, url):
+        if json is None:
+            return False
+        fh = vfs.open(url)
+        try:
+            return ChunkedFormat.identify(fh)
+        finally:
+            fh.close()
+
+    @classmethod
+    def identifyHeader(cls, url, header):
+        if json is None:
+            return False
+        return header.startswith(ChunkedFormat.magic)
+
+    def open(self, url=None):
+        if url:
+            self.url = vfs.normalize(url)
+        fh = vfs.open(self.url)
+        try:
+            self.layout, index = ChunkedFormat.read(fh)
+        finally:
+            fh.close()
+
+    def __str__(self):
+        layout = self.layout
+        return "%dx%dx%d %s chunked cube, %d tiles of %d lines by %d bands, %s compression" % (layout.samples, layout.lines, layout.bands, layout.dtype, layout.line_groups * layout.band_groups, layout.tile_lines, layout.tile_bands, layout.compression)
+
+    def getCubeNames(self):
+        return [self.layout.metadata.get('description', '') or str(self.url)]
+
+    def getCube(self, filename=None, index=0, progress=None, options=None):
+        layout = self.layout
+        cube = HSI.newCube('bil', self.url, progress)
+        cube.lines = layout.lines
+        cube.samples = layout.samples
+        cube.bands = layout.bands
+        if layout.dtype.byteorder == '>':
+            byte_order = HSI.BigEndian
+        elif layout.dtype.byteorder == '<':
+            byte_order = HSI.LittleEndian
+        else:
+            byte_order = HSI.nativeByteOrder
+        cube.initialize(layout.dtype.newbyteorder('=').type, byte_order)
+        for name in ChunkedFormat.attributes:
+            if name in layout.metadata:
+                value = layout.metadata[name]
+                if isinstance(value, unicode):
+                    value = str(value)
+                elif isinstance(value, list):
+                    value = [str(v) if isinstance(v, unicode) else v for v in value]
+                setattr(cube, name, value)
+        cube.cube_io = ChunkedCubeReader(cube, self.url)
+        cube.verifyAttributes()
+        return cube
+
+    @classmethod
+    def canExport(cls):
+        return json is not None
+
+    @classmethod
+    def getLayout(cls, cube, options):
+        itemsize = numpy.dtype(cube.data_type).itemsize
+        tile_bands = options.get('tile_bands', min(cube.bands, cls.tile_bands))
+        line_bytes = max(cube.samples * tile_bands * itemsize, 1)
+        tile_lines = options.get('tile_lines', max(cls.tile_bytes / line_bytes, 1))
+        byte_order = options.get('byte_order', HSI.nativeByteOrder)
+        if byte_order == HSI.BigEndian:
+            dtype = numpy.dtype(cube.data_type).newbyteorder('>')
+        else:
+            dtype = numpy.dtype(cube.data_type).newbyteorder('<')
+        layout = ChunkedFormat(cube.lines, cube.samples, cube.bands, dtype,
+                               tile_lines, tile_bands,
+                               options.get('compression', 'zlib'))
+        if layout.compression not in ChunkedFormat.compressors:
+            raise ValueError("Unknown compression %s" % layout.compression)
+        for name in ChunkedFormat.attributes:
+            value = getattr(cube, name, None)
+            if value is not None:
+                if isinstance(value, numpy.ndarray):
+                    value = value.tolist()
+                layout.metadata[name] = value
+        return layout
+
+    @classmethod
+    def export(cls, filename, cube, options=None, progress=None):
+        """Write the cube as a chunked cube file
+
+        @param options: dict that may contain 'compression' ('zlib', 'lz4'
+        or 'none'), 'byte_order', 'tile_lines' and 'tile_bands'
+        """
+        if options is None:
+            options = dict()
+        layout = cls.getLayout(cube, options)
+        url = vfs.normalize(filename)
+        fh = vfs.open_write(url)
+        try:
+            fh.write(ChunkedFormat.magic)
+            fh.write(struct.pack("<I", ChunkedFormat.version))
+            offset = len(ChunkedFormat.magic) + 4
+            index = numpy.zeros((layout.line_groups * layout.band_groups, 2), dtype='<u8')
+            tile = 0
+            for line, block in cube.iterFocalPlaneBlocks(layout.tile_lines):
+                for band in range(0, cube.bands, layout.tile_bands):
+                    data = numpy.ascontiguousarray(block[:, band:band + layout.tile_bands, :], dtype=layout.dtype)
+                    data = layout.compress(data.tostring(), cls.level)
+                    fh.write(data)
+                    index[tile] = (offset, len(data))
+                    offset += len(data)
+                    tile += 1
+                if progress:
+                    progress(((line + block.shape[0]) * 100) / max(cube.lines, 1))
+            text = layout.toJSON()
+            fh.write(struct.pack("<I", len(text)))
+            fh.write(text)
+            fh.write(index.tostring())
+            fh.write(struct.pack("<Q", offset))
+            fh.write(ChunkedFormat.magic)
+        finally:
+            fh.close()
+
+
+HSI.HyperspectralFileFormat.addDefaultHandler(ChunkedDataset)
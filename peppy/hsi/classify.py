@@ -0,0 +1,200 @@
+# peppy Copyright (c) 2006-2010 Rob McMullen
+# Licenced under the GPLv2; see http://peppy.flipturn.org for more info
+"""Unsupervised classification of cubes.
+
+Clustering a whole cube with the standard k-means algorithm requires a pass
+through the data for every iteration.  Instead, the L{MiniBatchKMeans}
+classifier reads a small number of tiles of lines at random positions in the
+cube, and updates the cluster centers with small random batches of the
+spectra from those tiles.  A single streaming pass then labels every pixel
+with its nearest center, optionally split across a pool of worker processes
+when the cube can be memory mapped by them.
+"""
+
+import numpy
+
+from peppy.debug import *
+
+import cube as HSI
+import utils
+import parallel
+
+
+class MiniBatchKMeans(debugmixin):
+    """Mini-batch k-means clustering of the spectra of a cube.
+
+    The cluster centers are updated from batches of randomly chosen spectra
+    using a per-center learning rate that decreases as more spectra are
+    assigned to the center, following Sculley, "Web-Scale K-Means
+    Clustering" (2010).  Bad bands are not used.
+    """
+    #: Number of tiles of lines read at random positions in the cube
+    tiles = 16
+
+    #: Memory budget in bytes of each tile
+    tile_bytes = 4 * 1024 * 1024
+
+    #: Number of spectra taken from each tile
+    spectra_per_tile = 4096
+
+    #: Number of spectra in each batch
+    batch_size = 1024
+
+    #: Maximum number of batches
+    iterations = 200
+
+    #: The iterations stop when no center moves more than this fraction of
+    #: the typical magnitude of the spectra
+    tolerance = 1e-4
+
+    def __init__(self, cube, classes=8, seed=None):
+        """Prepare the classifier
+
+        @param cube: L{Cube} to classify
+
+        @param classes: number of clusters
+
+        @param seed: optional seed for the random number generator, to get
+        repeatable results
+        """
+        if classes < 1 or classes > 32767:
+            raise ValueError("Number of classes must be between 1 and 32767")
+        self.cube = cube
+        self.classes = classes
+        self.random = numpy.random.RandomState(seed)
+        self.good = cube.getGoodBands()
+        if len(self.good) == 0:
+            raise ValueError("All bands of the cube are marked as bad bands")
+        self.centers = None
+        self.counts = None
+
+    def getLinesPerTile(self):
+        line_bytes = self.cube.samples * self.cube.bands * self.cube.itemsize
+        return self.cube.getLinesPerBlock(line_bytes, self.tile_bytes)
+
+    def getSample(self):
+        """Read the random tiles and pick random spectra from each
+
+        @return: float64 array of (spectra x good bands)
+        """
+        cube = self.cube
+        count = self.getLinesPerTile()
+        starts = range(0, cube.lines, count)
+        if len(starts) > self.tiles:
+            starts = self.random.permutation(starts)[0:self.tiles]
+        sample = []
+        # Read the tiles in file order to avoid seeking back and forth
+        for line in sorted(starts):
+            block = cube.getFocalPlanesRaw(line, min(line + count, cube.lines))
+            pixels = block[:, self.good, :].transpose(0, 2, 1).reshape(-1, len(self.good))
+            if len(pixels) > self.spectra_per_tile:
+                pixels = pixels[self.random.randint(0, len(pixels), self.spectra_per_tile)]
+            sample.append(pixels.astype(numpy.float64))
+        return numpy.concatenate(sample)
+
+    def initCenters(self, sample):
+        """Choose the initial centers from the sample using k-means++
+
+        Each new center is chosen with a probability proportional to the
+        squared distance of the spectrum from the nearest center already
+        chosen, which spreads the initial centers across the clusters.
+        """
+        centers = numpy.zeros((self.classes, sample.shape[1]), dtype=numpy.float64)
+        centers[0] = sample[self.random.randint(0, len(sample))]
+        dist2 = ((sample - centers[0]) ** 2).sum(axis=1)
+        for i in range(1, self.classes):
+            total = dist2.sum()
+            if total <= 0.0:
+                raise ValueError("Only %d distinct spectra found for %d classes" % (i, self.classes))
+            index = numpy.searchsorted(dist2.cumsum(), self.random.uniform(0.0, total), side='right')
+            centers[i] = sample[min(index, len(sample) - 1)]
+            numpy.minimum(dist2, ((sample - centers[i]) ** 2).sum(axis=1), dist2)
+        self.centers = centers
+        self.counts = numpy.zeros(self.classes, dtype=numpy.float64)
+
+    def countLabels(self, labels, weights=None):
+        """Return the (optionally weighted) number of each label as a float64
+        array of one entry per class.
+
+        Older versions of numpy don't support the minlength argument of
+        bincount, so the counts are copied into a full length array.
+        """
+        counts = numpy.zeros(self.classes, dtype=numpy.float64)
+        if len(labels) > 0:
+            if weights is None:
+                found = numpy.bincount(labels)
+            else:
+                found = numpy.bincount(labels, weights)
+            counts[0:len(found)] = found
+        return counts
+
+    def updateCenters(self, batch):
+        """Move the centers toward the spectra of the batch assigned to them
+
+        @return: largest distance moved by a center
+        """
+        labels = utils.getNearestCenters(batch, self.centers)
+        assigned = self.countLabels(labels)
+        sums = numpy.zeros(self.centers.shape, dtype=numpy.float64)
+        for i in range(self.centers.shape[1]):
+            sums[:, i] = self.countLabels(labels, batch[:, i])
+        self.counts += assigned
+        used = assigned > 0
+        # Equivalent to applying the per-spectrum update c += (x - c) / n
+        # to each spectrum of the batch in turn
+        step = (sums[used] - assigned[used, numpy.newaxis] * self.centers[used]) / self.counts[used, numpy.newaxis]
+        self.centers[used] += step
+        if not used.any():
+            return 0.0
+        return numpy.sqrt((step * step).sum(axis=1)).max()
+
+    def train(self, progress=None):
+        """Find the cluster centers
+
+        @param progress: optional callable taking the percent complete
+
+        @return: number of batches used
+        """
+        sample = self.getSample()
+        self.initCenters(sample)
+        scale = numpy.sqrt((sample * sample).sum(axis=1)).mean()
+        limit = self.tolerance * max(scale, 1e-12)
+        size = min(self.batch_size, len(sample))
+        for iteration in range(self.iterations):
+            batch = sample[self.random.randint(0, len(sample), size)]
+            moved = self.updateCenters(batch)
+            if progress:
+                progress(((iteration + 1) * 100) / self.iterations)
+            if moved < limit:
+                break
+        return iteration + 1
+
+    def classify(self, progress=None, processes=None):
+        """Label every pixel of the cube with its nearest center
+
+        @param progress: optional callable taking the percent complete
+
+        @param processes: number of worker processes, or 0 to use one per
+        CPU.  The pixels are labeled in this process if processes is None or
+        1 (the default), or if the cube can't be memory mapped by the
+        workers.
+
+        @return: single band int16 cube of the same lines and samples as the
+        source cube
+        """
+        if self.centers is None:
+            self.train()
+        cube = self.cube
+        classes = HSI.createCubeLike(cube, interleave='bsq', bands=1, datatype=numpy.int16, byteorder=HSI.nativeByteOrder)
+        classes.band_names = ['Class']
+        classes.spectra_names = ["Class %d" % (i + 1) for i in range(self.classes)]
+        band = classes.getBandRaw(0)
+        if parallel.getNumProcesses(processes) > 1 and parallel.CubeSource.fromCube(cube) is not None:
+            band[:,:] = parallel.classifyInParallel(cube, self.good, self.centers, processes, progress)
+        else:
+            for line, block in cube.iterFocalPlaneBlocks():
+                end = line + block.shape[0]
+                band[line:end,:] = utils.getNearestCentersOfBlock(block, self.good, self.centers)
+                if progress:
+                    progress((end * 100) / max(cube.lines, 1))
+        return classes
@@ -43,9 +43,12 @@ __all__ = ['HSIActionMixin', 'scipy_module',
            'Cube', 'CubeReader',
            'MetadataMixin', 'newCube', 'createCube', 'createCubeLike',
            'LittleEndian', 'BigEndian', 'nativeByteOrder', 'native_endian',
+           'getSwappedView',
            'HyperspectralFileFormat',
-           'ROI', 'ROIFile',
+           'CubeReduction',
+           'ROI', 'ROIFile', 'ROIStatistics',
            'HyperspectralROIFormat',
-           'spectralAngle', 'resample', 'resampleSingle', 'normalizeUnits',
+           'spectralAngle', 'resample', 'resampleSingle', 'SpectralResampler',
+           'normalizeUnits',
            'bandPixelize', 'bandReduceSampling',
            ]
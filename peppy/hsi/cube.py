@@ -12,6 +12,11 @@ from datetime import datetime
 
 import numpy
 import utils
+from cache import TileCache, MemoryBudget
+from transpose import InterleaveTransposer
+from stats import BandStatistics, StatsCache
+from readahead import ReadAheadIterator, getRanges
+from reduction import CubeReduction
 
 import peppy.vfs as vfs
 
@@ -29,6 +34,15 @@ else:
     native_endian = '>'
 byteordertext=['<','>']
 
+def getSwappedView(data):
+    """Return a view of the array that interprets its bytes in the opposite
+    byte order.
+    
+    The values are the same as those of data.byteswap(), but the data isn't
+    copied.
+    """
+    return data.view(data.dtype.newbyteorder())
+
 
 class MetadataMixin(debugmixin):
     """Generic mixin interface for Cube metadata.
@@ -48,6 +62,42 @@ class MetadataMixin(debugmixin):
         load."""
         return False
     
+    @classmethod
+    def identifyHeader(cls, url, header):
+        """Identify the file given the first bytes of the file.
+        
+        This is called by L{HyperspectralFileFormat} with the start of the
+        file that is read once and shared by all handlers, so subclasses
+        should override this to avoid reopening the file.  The default
+        falls back to L{identify}.
+        
+        @param url: url of the file
+        
+        @param header: string holding the first
+        L{HyperspectralFileFormat.header_bytes} of the file (or the whole
+        file if it is shorter)
+        
+        @return: a false value if the file isn't recognized.  Otherwise,
+        True or any other true value, which is passed to the constructor of
+        the subclass as the identity keyword argument and is cached along
+        with the handler.
+        """
+        return cls.identify(url)
+    
+    @classmethod
+    def getIdentifyDependencies(cls, url, info):
+        """Return the urls of other files that the identification of the url
+        depends on.
+        
+        If any of these files change, the cached identification of the url
+        is discarded.
+        
+        @param url: url of the file
+        
+        @param info: the value returned by L{identifyHeader}
+        """
+        return []
+    
     @classmethod
     def canExport(cls):
         return False
@@ -104,6 +154,12 @@ class MetadataMixin(debugmixin):
 
 class CubeReader(debugmixin):
     """Abstract class for reading raw data from an HSI cube"""
+    
+    #: Whether or not data returned from this reader should be stored in the
+    #: L{Cube.tile_cache}.  Only readers that must go back to the file for
+    #: every request benefit from the cache.
+    use_tile_cache = False
+    
     def __init__(self):
         self.user_counts_from = 1
     
@@ -149,6 +205,81 @@ class CubeReader(debugmixin):
         """Get an array of (lines) at the given sample and band"""
         raise NotImplementedError
 
+    def getFocalPlanesRaw(self, line1, line2):
+        """Get an array of (lines x bands x samples) for a range of lines.
+        
+        This is a bulk version of L{getFocalPlaneRaw} used when processing
+        the entire cube in large blocks.  The default implementation stacks
+        individual focal planes; subclasses override it to read the whole
+        block at once.  The returned array may be a view into the data, so
+        don't modify it.
+        
+        @param line1: first line
+        
+        @param line2: one past the last line
+        """
+        s = None
+        for line in range(line1, line2):
+            fp = self.getFocalPlaneRaw(line, use_progress=False)
+            if s is None:
+                s = numpy.empty((line2 - line1,) + fp.shape, dtype=fp.dtype)
+            s[line - line1] = fp
+        return s
+
+    def getBandLinesRaw(self, band, line1, line2):
+        """Get an array of (lines x samples) for a range of lines of a band.
+        
+        The default implementation slices the full band; readers that can
+        read just the requested lines override it.  The returned array may
+        be a view into the data, so don't modify it.
+        
+        @param band: band number
+        
+        @param line1: first line
+        
+        @param line2: one past the last line
+        """
+        return self.getBandRaw(band, use_progress=False)[line1:line2]
+
+    def getBandsRaw(self, band1, band2):
+        """Get an array of (bands x lines x samples) for a range of bands.
+        
+        This is a bulk version of L{getBandRaw}.  The default implementation
+        stacks individual bands; subclasses override it to read all the
+        bands in a single pass through the data.  The returned array may be
+        a view into the data, so don't modify it.
+        
+        @param band1: first band
+        
+        @param band2: one past the last band
+        """
+        s = None
+        for band in range(band1, band2):
+            plane = self.getBandRaw(band, use_progress=False)
+            if s is None:
+                s = numpy.empty((band2 - band1,) + plane.shape, dtype=plane.dtype)
+            s[band - band1] = plane
+        return s
+
+    def getSpectraAtPointsRaw(self, lines, samples):
+        """Get an array of (points x bands) of the spectra at many pixels.
+        
+        This is a bulk version of L{getSpectraRaw} for gathering many
+        scattered pixels at once, e.g. all the points in a region of
+        interest.  The default implementation reads each spectrum
+        individually; subclasses override it to use the fastest access
+        order of the data.
+        
+        @param lines: array of line numbers of the points
+        
+        @param samples: array of sample numbers of the points, the same
+        length as lines
+        """
+        s = numpy.empty((len(lines), self.bands), dtype=self.data_type)
+        for i in range(len(lines)):
+            s[i] = self.getSpectraRaw(lines[i], samples[i])
+        return s
+
     def getLineOfSpectraCopy(self, line):
         """Get the spectra (samples x bands) along the given line"""
         # Default implementation is to use the transpose of getFocalPlaneRaw,
@@ -251,6 +382,13 @@ class FileCubeReader(CubeReader):
     Note: this is (potentially much) slower than mmap access of the
     L{MMapCubeReader}, but won't throw out of memory exceptions.
     """
+    #: Maximum number of bytes read from the file at one time when gathering
+    #: strided data (e.g. a band from a BIP cube).  Reads are rounded to a
+    #: whole number of lines, so at least one line is always read.
+    block_bytes = 16 * 1024 * 1024
+    
+    use_tile_cache = True
+    
     def __init__(self, cube, url=None, array=None):
         CubeReader.__init__(self)
         self.fh = vfs.open(url)
@@ -262,15 +400,17 @@ class FileCubeReader(CubeReader):
             self.offset = cube.data_offset
         self.dprint("url=%s file=%s offset=%d" % (url, self.fh, self.offset))
         self.getSizeFromCube(cube)
-        self.data_type = cube.data_type
+        # Data is read using the byte order of the file, so non-native data
+        # isn't swapped when read; numpy converts the values only when they
+        # are used in a calculation
+        self.data_type = cube.getDtype()
         self.itemsize = cube.itemsize
         self.getProgressBar = cube.getProgressBar
-        if cube.byte_order != nativeByteOrder:
-            self.swap = True
-        else:
-            self.swap = False
         
         self.invalid_after = -1
+        
+        # reusable buffer for block reads, allocated on first use
+        self.block_buffer = None
     
     def isInvalid(self, pos):
         if self.invalid_after >= 0:
@@ -324,6 +464,107 @@ class FileCubeReader(CubeReader):
             # hit out of memory error, so load in pieces
             fh.seek(pos)
             return self.getNumpyArrayFromFilePiecewise(fh, count)
+    
+    def readNumpyArrayInto(self, fh, buf):
+        """Fill a numpy array with data from the current file position.
+        
+        Like L{getNumpyArrayFromFile}, but reads directly into a preallocated
+        array so that the same memory can be reused for many reads.  Missing
+        data at the end of the file is marked as invalid and filled with 0xff
+        bytes.
+        
+        @param fh: file-like object positioned at the start of the data
+        
+        @param buf: contiguous 1D array of self.data_type to be filled
+        """
+        pos = fh.tell()
+        count = buf.size * self.itemsize
+        if hasattr(fh, 'readinto'):
+            num = fh.readinto(buf)
+        else:
+            bytes = fh.read(count)
+            num = len(bytes)
+            if num == count:
+                buf[:] = numpy.fromstring(bytes, dtype=self.data_type)
+            else:
+                buf.view(numpy.uint8)[0:num] = numpy.fromstring(bytes, dtype=numpy.uint8)
+        if num != count:
+            self.setInvalidAfter(pos + num)
+            buf.view(numpy.uint8)[num:] = 0xff
+        return buf
+    
+    def getLinesPerBlock(self):
+        """Return the number of lines that fit in a block of L{block_bytes}"""
+        line_bytes = self.samples * self.bands * self.itemsize
+        count = max(self.block_bytes / max(line_bytes, 1), 1)
+        return min(count, self.lines)
+    
+    def getBlockBuffer(self, count):
+        """Return a reusable 1D array of exactly count items.
+        
+        The returned array is a view into a buffer that is shared among all
+        the block reads of this reader, so the contents are only valid until
+        the next block read.
+        """
+        if self.block_buffer is None or self.block_buffer.size < count:
+            self.block_buffer = numpy.empty(count, dtype=self.data_type)
+        return self.block_buffer[0:count]
+    
+    def iterLineBlocks(self, progress=None):
+        """Iterate through the cube reading many lines at a time.
+        
+        Only useful for interleaves that store all the data of a line
+        contiguously (i.e. BIP and BIL), because the whole cube is read
+        sequentially using large reads into a reusable buffer.
+        
+        @param progress: optional progress bar that will be updated with the
+        line number after every block
+        
+        @return: tuple of (line number of first line in the block, block)
+        where block is a 2D array of (lines x (samples * bands)) items in file
+        order.  The block is only valid until the next iteration.
+        """
+        fh = self.fh
+        fh.seek(self.offset)
+        items_per_line = self.samples * self.bands
+        block_lines = self.getLinesPerBlock()
+        line = 0
+        while line < self.lines:
+            count = min(block_lines, self.lines - line)
+            buf = self.getBlockBuffer(count * items_per_line)
+            self.readNumpyArrayInto(fh, buf)
+            yield line, buf.reshape(count, items_per_line)
+            line += count
+            if progress:
+                progress.updateProgress(line)
+    
+    def getSpectraAtPointsRaw(self, lines, samples):
+        """Get an array of (points x bands) of the spectra at many pixels.
+        
+        The points are sorted by line and nearby lines are read together in
+        blocks using L{getFocalPlanesRaw}, so each block of lines is read
+        once regardless of the number of points in it.  This is a single
+        read for BIP and BIL cubes, and one read per band for BSQ cubes,
+        rather than one read per band for every point.
+        """
+        lines = numpy.asarray(lines, dtype=numpy.int64)
+        samples = numpy.asarray(samples, dtype=numpy.int64)
+        s = numpy.empty((len(lines), self.bands), dtype=self.data_type)
+        if len(lines) == 0:
+            return s
+        order = numpy.argsort(lines, kind='mergesort')
+        sorted_lines = lines[order]
+        block_lines = self.getLinesPerBlock()
+        start = 0
+        while start < len(order):
+            line1 = sorted_lines[start]
+            end = numpy.searchsorted(sorted_lines, line1 + block_lines, side='left')
+            line2 = sorted_lines[end - 1] + 1
+            index = order[start:end]
+            block = self.getFocalPlanesRaw(line1, line2)
+            s[index] = block[lines[index] - line1, :, samples[index]]
+            start = end
+        return s
 
 
 class FileBIPCubeReader(BIPMixin, FileCubeReader):
@@ -339,42 +580,32 @@ class FileBIPCubeReader(BIPMixin, FileCubeReader):
         skip = (self.bands * self.samples) * line + (self.bands * sample) + band
         fh.seek(self.offset + (skip * self.itemsize))
         s = self.getNumpyArrayFromFile(fh, 1)
-        if self.swap:
-            s.byteswap(True)
         return s[0]
 
     def getBandRaw(self, band, use_progress=True):
         """Get an array of (lines x samples) at the specified band"""
         s = numpy.empty((self.lines, self.samples), dtype=self.data_type)
-        fh = self.fh
-        fh.seek(self.offset + (band * self.itemsize))
         
-        # the amount to skip between successive reads will be one less than the
-        # number of bands, because the file pointer advances by one item after
-        # a read
-        skip = self.itemsize * (self.bands - 1)
-        samp = 0
-        line = 0
+        # Band data is strided through the entire file, so read big blocks of
+        # lines and pull the band out of each block using a strided view
         progress = self.getProgressBar(use_progress)
         if progress:
             progress.startProgress("Loading Band %d" % (band + self.user_counts_from), self.lines, delay=1.0)
-        while True:
-            data = self.getNumpyArrayFromFile(fh, 1)
-            s[line, samp] = data[0]
-            samp += 1
-            if samp >= self.samples:
-                samp = 0
-                line += 1
-                if line >= self.lines:
-                    break
-                if progress:
-                    progress.updateProgress(line)
-            fh.seek(skip, 1)
+        for line, block in self.iterLineBlocks(progress):
+            block = block.reshape(block.shape[0], self.samples, self.bands)
+            s[line:line + block.shape[0], :] = block[:, :, band]
         if progress:
             progress.stopProgress("Loaded Band %d" % (band + self.user_counts_from))
             
-        if self.swap:
-            s.byteswap(True)
+        return s
+
+    def getBandsRaw(self, band1, band2):
+        """Get an array of (bands x lines x samples) for a range of bands
+        using a single pass through the file"""
+        s = numpy.empty((band2 - band1, self.lines, self.samples), dtype=self.data_type)
+        for line, block in self.iterLineBlocks():
+            block = block.reshape(block.shape[0], self.samples, self.bands)
+            s[:, line:line + block.shape[0], :] = block[:, :, band1:band2].transpose(2, 0, 1)
         return s
 
     def getSpectraRaw(self, line, sample):
@@ -383,8 +614,6 @@ class FileBIPCubeReader(BIPMixin, FileCubeReader):
         skip = (self.bands * self.samples) * line + (self.bands * sample)
         fh.seek(self.offset + (skip * self.itemsize))
         s = self.getNumpyArrayFromFile(fh, self.bands)
-        if self.swap:
-            s.byteswap(True)
         return s
 
     def getFocalPlaneRaw(self, line, use_progress=True):
@@ -394,10 +623,16 @@ class FileBIPCubeReader(BIPMixin, FileCubeReader):
         fh.seek(self.offset + (skip * self.itemsize))
         s = self.getNumpyArrayFromFile(fh, (self.bands * self.samples))
         s = s.reshape(self.samples, self.bands).T
-        if self.swap:
-            s.byteswap(True)
         return s
 
+    def getFocalPlanesRaw(self, line1, line2):
+        """Get an array of (lines x bands x samples) for a range of lines"""
+        fh = self.fh
+        fh.seek(self.offset + (self.bands * self.samples * line1 * self.itemsize))
+        s = numpy.empty((line2 - line1) * self.samples * self.bands, dtype=self.data_type)
+        self.readNumpyArrayInto(fh, s)
+        return s.reshape(line2 - line1, self.samples, self.bands).transpose(0, 2, 1)
+
     def getFocalPlaneDepthRaw(self, sample, band):
         """Get an array of values along a line, the given sample and band"""
         s = numpy.empty((self.lines,), dtype=self.data_type)
@@ -406,7 +641,8 @@ class FileBIPCubeReader(BIPMixin, FileCubeReader):
         
         # amount to skip to read the next line at the same sample, band
         # coordinate is one less because the file pointer will have advanced
-        # by one due to the file read
+        # by one due to the file read.  Only one value is needed from each
+        # line, so seeking is much cheaper than reading whole blocks of lines.
         skip = self.itemsize * ((self.samples * self.bands) - 1)
         line = 0
         while line < self.lines:
@@ -415,8 +651,6 @@ class FileBIPCubeReader(BIPMixin, FileCubeReader):
             line += 1
             fh.seek(skip, 1)
             
-        if self.swap:
-            s.byteswap(True)
         return s
 
 
@@ -433,39 +667,32 @@ class FileBILCubeReader(BILMixin, FileCubeReader):
         skip = (self.bands * self.samples) * line + (self.samples * band) + sample
         fh.seek(self.offset + (skip * self.itemsize))
         s = self.getNumpyArrayFromFile(fh, 1)
-        if self.swap:
-            s.byteswap(True)
         return s[0]
 
     def getBandRaw(self, band, use_progress=True):
         """Get an array of (lines x samples) at the specified band"""
         s = numpy.empty((self.lines, self.samples), dtype=self.data_type)
-        fh = self.fh
-        fh.seek(self.offset + ((band * self.samples) * self.itemsize))
         
-        # the amount to skip between successive reads will be less than the
-        # number of bands * samples, because the file pointer advances by the
-        # number of samples after a read
-        skip = self.itemsize * ((self.samples * self.bands) - self.samples)
-        samp = 0
-        line = 0
+        # Each line of the band is a short contiguous run, so read big blocks
+        # of lines and pull the band out of each block using a strided view
         progress = self.getProgressBar(use_progress)
         if progress:
             progress.startProgress("Loading Band %d" % (band + self.user_counts_from), self.lines, delay=1)
-        while True:
-            data = self.getNumpyArrayFromFile(fh, self.samples)
-            s[line, :] = data
-            line += 1
-            if line >= self.lines:
-                break
-            if progress:
-                progress.updateProgress(line)
-            fh.seek(skip, 1)
+        for line, block in self.iterLineBlocks(progress):
+            block = block.reshape(block.shape[0], self.bands, self.samples)
+            s[line:line + block.shape[0], :] = block[:, band, :]
         if progress:
             progress.stopProgress("Loaded Band %d" % (band + self.user_counts_from))
             
-        if self.swap:
-            s.byteswap(True)
+        return s
+
+    def getBandsRaw(self, band1, band2):
+        """Get an array of (bands x lines x samples) for a range of bands
+        using a single pass through the file"""
+        s = numpy.empty((band2 - band1, self.lines, self.samples), dtype=self.data_type)
+        for line, block in self.iterLineBlocks():
+            block = block.reshape(block.shape[0], self.bands, self.samples)
+            s[:, line:line + block.shape[0], :] = block[:, band1:band2, :].transpose(1, 0, 2)
         return s
 
     def getSpectraRaw(self, line, sample):
@@ -484,8 +711,6 @@ class FileBILCubeReader(BILMixin, FileCubeReader):
             s[band] = data[0]
             band += 1
             fh.seek(skip, 1)
-        if self.swap:
-            s.byteswap(True)
         return s
 
     def getFocalPlaneRaw(self, line, use_progress=True):
@@ -495,10 +720,16 @@ class FileBILCubeReader(BILMixin, FileCubeReader):
         fh.seek(self.offset + (skip * self.itemsize))
         s = self.getNumpyArrayFromFile(fh, (self.bands * self.samples))
         s = s.reshape(self.bands, self.samples)
-        if self.swap:
-            s.byteswap(True)
         return s
 
+    def getFocalPlanesRaw(self, line1, line2):
+        """Get an array of (lines x bands x samples) for a range of lines"""
+        fh = self.fh
+        fh.seek(self.offset + (self.bands * self.samples * line1 * self.itemsize))
+        s = numpy.empty((line2 - line1) * self.bands * self.samples, dtype=self.data_type)
+        self.readNumpyArrayInto(fh, s)
+        return s.reshape(line2 - line1, self.bands, self.samples)
+
     def getFocalPlaneDepthRaw(self, sample, band):
         """Get an array of values along a line, the given sample and band"""
         s = numpy.empty((self.lines,), dtype=self.data_type)
@@ -507,7 +738,8 @@ class FileBILCubeReader(BILMixin, FileCubeReader):
         
         # amount to skip to read the next line at the same sample, band
         # coordinate is one less because the file pointer will have advanced
-        # by one due to the file read
+        # by one due to the file read.  Only one value is needed from each
+        # line, so seeking is much cheaper than reading whole blocks of lines.
         skip = self.itemsize * ((self.samples * self.bands) - 1)
         line = 0
         while line < self.lines:
@@ -516,8 +748,6 @@ class FileBILCubeReader(BILMixin, FileCubeReader):
             line += 1
             fh.seek(skip, 1)
             
-        if self.swap:
-            s.byteswap(True)
         return s
 
 
@@ -534,8 +764,6 @@ class FileBSQCubeReader(BSQMixin, FileCubeReader):
         skip = (self.lines * self.samples) * band + (self.samples * line) + sample
         fh.seek(self.offset + (skip * self.itemsize))
         s = self.getNumpyArrayFromFile(fh, 1)
-        if self.swap:
-            s.byteswap(True)
         return s[0]
 
     def getBandRaw(self, band, use_progress=True):
@@ -545,10 +773,31 @@ class FileBSQCubeReader(BSQMixin, FileCubeReader):
         fh.seek(self.offset + (skip * self.itemsize))
         s = self.getNumpyArrayFromFile(fh, (self.lines * self.samples))
         s = s.reshape(self.lines, self.samples)
-        if self.swap:
-            s.byteswap(True)
         return s
 
+    def getBandLinesRaw(self, band, line1, line2):
+        """Get an array of (lines x samples) for a range of lines of a band
+        
+        The lines of a band are contiguous, so this is a single read.
+        """
+        fh = self.fh
+        skip = (self.lines * self.samples) * band + (self.samples * line1)
+        fh.seek(self.offset + (skip * self.itemsize))
+        s = self.getNumpyArrayFromFile(fh, (line2 - line1) * self.samples)
+        s = s.reshape(line2 - line1, self.samples)
+        return s
+
+    def getBandsRaw(self, band1, band2):
+        """Get an array of (bands x lines x samples) for a range of bands
+        
+        The bands are contiguous, so this is a single read.
+        """
+        s = numpy.empty((band2 - band1) * self.lines * self.samples, dtype=self.data_type)
+        fh = self.fh
+        fh.seek(self.offset + (band1 * self.lines * self.samples * self.itemsize))
+        self.readNumpyArrayInto(fh, s)
+        return s.reshape(band2 - band1, self.lines, self.samples)
+
     def getSpectraRaw(self, line, sample):
         """Get the spectra at the given pixel"""
         s = numpy.empty((self.bands,), dtype=self.data_type)
@@ -565,8 +814,6 @@ class FileBSQCubeReader(BSQMixin, FileCubeReader):
             s[band] = data[0]
             band += 1
             fh.seek(skip, 1)
-        if self.swap:
-            s.byteswap(True)
         return s
 
     def getFocalPlaneRaw(self, line, use_progress=True):
@@ -594,10 +841,22 @@ class FileBSQCubeReader(BSQMixin, FileCubeReader):
             fh.seek(skip, 1)
         if progress:
             progress.stopProgress("Loaded Focal Plane at line %d" % (line + self.user_counts_from))
-        if self.swap:
-            s.byteswap(True)
         return s
 
+    def getFocalPlanesRaw(self, line1, line2):
+        """Get an array of (lines x bands x samples) for a range of lines
+        
+        The lines are contiguous within each band, so this performs one
+        read per band directly into the output array.
+        """
+        count = line2 - line1
+        s = numpy.empty((self.bands, count * self.samples), dtype=self.data_type)
+        fh = self.fh
+        for band in range(self.bands):
+            fh.seek(self.offset + (((band * self.lines) + line1) * self.samples * self.itemsize))
+            self.readNumpyArrayInto(fh, s[band])
+        return s.reshape(self.bands, count, self.samples).transpose(1, 0, 2)
+
     def getFocalPlaneDepthRaw(self, sample, band):
         """Get an array of values along a line, the given sample and band"""
         s = numpy.empty((self.lines,), dtype=self.data_type)
@@ -614,8 +873,6 @@ class FileBSQCubeReader(BSQMixin, FileCubeReader):
             s[line] = data[0]
             line += 1
             fh.seek(skip, 1)
-        if self.swap:
-            s.byteswap(True)
         return s
 
 
@@ -678,8 +935,7 @@ class MMapCubeReader(CubeReader):
         else:
             slice = self.mmap[:]
                 
-        view = slice.view(cube.data_type)
-        self.raw = view.newbyteorder(byteordertext[cube.byte_order])
+        self.raw = slice.view(cube.getDtype())
     
     def getRaw(self):
         """Return the raw numpy array"""
@@ -743,6 +999,14 @@ class MMapBIPCubeReader(BIPMixin, MMapCubeReader):
         s = self.raw[line, sample, :]
         return s
 
+    def getSpectraAtPointsRaw(self, lines, samples):
+        """Get an array of (points x bands) of the spectra at many pixels"""
+        return self.raw[lines, samples, :]
+
+    def getBandsRaw(self, band1, band2):
+        """Get an array of (bands x lines x samples) for a range of bands"""
+        return self.raw[:, :, band1:band2].transpose(2, 0, 1)
+
     def getFocalPlaneRaw(self, line, use_progress=True):
         """Get an array of (bands x samples) the given line"""
         # Note: transpose doesn't seem to automatically generate a copy, so
@@ -750,6 +1014,10 @@ class MMapBIPCubeReader(BIPMixin, MMapCubeReader):
         s = self.raw[line, :, :].T
         return s
 
+    def getFocalPlanesRaw(self, line1, line2):
+        """Get an array of (lines x bands x samples) for a range of lines"""
+        return self.raw[line1:line2, :, :].transpose(0, 2, 1)
+
     def getFocalPlaneDepthRaw(self, sample, band):
         """Get an array of values at constant line, the given sample and band"""
         s = self.raw[:, sample, band]
@@ -782,12 +1050,24 @@ class MMapBILCubeReader(BILMixin, MMapCubeReader):
         """Get the spectra at the given pixel"""
         s = self.raw[line, :, sample]
         return s
+
+    def getSpectraAtPointsRaw(self, lines, samples):
+        """Get an array of (points x bands) of the spectra at many pixels"""
+        return self.raw[lines, :, samples]
+
+    def getBandsRaw(self, band1, band2):
+        """Get an array of (bands x lines x samples) for a range of bands"""
+        return self.raw[:, band1:band2, :].transpose(1, 0, 2)
     
     def getFocalPlaneRaw(self, line, use_progress=True):
         """Get an array of (bands x samples) the given line"""
         s = self.raw[line, :, :]
         return s
 
+    def getFocalPlanesRaw(self, line1, line2):
+        """Get an array of (lines x bands x samples) for a range of lines"""
+        return self.raw[line1:line2, :, :]
+
     def getFocalPlaneDepthRaw(self, sample, band):
         """Get an array of values at constant line, the given sample and band"""
         s = self.raw[:, band, sample]
@@ -823,11 +1103,23 @@ class MMapBSQCubeReader(BSQMixin, MMapCubeReader):
         s = self.raw[:, line, sample]
         return s
 
+    def getSpectraAtPointsRaw(self, lines, samples):
+        """Get an array of (points x bands) of the spectra at many pixels"""
+        return self.raw[:, lines, samples].T
+
+    def getBandsRaw(self, band1, band2):
+        """Get an array of (bands x lines x samples) for a range of bands"""
+        return self.raw[band1:band2, :, :]
+
     def getFocalPlaneRaw(self, line, use_progress=True):
         """Get an array of (bands x samples) the given line"""
         s = self.raw[:, line, :]
         return s
 
+    def getFocalPlanesRaw(self, line1, line2):
+        """Get an array of (lines x bands x samples) for a range of lines"""
+        return self.raw[:, line1:line2, :].transpose(1, 0, 2)
+
     def getFocalPlaneDepthRaw(self, sample, band):
         """Get an array of values at constant line, the given sample and band"""
         s = self.raw[band, :, sample]
@@ -868,6 +1160,19 @@ class Cube(debugmixin):
     # Image sizes smaller than the limit specified here will be loaded using
     # mmap; otherwise will be loaded with direct file access
     mmap_size_limit = -1
+    
+    #: Cache shared among all cubes that holds recently used planes of data
+    #: from cube readers that are slow to access.  See L{TileCache}.
+    tile_cache = TileCache()
+
+    #: Budget shared among all cubes created in memory, past which they are
+    #: moved to temporary files.  See L{MemoryBudget}.
+    memory_budget = MemoryBudget()
+
+    #: Memory budget in bytes of each block returned by
+    #: L{iterFocalPlaneBlocks} and L{iterBandBlocks}, also used by the bulk
+    #: processing code through L{getLinesPerBlock}
+    readahead_bytes = 16 * 1024 * 1024
 
     def __init__(self, filename=None, interleave='unknown', progress=None):
         self.url = None
@@ -941,6 +1246,13 @@ class Cube(debugmixin):
         # calculated quantities
         self.spectraextrema=[None,None] # min and max over whole cube
         
+        # per-band statistics, calculated or loaded on demand
+        self.statistics = None
+        
+        # spectrum ordered copy of the data used for spectra lookups, see
+        # L{SpectralShadow}
+        self.spectral_shadow = None
+        
         # progress bar indicator
         self.progress = progress
 
@@ -1022,7 +1334,13 @@ class Cube(debugmixin):
     def open(self,url=None):
         if url:
             self.setURL(url)
+            if self.cube_io is not None:
+                self.tile_cache.removeReader(self.cube_io)
             self.cube_io = None
+            self.statistics = None
+            if self.spectral_shadow is not None:
+                self.spectral_shadow.stop()
+                self.spectral_shadow = None
 
         if self.url:
             if self.cube_io is None: # don't try to reopen if already open
@@ -1059,6 +1377,11 @@ class Cube(debugmixin):
         else:
             self.endian = byteordertext[self.byte_order]
 
+    def getDtype(self):
+        """Return the numpy dtype of the data including the byte order in
+        which it is stored"""
+        return numpy.dtype(self.data_type).newbyteorder(byteordertext[self.byte_order])
+    
     def initializeOffset(self):
         if self.header_offset>0 or self.file_offset>0:
             if self.data_offset==0:
@@ -1178,10 +1501,87 @@ class Cube(debugmixin):
 
     def getUpdatedExtrema(self):
         return self.spectraextrema
+    
+    def getStatistics(self, compute=True, reader=None, progress=None):
+        """Return the per-band statistics of the cube.
+        
+        Statistics are loaded from the sidecar cache if they have been
+        calculated previously for the same data file; otherwise they are
+        calculated in a single pass through the cube and saved to the cache.
+        
+        @param compute: if False, only return statistics that are already
+        available without reading the data, returning None if there aren't
+        any
+        
+        @param reader: optional cube reader passed to
+        L{BandStatistics.fromCube}
+        
+        @param progress: optional callable taking the percent complete
+        
+        @return: L{BandStatistics} instance or None
+        """
+        if self.statistics is None:
+            stats = StatsCache.load(self)
+            if stats is None and compute:
+                stats = BandStatistics.fromCube(self, reader, progress)
+                StatsCache.save(self, stats)
+            if stats is not None:
+                self.setStatistics(stats)
+        return self.statistics
+    
+    def setStatistics(self, stats):
+        """Use the given statistics for this cube, which also provides the
+        extrema of the whole cube without further scanning of the data.
+        """
+        self.statistics = stats
+        minval, maxval = stats.getCubeExtrema()
+        # spectraextrema is shared with the plotters, so modify in place
+        self.spectraextrema[0] = minval
+        self.spectraextrema[1] = maxval
+    
+    def getBandSummary(self, band):
+        """Return the L{BandSummary} of a band if the statistics are
+        available, or None if they haven't been calculated.
+        """
+        if self.statistics is None:
+            return None
+        return self.statistics.getBandSummary(band)
 
     def getPixel(self,line,sample,band):
         """Get an individual pixel at the specified line, sample, & band"""
         return self.cube_io.getPixel(line, sample, band)
+    
+    def getCacheKey(self, axis, index, tile):
+        """Return the key used to store data from this cube in the tile cache
+
+        See L{getCachedRaw} for a description of the arguments.
+        """
+        return (self.cube_io, axis, index, tile)
+
+    def getCachedRaw(self, axis, index, tile, loader, *args):
+        """Return data from the tile cache, loading it if necessary.
+        
+        If the cube reader doesn't use the cache, this is just a call to the
+        loader.
+        
+        @param axis: text string describing the type of data, e.g. 'band'
+        
+        @param index: band or line number
+        
+        @param tile: None for the full plane of data, or a tuple describing
+        the subset of the plane
+        
+        @param loader: function that returns the data if it isn't found in
+        the cache, called using the remaining arguments
+        """
+        if not self.cube_io.use_tile_cache:
+            return loader(*args)
+        key = self.getCacheKey(axis, index, tile)
+        data = self.tile_cache.get(key)
+        if data is None:
+            data = loader(*args)
+            self.tile_cache.put(key, data)
+        return data
 
     def getBand(self, band, use_progress=True):
         """Get a copy of the array of (lines x samples) at the
@@ -1197,7 +1597,7 @@ class Cube(debugmixin):
         return s
 
     def getBandRaw(self, band, use_progress=True):
-        return self.cube_io.getBandRaw(band, use_progress)
+        return self.getCachedRaw('band', band, None, self.cube_io.getBandRaw, band, use_progress)
     
     def getBandTile(self, line1, line2, sample1, sample2, band):
         """Return a rectangular subset of a band.
@@ -1211,7 +1611,7 @@ class Cube(debugmixin):
         @param band: band number
         @returns: numpy array containing the slice of the band
         """
-        return self.cube_io.getBandTile(line1, line2, sample1, sample2, band)
+        return self.getCachedRaw('band', band, (line1, line2, sample1, sample2), self.cube_io.getBandTile, line1, line2, sample1, sample2, band)
 
     def getFocalPlaneInPlace(self, line, use_progress=True):
         """Get the slice of the data array (bands x samples) at the specified
@@ -1223,7 +1623,32 @@ class Cube(debugmixin):
         return s
 
     def getFocalPlaneRaw(self, line, use_progress=True):
-        return self.cube_io.getFocalPlaneRaw(line, use_progress)
+        return self.getCachedRaw('focalplane', line, None, self.cube_io.getFocalPlaneRaw, line, use_progress)
+
+    def getFocalPlanesRaw(self, line1, line2):
+        """Get an array of (lines x bands x samples) for the range of lines
+        from line1 up to but not including line2.
+        
+        Used for bulk processing of the cube, so the tile cache is bypassed.
+        The returned array may be a view into the data.
+        """
+        return self.cube_io.getFocalPlanesRaw(line1, line2)
+
+    def getBandLinesRaw(self, band, line1, line2):
+        """Get an array of (lines x samples) of the specified band for the
+        range of lines from line1 up to but not including line2.
+        
+        Like L{getFocalPlanesRaw}, the tile cache is bypassed.
+        """
+        return self.cube_io.getBandLinesRaw(band, line1, line2)
+
+    def getBandsRaw(self, band1, band2):
+        """Get an array of (bands x lines x samples) for the range of bands
+        from band1 up to but not including band2.
+        
+        Like L{getFocalPlanesRaw}, the tile cache is bypassed.
+        """
+        return self.cube_io.getBandsRaw(band1, band2)
 
     def getFocalPlaneDepthInPlace(self, sample, band):
         """Get the slice of the data array through the cube at the specified
@@ -1233,7 +1658,7 @@ class Cube(debugmixin):
         return s
 
     def getFocalPlaneDepthRaw(self, sample, band):
-        return self.cube_io.getFocalPlaneDepthRaw(sample, band)
+        return self.getCachedRaw('depth', sample, band, self.cube_io.getFocalPlaneDepthRaw, sample, band)
 
     def getSpectra(self,line,sample):
         """Get the spectra at the given pixel.  Calculate the extrema
@@ -1251,7 +1676,34 @@ class Cube(debugmixin):
 
     def getSpectraRaw(self,line,sample):
         """Get the spectra at the given pixel"""
-        return self.cube_io.getSpectraRaw(line, sample)
+        shadow = self.spectral_shadow
+        if shadow is not None and shadow.isReady():
+            return shadow.getSpectraRaw(line, sample)
+        return self.getCachedRaw('spectra', line, sample, self.cube_io.getSpectraRaw, line, sample)
+
+    def getSpectraAtPoints(self, lines, samples):
+        """Get an array of (points x bands) of the spectra at many pixels,
+        with the bad bands zeroed.  Calculate the extrema as we go along.
+        
+        @param lines: sequence of line numbers of the points
+        
+        @param samples: sequence of sample numbers of the points
+        """
+        spectra=self.getSpectraAtPointsRaw(lines, samples).copy()
+        spectra*=self.bbl
+        if len(spectra) > 0:
+            self.updateExtrema(spectra)
+        return spectra
+
+    def getSpectraAtPointsRaw(self, lines, samples):
+        """Get an array of (points x bands) of the spectra at many pixels
+        using the fastest access order of the cube reader"""
+        lines = numpy.asarray(lines, dtype=numpy.int64)
+        samples = numpy.asarray(samples, dtype=numpy.int64)
+        shadow = self.spectral_shadow
+        if shadow is not None and shadow.isReady():
+            return shadow.getSpectraAtPointsRaw(lines, samples)
+        return self.cube_io.getSpectraAtPointsRaw(lines, samples)
 
     def getLineOfSpectra(self,line):
         """Get the all the spectra along the given line.  Calculate
@@ -1385,6 +1837,14 @@ class Cube(debugmixin):
         else:
             return self.bbl
     
+    def getGoodBands(self):
+        """Return an index array of the bands that aren't marked as bad in
+        the bad band list.  All bands are good if there is no bad band list.
+        """
+        if self.bbl:
+            return numpy.nonzero(numpy.asarray(self.bbl[0:self.bands]))[0]
+        return numpy.arange(self.bands)
+    
     def isBadBand(self, index):
         if self.bbl:
             # bbl is stored in the opposite sense: 1 = good, 0 = bad
@@ -1397,51 +1857,184 @@ class Cube(debugmixin):
     def isFasterBand(self):
         return self.interleave in ["bsq"]
     
+    def iterReadAhead(self, getter, ranges):
+        """Iterate over blocks of data, loading the next block in a
+        background thread if the cube is read from a file.
+        
+        @param getter: name of the cube reader method that returns the
+        block, called with the start and end of each range
+        
+        @param ranges: list of (start, end) tuples
+        
+        @return: tuple of (start, block) for each range
+        """
+        if self.cube_io.use_tile_cache and self.url is not None:
+            # The background thread uses its own reader so the file position
+            # isn't shared with other users of the cube
+            reader = self.cube_io.__class__(self, self.url)
+            return ReadAheadIterator(getattr(reader, getter), ranges, cleanup=reader.fh.close)
+        return self.iterBlocks(getattr(self.cube_io, getter), ranges)
+    
+    def iterBlocks(self, loader, ranges):
+        for start, end in ranges:
+            yield start, loader(start, end)
+    
+    def getPlanesPerBlock(self, plane_bytes, total, block_bytes=None):
+        if block_bytes is None:
+            block_bytes = self.readahead_bytes
+        count = max(block_bytes / max(plane_bytes, 1), 1)
+        return min(count, max(total, 1))
+    
+    def getLinesPerBlock(self, line_bytes, block_bytes=None):
+        """Return the number of lines that fit in a memory budget
+        
+        @param line_bytes: number of bytes needed for each line of the block,
+        including any temporary arrays used to process it
+        
+        @param block_bytes: memory budget in bytes, or None to use
+        L{readahead_bytes}
+        
+        @return: number of lines, at least one
+        """
+        return self.getPlanesPerBlock(line_bytes, self.lines, block_bytes)
+    
+    def iterFocalPlaneBlocks(self, count=None, line1=0, line2=None):
+        """Iterate over blocks of focal planes.
+        
+        For cubes that are read from a file, the next block is read in a
+        background thread while the caller processes the current block.  As
+        in L{getFocalPlanesRaw}, the tile cache is bypassed so that a pass
+        through the entire cube doesn't flush out the planes that are
+        currently being displayed.
+        
+        @param count: number of lines in each block, or None to use as many
+        lines as fit in L{readahead_bytes}
+        
+        @param line1: first line
+        
+        @param line2: one past the last line, or None for the end of the cube
+        
+        @return: tuple of (first line of the block, array of (lines x bands
+        x samples)).  The array may be a view into the data, so don't modify
+        it.
+        """
+        if line2 is None:
+            line2 = self.lines
+        if count is None:
+            count = self.getPlanesPerBlock(self.bands * self.samples * self.itemsize, line2 - line1)
+        return self.iterReadAhead('getFocalPlanesRaw', getRanges(line2, count, line1))
+    
+    def iterBandBlocks(self, count=None):
+        """Iterate over blocks of bands.
+        
+        Like L{iterFocalPlaneBlocks}, the next block is read in a background
+        thread for cubes that are read from a file.  BIP and BIL files are
+        read in a single pass for each block, so larger blocks mean fewer
+        passes through the file.
+        
+        @param count: number of bands in each block, or None to use as many
+        bands as fit in L{readahead_bytes}
+        
+        @return: tuple of (first band of the block, array of (bands x lines
+        x samples)).  The array may be a view into the data, so don't modify
+        it.
+        """
+        if count is None:
+            count = self.getPlanesPerBlock(self.lines * self.samples * self.itemsize, self.bands)
+        return self.iterReadAhead('getBandsRaw', getRanges(self.bands, count))
+    
     def iterFocalPlanes(self):
         """Iterate over all focal planes.
         
-        Note that this will be slow when the cube is in BSQ format
+        The focal planes are read in blocks using L{iterFocalPlaneBlocks}.
         """
-        for i in range(self.lines):
-            fp = self.getFocalPlaneRaw(i, use_progress=False)
-            yield fp
+        for line, block in self.iterFocalPlaneBlocks():
+            for fp in block:
+                yield fp
     
     def iterBands(self):
         """Iterate over all bands.
         
-        Note that this will be slow when the cube is in BIL format, and
-        extremely slow when the cube is BIP.
+        The bands are read in blocks using L{iterBandBlocks}.
         """
-        for i in range(self.bands):
-            band = self.getBandRaw(i, use_progress=False)
-            yield band
-    
+        for band, block in self.iterBandBlocks():
+            for plane in block:
+                yield plane
+
+    def getReduction(self, axis, operations, progress=None):
+        """Reduce the cube along an axis in a single pass through the data.
+
+        @param axis: 'lines', 'samples', or 'bands'
+
+        @param operations: list of operations as described in
+        L{CubeReduction}, e.g.  ['mean', 'stddev', 'median', 'p95']
+
+        @param progress: optional callable taking the percent complete
+
+        @return: dict mapping the operation name to a 2d float64 array
+        """
+        return CubeReduction(self, axis).compute(operations, progress)
+
+    def createReducedCube(self, axis, data, name=None):
+        """Create a float32 cube from a result of L{getReduction}.
+
+        The reduced axis has a length of one in the new cube, so reducing
+        the lines gives a cube with a single focal plane and reducing the
+        bands gives a single band cube.
+
+        @param axis: axis that was reduced
+
+        @param data: 2d array returned by L{getReduction}
+
+        @param name: optional band name used when the bands were reduced
+        """
+        if axis == 'lines':
+            cube = createCubeLike(self, interleave='bil', lines=1, datatype=numpy.float32, byteorder=nativeByteOrder)
+            cube.getNumpyArray()[0,:,:] = data
+        elif axis == 'samples':
+            cube = createCubeLike(self, interleave='bip', samples=1, datatype=numpy.float32, byteorder=nativeByteOrder)
+            cube.getNumpyArray()[:,0,:] = data
+        else:
+            cube = createCubeLike(self, interleave='bsq', bands=1, datatype=numpy.float32, byteorder=nativeByteOrder)
+            cube.getNumpyArray()[0,:,:] = data
+            if name:
+                cube.band_names = [name]
+            return cube
+        cube.wavelengths = self.wavelengths[:]
+        cube.wavelength_units = self.wavelength_units
+        cube.fwhm = self.fwhm[:]
+        cube.bbl = self.bbl[:]
+        cube.band_names = self.band_names[:]
+        return cube
+
     def getNumpyArray(self):
         """Get a pointer to the raw numpy array if it's capable"""
         if hasattr(self.cube_io, 'getRaw'):
             return self.cube_io.getRaw()
         raise TypeError("Cube is not using numpy to store its data")
     
+    def iterRawInterleave(self, interleave, endian):
+        """Iterate over the raw bytes of the cube in the given interleave.
+        
+        The data is converted in large blocks using the
+        L{InterleaveTransposer}, so file-backed cubes aren't reread once for
+        every band or focal plane.
+        """
+        transposer = InterleaveTransposer(self, interleave)
+        for piece in transposer.iterSequential():
+            yield self.cube_io.getBytesFromArray(piece, endian)
+    
     def iterRawBIP(self, endian):
         # bands vary fastest, then samples, then lines
-        for i in range(self.lines):
-            band = self.cube_io.getFocalPlaneRaw(i, use_progress=False).transpose()
-            bytes = self.cube_io.getBytesFromArray(band, endian)
-            yield bytes
+        return self.iterRawInterleave('bip', endian)
     
     def iterRawBIL(self, endian):
         # samples vary fastest, then bands, then lines
-        for i in range(self.lines):
-            band = self.cube_io.getFocalPlaneRaw(i, use_progress=False)
-            bytes = self.cube_io.getBytesFromArray(band, endian)
-            yield bytes
+        return self.iterRawInterleave('bil', endian)
     
     def iterRawBSQ(self, endian):
         # samples vary fastest, then lines, then bands 
-        for i in range(self.bands):
-            band = self.cube_io.getBandRaw(i, use_progress=False)
-            bytes = self.cube_io.getBytesFromArray(band, endian)
-            yield bytes
+        return self.iterRawInterleave('bsq', endian)
     
     def iterRaw(self, size, interleaveiter, byte_order=None):
         """Iterator used to return the raw data of the cube in manageable chunks.
@@ -1461,12 +2054,7 @@ class Cube(debugmixin):
         """
         fh = StringIO()
         i = 0
-        if byte_order is None:
-            byte_order = self.byte_order
-        if byte_order == LittleEndian:
-            byte_order = '<'
-        elif byte_order == BigEndian:
-            byte_order = '>'
+        byte_order = self.getEndianText(byte_order)
         for bytes in interleaveiter(byte_order):
             count = len(bytes)
             if (i + count) < size:
@@ -1517,22 +2105,36 @@ class Cube(debugmixin):
             return self.iterRaw(block_size, iter, byte_order)
         return None
     
-    def writeRawData(self, fh, options=None, progress=None, block_size=100000):
+    def getEndianText(self, byte_order=None):
+        """Convert a byte order constant into '<' or '>'"""
+        if byte_order is None:
+            byte_order = self.byte_order
+        if byte_order == LittleEndian:
+            return '<'
+        elif byte_order == BigEndian:
+            return '>'
+        return byte_order
+    
+    def writeRawData(self, fh, options=None, progress=None, max_bytes=None):
+        """Write the data to the file handle, converting the interleave and
+        byte order if requested.
+        
+        @param fh: file handle positioned at the start of the data
+        
+        @param options: dict that may contain 'interleave' and 'byte_order'
+        keys describing the output format
+        
+        @param progress: optional callable taking the percent complete
+        
+        @param max_bytes: optional memory budget passed to the
+        L{InterleaveTransposer}
+        """
         if options is None:
             options = dict()
         interleave = options.get('interleave', self.interleave)
         byte_order = options.get('byte_order', self.byte_order)
-        num_blocks = (self.data_bytes / block_size) + 1
-        iterator = self.getRawIterator(block_size, interleave, byte_order)
-        if iterator:
-            count = 0
-            for block in iterator:
-                fh.write(block)
-                if progress:
-                    progress((count * 100) / num_blocks)
-                count += 1
-        else:
-            raise ValueError("Unknown interleave %s" % interleave)
+        transposer = InterleaveTransposer(self, interleave, max_bytes)
+        transposer.write(fh, self.getEndianText(byte_order), progress)
 
     def registerProgress(self, progress):
         """Register the progress bar that cube functions may use when needed.
@@ -1603,7 +2205,7 @@ def createCube(interleave,lines,samples,bands,datatype=None, byteorder=nativeByt
         if data is not None:
             raw = numpy.frombuffer(data, datatype)
         else:
-            raw = numpy.zeros((samples*lines*bands), dtype=datatype)
+            raw = Cube.memory_budget.allocate(cube, samples*lines*bands, datatype)
     else:
         raw = None
     cube.cube_io = cube_io_cls(cube, array=raw)
@@ -1636,7 +2238,7 @@ def createCubeLike(other, interleave=None, lines=None, samples=None, bands=None,
     if data is not None:
         raw = numpy.frombuffer(data, datatype)
     else:
-        raw = numpy.zeros((cube.samples*cube.lines*cube.bands), dtype=datatype)
+        raw = Cube.memory_budget.allocate(cube, cube.samples*cube.lines*cube.bands, datatype)
     cube.cube_io = cube_io_cls(cube, array=raw)
     cube.verifyAttributes()
     return cube
@@ -11,31 +11,139 @@ from cStringIO import StringIO
 from peppy.hsi.common import *
 from peppy.hsi.subcube import *
 import peppy.hsi.colors as colors
+from peppy.hsi.stats import BandSummary
 
 # hsi mode and the plotting utilities require numpy, the check for which is
 # handled by the major mode wrapper
 import numpy
 
 
+def scaleValues(values, minval, maxval):
+    """Scale the values to 8 bit grayscale where minval maps to 0 and maxval
+    maps to 255"""
+    if minval == maxval:
+        return (values - minval).astype(numpy.uint8)
+    #gray=((raw-minval)*(255.0/(maxval-minval))).astype(numpy.uint8)
+    temp1 = values - minval
+    temp2 = temp1 * (255.0/(maxval-minval))
+    return temp2.astype(numpy.uint8)
+
+def clipValues(values, clip):
+    """Clip the values to the range given by the tuple clip, where either
+    end of the range may be None for no limit"""
+    if clip is None:
+        return values
+    lo, hi = clip
+    if lo is not None and hi is not None:
+        return numpy.clip(values, lo, hi)
+    elif lo is not None:
+        return numpy.where(values < lo, lo, values)
+    elif hi is not None:
+        return numpy.where(values > hi, hi, values)
+    return values
+
+
+class PlaneLookup(debugmixin):
+    """Conversion of a data plane into 8 bit display values, tile by tile.
+    
+    The clip from any range-limiting filters, the linear stretch between the
+    extrema and the colormap are all functions of the data value alone, so
+    for 8 and 16 bit integer data they are combined into a single lookup
+    table indexed by the raw bits of each value.  Other data types are
+    converted one tile at a time, so the temporary arrays are never larger
+    than a tile.
+    """
+    #: Integer data types with at most this many bytes use a lookup table
+    max_lookup_itemsize = 2
+    
+    def __init__(self, raw, extrema=None, clip=None, palette=None):
+        """Create the lookup for the plane
+        
+        @param raw: 2D data plane
+        
+        @param extrema: tuple of (min, max) of the plane after clipping, or
+        None to calculate it from the plane
+        
+        @param clip: tuple of (min, max) to clip the values before scaling,
+        either of which may be None, or None to skip clipping
+        
+        @param palette: (256 x 3) uint8 array mapping gray levels to RGB, or
+        None to produce gray levels only
+        """
+        self.raw = raw
+        self.clip = clip
+        self.palette = palette
+        if extrema is None:
+            extrema = clipValues(numpy.array([raw.min(), raw.max()]), clip)
+        # Without the following casts, raw.min() and raw.max() remain as ctype
+        # variables rather than python ints and will be clamped to the ctype
+        # max value.
+        self.minval = float(extrema[0])
+        self.maxval = float(extrema[1])
+        self.index_dtype = None
+        self.table = None
+        
+        dtype = raw.dtype
+        if dtype.kind in 'iu' and dtype.itemsize <= self.max_lookup_itemsize:
+            self.initTable(dtype)
+    
+    def initTable(self, dtype):
+        """Create the table mapping the raw bits of every possible value to
+        the output"""
+        bits = dtype.itemsize * 8
+        unsigned = numpy.dtype('u%d' % dtype.itemsize)
+        # The table is indexed by the raw bits interpreted as an unsigned
+        # value in the same byte order as the data
+        self.index_dtype = unsigned.newbyteorder(dtype.byteorder)
+        values = numpy.arange(2 ** bits, dtype=numpy.int64).astype(unsigned)
+        values = values.view(dtype.newbyteorder('='))
+        gray = self.getGray(values)
+        if self.palette is not None:
+            self.table = self.palette.take(gray, axis=0)
+        else:
+            self.table = gray
+    
+    def getGray(self, values):
+        return scaleValues(clipValues(values, self.clip), self.minval, self.maxval)
+    
+    def mapTile(self, u1, u2, output):
+        """Convert lines u1 to u2 of the plane into the output array, which
+        is (lines x samples) for gray output or (lines x samples x 3) when
+        using a palette"""
+        tile = self.raw[u1:u2]
+        if self.table is not None:
+            self.table.take(tile.view(self.index_dtype), axis=0, out=output, mode='clip')
+        elif self.palette is not None:
+            self.palette.take(self.getGray(tile), axis=0, out=output, mode='clip')
+        else:
+            output[:,:] = self.getGray(tile)
+
+
 class RGBMapper(debugmixin):
+    #: Number of lines converted at once by L{getRGB}
+    tile_lines = 256
+    
     def scaleChunk(self, raw, minval, maxval, u1, u2, v1, v2, output):
         assert self.dprint("processing chunk [%d:%d, %d:%d], min=%d max=%d" % (u1, u2, v1, v2, minval, maxval))
-        if minval == maxval:
-            output[u1:u2, v1:v2] = (raw[u1:u2, v1:v2] - minval).astype(numpy.uint8)
-        else:
-            #gray=((raw-minval)*(255.0/(maxval-minval))).astype(numpy.uint8)
-            temp1 = raw[u1:u2, v1:v2] - minval
-            temp2 = temp1 * (255.0/(maxval-minval))
-            output[u1:u2, v1:v2] = temp2.astype(numpy.uint8)
+        output[u1:u2, v1:v2] = scaleValues(raw[u1:u2, v1:v2], minval, maxval)
 
-    def getGray(self, raw, tile_size=256):
+    def getGray(self, raw, tile_size=256, extrema=None):
+        """Scale the plane to 8 bit grayscale
+        
+        @param extrema: optional tuple of the (min, max) of the plane if it
+        is already known, so the plane doesn't have to be scanned
+        """
         # Without the following casts, raw.min() and raw.max() remain as ctype
         # variables rather than python ints and will be clamped to the ctype
         # max value.  I was getting the following bad result without the cast:
         # 
         # min=-3624 max=32767 range=-29145 len(raw)=78388745
-        minval = float(raw.min())
-        maxval = float(raw.max())
+        if extrema is not None:
+            minval = float(extrema[0])
+            maxval = float(extrema[1])
+        else:
+            minval = float(raw.min())
+            maxval = float(raw.max())
         valrange = int(maxval-minval)
         assert self.dprint("data: min=%s max=%s range=%s len(raw)=%d" % (str(minval),str(maxval),str(valrange), raw.size))
         gray = numpy.empty(raw.shape, dtype=numpy.uint8)
@@ -52,18 +160,67 @@ class RGBMapper(debugmixin):
 
         return gray
 
-    def getGrayMapping(self,raw):
-        return self.getGray(raw)
+    def getGrayMapping(self, raw, extrema=None):
+        return self.getGray(raw, extrema=extrema)
 
-    def getRGB(self, lines, samples, planes):
-        rgb = numpy.zeros((lines, samples, 3),numpy.uint8)
-        assert self.dprint("shapes: rgb=%s planes=%s" % (rgb.shape, planes[0].shape))
+    def getPlaneExtrema(self, extrema, i):
+        if extrema is not None:
+            return extrema[i]
+        return None
+    
+    def getPalette(self, count):
+        """Return the (256 x 3) uint8 array used to convert gray levels to
+        RGB when displaying count planes, or None for grayscale display"""
+        return None
+    
+    def getOutput(self, lines, samples, output=None):
+        """Return the output array, reusing the array from a previous call if
+        it is the right size"""
+        if output is None or output.shape != (lines, samples, 3):
+            output = numpy.empty((lines, samples, 3), numpy.uint8)
+        return output
+
+    def getRGB(self, lines, samples, planes, extrema=None, clips=None, output=None):
+        """Convert the planes to an RGB image
+        
+        The conversion is performed one tile of L{tile_lines} lines at a time
+        directly into the output array using a L{PlaneLookup} for each plane.
+        
+        @param extrema: optional list containing a tuple of (min, max) for
+        each plane, or None if the extrema of that plane isn't known
+        
+        @param clips: optional list containing a tuple of (min, max) for
+        each plane that the plane's values should be clipped to before
+        scaling, or None if the plane shouldn't be clipped
+        
+        @param output: optional (lines x samples x 3) uint8 array from a
+        previous call that will be reused if it is the correct size
+        """
+        rgb = self.getOutput(lines, samples, output)
+        assert self.dprint("shapes: rgb=%s planes=%s" % (rgb.shape, [p.shape for p in planes]))
         count = len(planes)
-        if count > 0:
-            for i in range(count):
-                rgb[:,:,i] = self.getGrayMapping(planes[i])
-            for i in range(count,3,1):
-                rgb[:,:,i] = rgb[:,:,0]
+        if count == 0:
+            # blank image
+            rgb[:,:,:] = 0
+            return rgb
+        
+        palette = self.getPalette(count)
+        lookups = []
+        for i in range(count):
+            clip = self.getPlaneExtrema(clips, i)
+            lookups.append(PlaneLookup(planes[i], self.getPlaneExtrema(extrema, i), clip, palette))
+        
+        u1 = 0
+        while u1 < lines:
+            u2 = min(u1 + self.tile_lines, lines)
+            if palette is not None:
+                lookups[0].mapTile(u1, u2, rgb[u1:u2])
+            else:
+                for i in range(count):
+                    lookups[i].mapTile(u1, u2, rgb[u1:u2,:,i])
+                for i in range(count,3,1):
+                    rgb[u1:u2,:,i] = rgb[u1:u2,:,0]
+            u1 = u2
         #dprint(rgb[0,:,0])
         
         return rgb
@@ -75,38 +232,62 @@ class PaletteMapper(RGBMapper):
             self.colormap = colors.getColormap(name)
         else:
             self.colormap = None
+        self.palette = None
         
-    def getRGB(self, lines, samples, planes):
+    def getPalette(self, count):
         # This is designed for grayscale images only; if there is more than one
         # plane, the standard RGB method is used
-        count = len(planes)
         if count > 1 or self.colormap is None:
-            return RGBMapper.getRGB(lines, samples, planes)
-        
-        if count > 0:
-            gray = self.getGrayMapping(planes[0])
-            
+            return None
+        if self.palette is None:
             # Matplotlib returns alpha values in the colormap, so we only need
             # the first 3 bands
-            rgba = self.colormap(gray, bytes=True)
-            rgb = numpy.zeros((lines, samples, 3),numpy.uint8)
-            for i in range(3):
-                rgb[:,:,i] = rgba[:,:,i]
-            #rgb = rgba[:,:,0:3]
-        else:
-            # blank image
-            rgb = numpy.zeros((lines, samples, 3),numpy.uint8)
-        assert self.dprint("shape: rgb=%s" % str(rgb.shape))
-        return rgb
+            gray = numpy.arange(256, dtype=numpy.uint8)
+            self.palette = self.colormap(gray, bytes=True)[:,0:3].copy()
+        return self.palette
 
 
 class GeneralFilter(debugmixin):
+    #: Whether the output of the filter has the same values as its input, in
+    #: which case the statistics of the input plane remain valid
+    preserves_values = True
+    
     def __init__(self, pos=0):
         self.pos = pos
         
     def getPlane(self,raw):
         return raw
     
+    def getPlaneWithSummary(self, raw, summary=None):
+        """Filter the plane using precalculated statistics if available.
+        
+        @param summary: L{BandSummary} of the input plane, or None if not
+        known
+        
+        @return: tuple of the filtered plane and the L{BandSummary} of the
+        filtered plane (or None if it isn't known)
+        """
+        plane = self.getPlane(raw)
+        if not self.preserves_values:
+            summary = None
+        return plane, summary
+    
+    def getClipWithSummary(self, raw, summary=None):
+        """Describe the filter as a clip of the values of the plane.
+        
+        Filters that only limit the range of values don't need to create a
+        filtered copy of the plane for display, because the clip can be
+        folded into the L{PlaneLookup} used by the L{RGBMapper}.
+        
+        @return: tuple of (min, max, summary) where min and max are the
+        limits of the clip (either may be None if unbounded) and summary is
+        the L{BandSummary} of the clipped plane (or None if it isn't known);
+        or None if the filter can't be described as a clip
+        """
+        if not self.preserves_values:
+            return None
+        return None, None, summary
+    
     def getXProfile(self, y, raw):
         """Get the x profile at a constant y.
         
@@ -133,10 +314,9 @@ class ContrastFilter(GeneralFilter):
     def setContrast(self,stretch):
         self.contraststretch = stretch
 
-    def getPlane(self, raw):
-        if self.contraststretch <= 0.0:
-            return raw
-        
+    def getStretchRange(self, raw):
+        """Calculate the range of values after removing the stretch
+        percentage of pixels from either end of the histogram"""
         minval=raw.min()
         maxval=raw.max()
         valrange=maxval-minval
@@ -165,9 +345,36 @@ class ContrastFilter(GeneralFilter):
             count-=h[i]
         maxscaled=minval+valrange*i/self.bins
         assert self.dprint("scaled: min=%d max=%d" % (minscaled,maxscaled))
+        return minscaled, maxscaled
+
+    def getPlane(self, raw):
+        if self.contraststretch <= 0.0:
+            return raw
+        
+        minscaled, maxscaled = self.getStretchRange(raw)
         filtered = numpy.clip(raw, minscaled, maxscaled)
         return filtered
 
+    def getPlaneWithSummary(self, raw, summary=None):
+        """Use the histogram from the band statistics when available rather
+        than calculating a new histogram of the plane every time"""
+        if self.contraststretch <= 0.0:
+            return raw, summary
+        
+        minscaled, maxscaled, summary = self.getClipWithSummary(raw, summary)
+        filtered = numpy.clip(raw, minscaled, maxscaled)
+        return filtered, summary
+
+    def getClipWithSummary(self, raw, summary=None):
+        if self.contraststretch <= 0.0:
+            return None, None, summary
+        
+        if summary is not None and summary.hasHistogram():
+            minscaled, maxscaled = summary.getStretchRange(self.contraststretch)
+        else:
+            minscaled, maxscaled = self.getStretchRange(raw)
+        return minscaled, maxscaled, BandSummary(minscaled, maxscaled)
+
 
 class SubtractFilter(GeneralFilter):
     """Apply a subtraction filter to the band.
@@ -175,6 +382,8 @@ class SubtractFilter(GeneralFilter):
     This filter subtracts data from the band.  Usually this is used to subtract
     dark data out of the band so that you can see what's left.
     """
+    preserves_values = False
+
     def __init__(self, band):
         GeneralFilter.__init__(self)
         self.darks = band
@@ -208,21 +417,23 @@ class ClipFilter(GeneralFilter):
 
     A cliping filter restricts the range of the image to specified values.
     """
+    preserves_values = False
+
     def __init__(self, min_clip=0, max_clip=None, pos=0):
         GeneralFilter.__init__(self, pos=pos)
         self.min_clip = min_clip
         self.max_clip = max_clip
    
     def getPlane(self,raw):
-        if self.min_clip is not None and self.max_clip is not None:
-            clipped = raw.clip(self.min_clip, self.max_clip)
-        elif self.min_clip is not None:
-            clipped = numpy.where(raw < self.min_clip, self.min_clip, raw)
-        elif self.max_clip is not None:
-            clipped = numpy.where(raw > self.max_clip, self.max_clip, raw)
-        else:
-            clipped = raw
-        return clipped
+        return clipValues(raw, (self.min_clip, self.max_clip))
+    
+    def getClipWithSummary(self, raw, summary=None):
+        if summary is not None:
+            # clipping is monotonic, so the extrema of the clipped plane are
+            # the clipped extrema of the original
+            minval, maxval = clipValues(numpy.array(summary.getExtrema()), (self.min_clip, self.max_clip))
+            summary = BandSummary(minval, maxval)
+        return self.min_clip, self.max_clip, summary
     
     def getXProfile(self, y, raw):
         return self.getPlane(raw)
@@ -238,6 +449,8 @@ class MedianFilter1D(GeneralFilter):
     which is one of the reasons to use this filter as opposed to a
     smoothing function.
     """
+    preserves_values = False
+
     def __init__(self, kernel_sample=3, kernel_line=1, pos=0):
         GeneralFilter.__init__(self, pos=pos)
 
@@ -258,6 +471,8 @@ class GaussianFilter(GeneralFilter):
     A gaussian filter colvolves the image with a gaussian shape to blur the
     image
     """
+    preserves_values = False
+
     def __init__(self, radius=10, pos=0):
         GeneralFilter.__init__(self, pos=pos)
 
@@ -312,6 +527,14 @@ class ChainFilter(GeneralFilter):
             raw = filter.getPlane(raw)
         return raw
     
+    def getPlaneWithSummary(self, raw, summary=None):
+        for filter in self.filters():
+            raw, summary = filter.getPlaneWithSummary(raw, summary)
+        return raw, summary
+    
+    def getClipWithSummary(self, raw, summary=None):
+        return None
+    
     def getXProfile(self, y, raw):
         for filter in self.filters():
             raw = filter.getXProfile(y, raw)
@@ -50,6 +50,10 @@ from peppy.hsi.common import *
 from peppy.hsi.subcube import *
 from peppy.hsi.filter import *
 from peppy.hsi.view import *
+from peppy.hsi.stats import StatsCache
+from peppy.hsi.overview import OverviewPyramid
+from peppy.hsi.shadow import SpectralShadow
+from peppy.hsi.utils import ThreadedCubeCompare
 from peppy.hsi.hsi_stc import *
 
 
@@ -70,6 +74,15 @@ class HSIMode(BitmapScroller, MajorMode):
         BoolParam('use_cube_min_max', False, help="Use overall cube min/max for profile min/max"),
         BoolParam('immediate_slider_updates', True, help="Refresh the image as the band slider moves rather than after releasing the slider"),
         BoolParam('use_mmap', False, help="Use memory mapping for data access when possible"),
+        IntParam('tile_cache_size', 256, help="Size in megabytes of the cache that holds recently viewed bands for cubes that aren't memory mapped"),
+        IntParam('derived_cube_memory', 1024, help="Size in megabytes of the memory used by cubes created during the session (e.g. band math or classification results), after which new cubes are created in temporary files"),
+        StrParam('derived_cube_temp_dir', '', help="Directory for the temporary files of cubes that don't fit in memory, or blank to use the system's temporary directory"),
+        BoolParam('use_overviews', True, help="Display reduced resolution overviews of the bands when zoomed out"),
+        IntParam('overview_cache_size', 512, help="Size in megabytes of the disk space used to save the overviews in the user's configuration directory.  The least recently used overviews are removed to make room for new ones"),
+        BoolParam('save_statistics', True, help="Save the band statistics calculated for each cube so they don't have to be recalculated when the cube is reopened"),
+        IntParam('worker_processes', 1, help="Number of worker processes used by calculations that can be split across processes, i.e. cube comparisons and k-means classification.  1 performs the calculations within peppy itself; 0 uses one process per CPU"),
+        BoolParam('use_spectral_copy', False, help="Build a spectrum ordered copy of BSQ cubes in the user's configuration directory so spectra can be plotted quickly.  Each copy uses as much disk space as the cube itself"),
+        IntParam('spectral_copy_cache_size', 2048, help="Size in megabytes of the disk space used by the spectrum ordered copies of BSQ cubes.  The least recently used copies are removed to make room for new ones"),
         )
 
     def __init__(self, parent, wrapper, buffer, frame):
@@ -113,6 +126,8 @@ class HSIMode(BitmapScroller, MajorMode):
         self.setStatusText(self.cubeview.getBandName(band), 2)
     
     def updateBox(self, ul, lr):
+        ul = self.cubeview.getFullResolutionBox(ul)
+        lr = self.cubeview.getFullResolutionBox(lr)
         self.setStatusText(u"(%d, %d) \u2192 (%d, %d): w=%d h=%d" % (ul[0], ul[1], lr[0], lr[1], lr[0] - ul[0] + 1, lr[1] - ul[1] + 1), 0)
 
     def OnUpdateUI(self, evt):
@@ -134,6 +149,44 @@ class HSIMode(BitmapScroller, MajorMode):
             Cube.mmap_size_limit = -1
         else:
             Cube.mmap_size_limit = 1
+        
+        Cube.tile_cache.setMaxBytes(self.classprefs.tile_cache_size * 1024 * 1024)
+        
+        # Limit on cubes created in memory
+        Cube.memory_budget.temp_dir = self.classprefs.derived_cube_temp_dir or None
+        Cube.memory_budget.setMaxBytes(self.classprefs.derived_cube_memory * 1024 * 1024)
+        
+        # Band statistics are stored in the user's configuration directory
+        if self.classprefs.save_statistics:
+            StatsCache.cache_dir = wx.GetApp().config.fullpath("hsi_statistics")
+        else:
+            StatsCache.cache_dir = None
+
+        # Overviews are stored there too, rather than next to the data file,
+        # also limited in size
+        if self.classprefs.use_overviews:
+            OverviewPyramid.cache_dir = wx.GetApp().config.fullpath("hsi_overviews")
+        else:
+            OverviewPyramid.cache_dir = None
+        OverviewPyramid.max_bytes = self.classprefs.overview_cache_size * 1024 * 1024
+
+        # Spectrum ordered copies are also stored in the configuration
+        # directory, limited in size
+        if self.classprefs.use_spectral_copy:
+            SpectralShadow.cache_dir = wx.GetApp().config.fullpath("hsi_spectra")
+        else:
+            SpectralShadow.cache_dir = None
+        SpectralShadow.max_bytes = self.classprefs.spectral_copy_cache_size * 1024 * 1024
+
+        # Cube comparisons can be started outside of an action, so the
+        # number of processes is set as the default of the comparison thread
+        ThreadedCubeCompare.processes = self.classprefs.worker_processes
+
+    def deleteWindowPreHook(self):
+        if self.cubeview is not None:
+            self.cubeview.stopPrefetcher()
+        if self.cube is not None and self.cube.spectral_shadow is not None:
+            self.cube.spectral_shadow.stop()
 
     def update(self, refresh=True):
         self.dprint("refresh=%s" % refresh)
@@ -181,12 +234,59 @@ class HSIMode(BitmapScroller, MajorMode):
         assert self.dprint(self.cube)
     
     def setViewer(self, viewcls):
+        zoom = self.getViewZoom()
+        if self.cubeview is not None:
+            self.cubeview.stopPrefetcher()
         self.cubeview = viewcls(self, self.cube, self.classprefs.display_rgb)
         self.cubeview.swapEndian(self.swap_endian)
+        self.setViewZoom(zoom)
         for minor in self.wrapper.getActiveMinorModes():
             if hasattr(minor, 'setCubeView'):
                 minor.setCubeView(self.cubeview)
 
+    def getViewZoom(self):
+        """Return the zoom factor relative to the full resolution cube.
+        
+        When an overview is displayed, the bitmap scroller's zoom factor is
+        relative to the overview rather than the cube.
+        """
+        if self.cubeview is None:
+            return self.zoom
+        return self.zoom / self.cubeview.overview_level
+    
+    def setViewZoom(self, zoom):
+        """Set the zoom factor relative to the full resolution cube,
+        switching to the appropriate overview level.
+        
+        @return: True if the overview level changed, meaning the bitmap must
+        be regenerated
+        """
+        zoom = max(min(zoom, self.max_zoom), self.min_zoom)
+        level = self.cubeview.getOverviewLevelForZoom(zoom)
+        changed = self.cubeview.setOverviewLevel(level)
+        self.zoom = zoom * self.cubeview.overview_level
+        return changed
+    
+    def zoomIn(self, zoom=2):
+        self.changeViewZoom(self.getViewZoom() * zoom)
+    
+    def zoomOut(self, zoom=2):
+        self.changeViewZoom(self.getViewZoom() / zoom)
+    
+    def changeViewZoom(self, zoom):
+        if self.setViewZoom(zoom):
+            self.update()
+            for minor in self.wrapper.getActiveMinorModes():
+                if hasattr(minor, 'setCubeView'):
+                    minor.setCubeView(self.cubeview)
+        else:
+            self._scaleImage()
+    
+    def getSelectedBox(self):
+        """Return the (x, y, w, h) of the current selection in full
+        resolution cube coordinates"""
+        return self.cubeview.getFullResolutionBox(self.selector.getSelectedBox())
+
     def getPopupActions(self, evt, x, y):
         import peppy.hsi.hsi_menu
         import peppy.hsi.filter_menu
@@ -207,22 +307,27 @@ class HSIMode(BitmapScroller, MajorMode):
         self.dprint("loading cube data from %s, options=%s" % (str(self.buffer.url), options))
         self.cube = self.dataset.getCube(self.buffer.url, progress=self.status_info, options=options)
         if self.cube.lines > 10000 or self.cube.samples > 10000:
-            self.zoom = 0.125
+            zoom = 0.125
         else:
-            self.zoom = 1.0
+            zoom = 1.0
         assert self.dprint(self.cube)
         viewer = CubeView
         if 'view' in options:
             if options['view'] == 'focalplane':
                 viewer = FocalPlaneView
         self.setViewer(viewer)
+        self.setViewZoom(zoom)
         self.dprint("loading bands...")
         self.cubeview.loadBands()
         self.dprint("loaded bands")
         self.update()
     
     def revertPostHook(self):
-        self.zoom = 1.0
+        if self.cubeview is not None:
+            # reset the overview level along with the zoom
+            self.setViewZoom(1.0)
+        else:
+            self.zoom = 1.0
         self.crop = None
         self.showInitialPosition(self.buffer.url)
         self.status_info.setText(self.getWelcomeMessage())
@@ -180,6 +180,10 @@ class BandSlider(HSIActionMixin, SliderAction):
         if self.mode.immediate_slider_updates:
             if self.mode.cubeview.gotoIndex(index, user=False):
                 self.mode.update()
+        else:
+            # start reading the band in the background so it's ready when the
+            # slider is released
+            self.mode.cubeview.prefetchHint(index)
     
     def action(self, index=-1, multiplier=1):
         #dprint("index=%d" % index)
@@ -256,7 +260,7 @@ class SpatialSubset(HSIActionMixin, SelectAction):
     
     def isEnabled(self):
         if self.mode.cubeview.__class__ == CubeView and self.mode.selector.__class__ == RubberBand:
-            x, y, w, h = self.mode.selector.getSelectedBox()
+            x, y, w, h = self.mode.getSelectedBox()
             return w > 1 and h > 1
         return False
     
@@ -270,7 +274,7 @@ class SpatialSubset(HSIActionMixin, SelectAction):
         name = self.getTempName()
         fh = vfs.make_file(name)
         subcube = SubCube(cube)
-        sample, line, ds, dl = self.mode.selector.getSelectedBox()
+        sample, line, ds, dl = self.mode.getSelectedBox()
         subcube.subset(line, line+dl, sample, sample+ds, 0, cube.bands)
         fh.setCube(subcube)
         # must close file handle or it won't be registered with the DatasetFS
@@ -279,59 +283,106 @@ class SpatialSubset(HSIActionMixin, SelectAction):
         self.frame.open(name)
 
 
-class FocalPlaneAverage(HSIActionMixin, SelectAction):
-    """Average all focal planes down to a single focal plane.
-    
+class CubeReductionMixin(HSIActionMixin):
+    """Reduce one axis of the cube to a single value using a
+    L{CubeReduction} operation and display the result as a new cube.
     """
-    name = "Average Focal Planes"
-    default_menu = ("Tools", -100)
-    
     testcube = 1
-    
-    def getTempName(self):
-        name = "focal_plane_average%d" % self.__class__.testcube
-        self.__class__.testcube += 1
+
+    def getTempName(self, operation, axis):
+        name = "%s_of_%s%d" % (operation, axis, CubeReductionMixin.testcube)
+        CubeReductionMixin.testcube += 1
         return self.getDatasetPath(name)
-    
-    def action(self, index=-1, multiplier=1):
+
+    def reduceCube(self, operation, axis):
         cube = self.mode.cube
-        name = self.getTempName()
+        self.mode.status_info.startProgress("Calculating %s of %s..." % (operation, axis), 100, delay=1.0)
+        results = cube.getReduction(axis, [operation], self.mode.status_info.updateProgress)
+        self.mode.status_info.stopProgress("Calculated %s of %s" % (operation, axis))
+        reduced = cube.createReducedCube(axis, results[operation], operation)
+        name = self.getTempName(operation, axis)
         fh = vfs.make_file(name)
-        avg = createCubeLike(cube, lines=1, interleave='bip')
-        data = avg.getNumpyArray()
-        #dprint("%d,%d,%d: %s" %(avg.lines, avg.samples, avg.bands, data.shape))
-        if cube.isFasterFocalPlane():
-            self.mode.status_info.startProgress("Averaging...", cube.lines, delay=1.0)
-            temp = numpy.zeros((avg.bands, avg.samples), dtype=numpy.float32)
-            line = 0
-            for plane in cube.iterFocalPlanes():
-                temp += plane
-                line += 1
-                self.mode.status_info.updateProgress(line)
-            temp /= cube.lines
-            data[0,:,:] = temp.T
-            self.mode.status_info.stopProgress("Averaged %s" % cube.url)
-        else:
-            self.mode.status_info.startProgress("Averaging...", cube.bands, delay=1.0)
-            band = 0
-            for plane in cube.iterBands():
-                a = numpy.average(plane, axis=0)
-                #dprint("band=%d: plane=%s a=%s" % (band, str(plane.shape), str(a.shape)))
-                data[0,:,band] = a
-                band += 1
-                self.mode.status_info.updateProgress(band)
-            self.mode.status_info.stopProgress("Averaged %s" % cube.url)
-            
-        fh.setCube(avg)
+        fh.setCube(reduced)
         # must close file handle or it won't be registered with the DatasetFS
         # file system
         fh.close()
-        options = {
-            'view': 'focalplane',
-            }
+        if axis == 'lines':
+            options = {
+                'view': 'focalplane',
+                }
+        else:
+            options = None
         self.frame.open(name, options=options)
 
 
+class FocalPlaneAverage(CubeReductionMixin, SelectAction):
+    """Average all focal planes down to a single focal plane.
+    
+    """
+    name = "Average Focal Planes"
+    default_menu = ("Tools", -100)
+    
+    operation = 'mean'
+    
+    def action(self, index=-1, multiplier=1):
+        self.reduceCube(self.operation, 'lines')
+
+
+class FocalPlaneMedian(FocalPlaneAverage):
+    """Reduce all focal planes to a single focal plane holding the
+    approximate median of each sample and band.
+    """
+    name = "Median of Focal Planes"
+    default_menu = ("Tools", 101)
+    
+    operation = 'median'
+
+
+class FocalPlaneStdDev(FocalPlaneAverage):
+    """Reduce all focal planes to a single focal plane holding the standard
+    deviation of each sample and band.
+    """
+    name = "Standard Deviation of Focal Planes"
+    default_menu = ("Tools", 102)
+    
+    operation = 'stddev'
+
+
+class ReduceCube(CubeReductionMixin, SelectAction):
+    """Reduce the lines, samples, or bands of the cube to a single value
+    
+    The reduction is chosen from a list like "median of lines" or "stddev of
+    bands".  Percentiles can also be typed in directly, e.g. "p95 of lines".
+    """
+    name = "Reduce Cube..."
+    default_menu = ("Tools", 103)
+    
+    def getChoices(self):
+        choices = []
+        for axis in CubeReduction.axes:
+            for operation in CubeReduction.operations:
+                choices.append("%s of %s" % (operation, axis))
+        return choices
+    
+    def action(self, index=-1, multiplier=1):
+        minibuffer = StaticListCompletionMinibuffer(self.mode, self,
+                                                    label="Reduction:",
+                                                    list=self.getChoices(),
+                                                    initial="")
+        self.mode.setMinibuffer(minibuffer)
+    
+    def processMinibuffer(self, minibuffer, mode, text):
+        try:
+            operation, axis = text.split(" of ")
+            operation = operation.strip()
+            axis = axis.strip()
+            CubeReduction(self.mode.cube, axis).getPercentile(operation)
+        except ValueError:
+            self.mode.setStatusText("Unknown reduction %s" % text)
+            return
+        self.reduceCube(operation, axis)
+
+
 class ScaledImageMixin(HSIActionMixin):
     minibuffer = IntMinibuffer
     minibuffer_label = "Scale Dimensions by Integer Factor:"
@@ -428,6 +479,232 @@ class ReduceImageDimensions(ScaledImageMixin, MinibufferAction):
         self.frame.open(name)
 
 
+class SpectralLibraryMatchMixin(HSIActionMixin):
+    """Match every pixel of the cube against a spectral library.
+
+    Prompts for the spectral library and creates a classification cube
+    holding the index of the best matching library spectrum of each pixel
+    and a score cube holding the quality of that match.
+    """
+    method = None
+    score_name = None
+
+    testcube = 1
+
+    def getTempName(self, label):
+        name = "%s%d" % (label, SpectralLibraryMatchMixin.testcube)
+        return self.getDatasetPath(name)
+
+    def action(self, index=-1, multiplier=1):
+        cwd = self.frame.cwd()
+        if not cwd.endswith(os.sep):
+            cwd += os.sep
+        minibuffer = LocalFileMinibuffer(self.mode, self, label="Spectral library:",
+                                    initial = cwd)
+        self.mode.setMinibuffer(minibuffer)
+
+    def processMinibuffer(self, minibuffer, mode, text):
+        from peppy.hsi.matching import SpectralLibraryMatcher
+
+        cube = self.mode.cube
+        try:
+            header = HyperspectralFileFormat.load(text)
+            library = header.getCube()
+            scale = SpectralLibraryMatcher.getScale(library, cube)
+            matcher = SpectralLibraryMatcher(library, cube, scale)
+        except Exception, e:
+            self.mode.setStatusText("Can't match against %s: %s" % (text, e))
+            return
+
+        self.mode.status_info.startProgress("Matching %s..." % text, 100, delay=1.0)
+        classes, scores = matcher.match(self.method, self.mode.status_info.updateProgress)
+        self.mode.status_info.stopProgress("Matched %s" % cube.url)
+
+        names = []
+        for label, result in [("library_match", classes), (self.score_name, scores)]:
+            name = self.getTempName(label)
+            fh = vfs.make_file(name)
+            fh.setCube(result)
+            # must close file handle or it won't be registered with the
+            # DatasetFS file system
+            fh.close()
+            names.append(name)
+        SpectralLibraryMatchMixin.testcube += 1
+        for name in names:
+            self.frame.open(name)
+
+
+class SpectralLibraryMatchSAM(SpectralLibraryMatchMixin, SelectAction):
+    """Classify the cube by the smallest spectral angle to the spectra in a
+    spectral library
+    """
+    name = "Match Spectral Library by Spectral Angle..."
+    default_menu = ("Tools", 400)
+    method = 'sam'
+    score_name = "library_angle"
+
+
+class SpectralLibraryMatchEuclidean(SpectralLibraryMatchMixin, SelectAction):
+    """Classify the cube by the smallest euclidean distance to the spectra in
+    a spectral library
+    """
+    name = "Match Spectral Library by Euclidean Distance..."
+    default_menu = ("Tools", 401)
+    method = 'euclidean'
+    score_name = "library_distance"
+
+
+class BandMathAction(HSIActionMixin, MinibufferAction):
+    """Calculate a new band from an arithmetic expression of the bands
+    
+    Bands are referenced as b[N] using the same band numbers as shown in the
+    band list, e.g. (b[54]-b[32])/(b[54]+b[32]) for a normalized difference.
+    """
+    name = "Band Math..."
+    default_menu = ("Tools", 500)
+    
+    key_bindings = None
+    minibuffer = TextMinibuffer
+    minibuffer_label = "Band math expression:"
+    
+    testcube = 1
+    
+    def getTempName(self):
+        name = "bandmath%d" % BandMathAction.testcube
+        BandMathAction.testcube += 1
+        return self.getDatasetPath(name)
+    
+    def processMinibuffer(self, minibuffer, mode, text):
+        from peppy.hsi.bandmath import BandMath
+        
+        cube = self.mode.cube
+        try:
+            expression = BandMath(text, self.mode.classprefs.band_number_offset)
+            expression.checkBands(cube)
+        except ValueError, e:
+            self.mode.setStatusText(str(e))
+            return
+        self.mode.status_info.startProgress("Calculating %s..." % text, 100, delay=1.0)
+        result = expression.apply(cube, self.mode.status_info.updateProgress)
+        self.mode.status_info.stopProgress("Calculated %s" % text)
+        name = self.getTempName()
+        fh = vfs.make_file(name)
+        fh.setCube(result)
+        # must close file handle or it won't be registered with the DatasetFS
+        # file system
+        fh.close()
+        self.frame.open(name)
+
+
+class PrincipalComponentsMixin(HSIActionMixin):
+    """Transform the cube into its leading components.
+    
+    The transform is calculated in one pass through the cube and the
+    components are written in a second pass, so the cube doesn't have to fit
+    in memory.  Bad bands are not used.
+    """
+    key_bindings = None
+    minibuffer = IntMinibuffer
+    minibuffer_label = "Number of components (0 for all):"
+    
+    testcube = 1
+    
+    def getTempName(self):
+        name = "%s%d" % (self.label, PrincipalComponentsMixin.testcube)
+        PrincipalComponentsMixin.testcube += 1
+        return self.getDatasetPath(name)
+    
+    def getTransform(self, cube):
+        raise NotImplementedError
+    
+    def processMinibuffer(self, minibuffer, mode, count):
+        cube = self.mode.cube
+        try:
+            transform = self.getTransform(cube)
+            self.mode.status_info.startProgress("Calculating covariance...", 100, delay=1.0)
+            transform.calculate(self.mode.status_info.updateProgress)
+        except ValueError, e:
+            self.mode.status_info.stopProgress(str(e))
+            return
+        self.mode.status_info.startProgress("Calculating components...", 100, delay=1.0)
+        result = transform.transform(count, self.mode.status_info.updateProgress)
+        self.mode.status_info.stopProgress("Calculated %d components" % result.bands)
+        name = self.getTempName()
+        fh = vfs.make_file(name)
+        fh.setCube(result)
+        # must close file handle or it won't be registered with the DatasetFS
+        # file system
+        fh.close()
+        self.frame.open(name)
+
+
+class PrincipalComponentsAction(PrincipalComponentsMixin, MinibufferAction):
+    """Principal component transform of the cube"""
+    name = "Principal Components..."
+    default_menu = ("Tools", -600)
+    
+    label = "pca"
+    
+    def getTransform(self, cube):
+        from peppy.hsi.pca import PrincipalComponents
+        return PrincipalComponents(cube)
+
+
+class MinimumNoiseFractionAction(PrincipalComponentsMixin, MinibufferAction):
+    """Minimum noise fraction transform of the cube"""
+    name = "Minimum Noise Fraction..."
+    default_menu = ("Tools", 601)
+    
+    label = "mnf"
+    
+    def getTransform(self, cube):
+        from peppy.hsi.pca import MinimumNoiseFraction
+        return MinimumNoiseFraction(cube)
+
+
+class KMeansClassification(HSIActionMixin, MinibufferAction):
+    """Unsupervised classification of the cube using mini-batch k-means
+    
+    The cluster centers are found from spectra sampled from a few tiles of
+    the cube, so only the final labeling of the pixels reads the whole cube.
+    """
+    name = "K-Means Classification..."
+    default_menu = ("Tools", -700)
+    
+    key_bindings = None
+    minibuffer = IntMinibuffer
+    minibuffer_label = "Number of classes:"
+    
+    testcube = 1
+    
+    def getTempName(self):
+        name = "kmeans%d" % KMeansClassification.testcube
+        KMeansClassification.testcube += 1
+        return self.getDatasetPath(name)
+    
+    def processMinibuffer(self, minibuffer, mode, classes):
+        from peppy.hsi.classify import MiniBatchKMeans
+        
+        cube = self.mode.cube
+        try:
+            kmeans = MiniBatchKMeans(cube, classes)
+            self.mode.status_info.startProgress("Finding %d clusters..." % classes, 100, delay=1.0)
+            kmeans.train(self.mode.status_info.updateProgress)
+        except ValueError, e:
+            self.mode.status_info.stopProgress(str(e))
+            return
+        self.mode.status_info.startProgress("Classifying...", 100, delay=1.0)
+        result = kmeans.classify(self.mode.status_info.updateProgress, self.mode.classprefs.worker_processes)
+        self.mode.status_info.stopProgress("Classified %s into %d classes" % (cube.url, classes))
+        name = self.getTempName()
+        fh = vfs.make_file(name)
+        fh.setCube(result)
+        # must close file handle or it won't be registered with the DatasetFS
+        # file system
+        fh.close()
+        self.frame.open(name)
+
+
 class ExportAsImage(SelectAction):
     """Export the current datacube in image format like PNG, JPEG, etc.
     """
@@ -502,3 +779,35 @@ class ExportAsENVILittleEndian(ENVIExportMixin, SelectAction):
     name = "as ENVI (little endian)"
     default_menu = ("File/Export", 102)
     endian = LittleEndian
+
+class ExportAsChunked(SelectAction):
+    """Export the current datacube as a chunked, compressed cube file
+    
+    Each tile of the cube is compressed separately, which greatly reduces
+    the size of sparse datasets like classification results and masks while
+    still allowing any part of the cube to be read quickly.
+    """
+    name = "as Compressed Cube"
+    default_menu = ("File/Export", 110)
+
+    def action(self, index=-1, multiplier=1):
+        filename = self.frame.showSaveAs("Save Image as Compressed Cube",
+                                         wildcard="Compressed Cube (*.pcc)|*.pcc")
+        if filename:
+            handler = HyperspectralFileFormat.getHandlerByName("Chunked")
+            if handler:
+                try:
+                    self.mode.showBusy(True)
+                    self.mode.status_info.startProgress("Exporting to %s" % filename)
+                    wx.GetApp().cooperativeYield()
+                    handler.export(filename, self.mode.cube, progress=self.updateProgress)
+                    self.mode.status_info.stopProgress("Saved %s" % filename)
+                    wx.GetApp().cooperativeYield()
+                finally:
+                    self.mode.showBusy(False)
+            else:
+                self.mode.setStatusText("Can't find compressed cube handler")
+
+    def updateProgress(self, value):
+        self.mode.status_info.updateProgress(value)
+        wx.GetApp().cooperativeYield()
@@ -90,12 +90,22 @@ class HSIPlugin(IPeppyPlugin):
                         peppy.hsi.hsi_menu.TestSubset,
                         peppy.hsi.hsi_menu.SpatialSubset,
                         peppy.hsi.hsi_menu.FocalPlaneAverage,
+                        peppy.hsi.hsi_menu.FocalPlaneMedian,
+                        peppy.hsi.hsi_menu.FocalPlaneStdDev,
+                        peppy.hsi.hsi_menu.ReduceCube,
                         peppy.hsi.hsi_menu.ScaleImageDimensions,
                         peppy.hsi.hsi_menu.ReduceImageDimensions,
+                        peppy.hsi.hsi_menu.SpectralLibraryMatchSAM,
+                        peppy.hsi.hsi_menu.SpectralLibraryMatchEuclidean,
+                        peppy.hsi.hsi_menu.BandMathAction,
+                        peppy.hsi.hsi_menu.PrincipalComponentsAction,
+                        peppy.hsi.hsi_menu.MinimumNoiseFractionAction,
+                        peppy.hsi.hsi_menu.KMeansClassification,
                         
                         peppy.hsi.hsi_menu.ExportAsENVI,
                         peppy.hsi.hsi_menu.ExportAsENVIBigEndian,
                         peppy.hsi.hsi_menu.ExportAsENVILittleEndian,
+                        peppy.hsi.hsi_menu.ExportAsChunked,
                         peppy.hsi.hsi_menu.ExportAsImage,
                         ]
             except Exception, e:
@@ -14,6 +14,62 @@ import peppy.hsi.datasetfs
 from peppy.debug import *
 
 
+class FileKeyCache(debugmixin):
+    """Least-recently-used dict of values associated with the current
+    contents of a file.
+
+    The values are keyed on the url, size and modification time of the file,
+    so a value is no longer returned once the file has changed.  Files whose
+    size or modification time can't be determined aren't cached.
+    """
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self.clear()
+
+    def clear(self):
+        # key -> [last access stamp, value]
+        self.entries = {}
+        self.stamp = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    @classmethod
+    def getKey(cls, url):
+        """Return the key identifying the current contents of the url, or
+        None if the url can't be identified"""
+        try:
+            size = vfs.get_size(url)
+            mtime = vfs.get_mtime(url)
+        except Exception, e:
+            cls.dprint("can't identify %s: %s" % (url, e))
+            return None
+        return (str(url), str(size), str(mtime))
+
+    def get(self, key):
+        """Return the value stored for the key, or None if not in the cache"""
+        entry = self.entries.get(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.stamp += 1
+        entry[0] = self.stamp
+        return entry[1]
+
+    def put(self, key, value):
+        self.stamp += 1
+        self.entries[key] = [self.stamp, value]
+        if len(self.entries) > self.max_entries:
+            # remove the least recently used quarter of the entries at once
+            # so the search for them isn't repeated on every put
+            order = sorted([(entry[0], k) for k, entry in self.entries.iteritems()])
+            for stamp, k in order[0:len(order) - (self.max_entries * 3) / 4]:
+                del self.entries[k]
+
+
 class HyperspectralFileFormat(debugmixin):
     loaded = False
 
@@ -22,6 +78,15 @@ class HyperspectralFileFormat(debugmixin):
 
     plugin_manager = None
 
+    #: Number of bytes at the start of the file that are read once and
+    #: passed to the identifyHeader method of every handler
+    header_bytes = 2880
+
+    #: Handlers that matched each file, along with the information that each
+    #: handler found while identifying the file and the keys of the other
+    #: files that the identification depends on.  See L{probe}.
+    identify_cache = FileKeyCache()
+
     @classmethod
     def addDefaultHandler(cls, handler):
         cls.dprint("adding handler %s" % handler)
@@ -52,6 +117,7 @@ class HyperspectralFileFormat(debugmixin):
             return
         import ENVI
         import FITS
+        import chunked
         import subcube
         
         cls.handlers = [h for h in cls.default_handlers]
@@ -59,17 +125,61 @@ class HyperspectralFileFormat(debugmixin):
         HyperspectralFileFormat.loaded = True
 
     @classmethod
-    def identifyall(cls, url):
+    def readHeader(cls, url):
+        """Read the start of the file that is shared among the handlers"""
+        fh = vfs.open(url)
+        try:
+            return fh.read(cls.header_bytes)
+        finally:
+            fh.close()
+
+    @classmethod
+    def probe(cls, url):
+        """Find the handlers that can load the url.
+
+        The start of the file is read once and passed to the identifyHeader
+        method of each handler.  Successful results are cached on the url,
+        size and modification time of the file, so reopening a file doesn't
+        read it again.  Handlers whose identification depends on other files
+        (like ENVI header files) list them in getIdentifyDependencies, and
+        the cached result is only used while those files are unchanged.
+        Files that no handler recognizes aren't cached, because a file they
+        depend on may be created later.
+
+        @return: list of tuples of (handler, info), where info is the value
+        returned by the handler's identifyHeader method, in order of
+        preference
+        """
         cls.discover()
+        url = vfs.normalize(url)
+        
+        key = cls.identify_cache.getKey(url)
+        if key is not None:
+            entry = cls.identify_cache.get(key)
+            if entry is not None:
+                order, dependencies = entry
+                for depurl, depkey in dependencies:
+                    if cls.identify_cache.getKey(depurl) != depkey:
+                        cls.dprint("%s has changed; identifying %s again" % (depurl, url))
+                        break
+                else:
+                    cls.dprint("found %s in identification cache" % url)
+                    return order
         
         cls.dprint("handlers: %s" % cls.handlers)
         matches = []
         if vfs.is_file(url):
+            header = cls.readHeader(url)
             for format in cls.handlers:
                 cls.dprint("checking %s for %s format" % (url, format.format_name))
-                if format.identify(url):
+                try:
+                    info = format.identifyHeader(url, header)
+                except Exception, e:
+                    cls.dprint("%s failed identifying %s: %s" % (format.format_name, url, e))
+                    info = None
+                if info:
                     cls.dprint("Possible match for %s format" % format.format_name)
-                    matches.append(format)
+                    matches.append((format, info))
         order = []
         for match in matches:
             # It is possible that the file can be loaded as more than
@@ -78,25 +188,49 @@ class HyperspectralFileFormat(debugmixin):
             # efficient than GDAL.  So, loop through the matches and
             # see if there is a specific class that should be used
             # instead of a generic one.
-            cls.dprint("Checking %s for specific support of %s" % (match, url))
+            cls.dprint("Checking %s for specific support of %s" % (match[0], url))
             name, ext = os.path.splitext(url.path.get_name())
             ext.lower()
-            if ext in match.extensions:
+            if ext in match[0].extensions:
                 cls.dprint("Found specific support for %s in %s" % (ext, match))
                 order.append(match)
                 matches.remove(match)
         if len(matches)>0:
             order.extend(matches)
+        if key is not None and order:
+            dependencies = []
+            for format, info in order:
+                for depurl in format.getIdentifyDependencies(url, info):
+                    dependencies.append((depurl, cls.identify_cache.getKey(depurl)))
+            cls.identify_cache.put(key, (order, dependencies))
         return order
 
     @classmethod
-    def identify(cls, url):
+    def identifyall(cls, url):
+        return [format for format, info in cls.probe(url)]
+
+    @classmethod
+    def getVFSDataset(cls, url):
+        """Return the dataset provided directly by the virtual filesystem, or
+        None if the url is an ordinary file.
+        
+        Local files are never provided by a dataset, so they aren't opened.
+        """
+        if url.scheme == 'file':
+            return None
         fh = vfs.open(url)
         assert cls.dprint("checking for cube handler: %s" % dir(fh))
         if fh and hasattr(fh, 'metadata') and hasattr(fh.metadata, 'getCube'):
             return fh.metadata
-            
+        return None
+
+    @classmethod
+    def identify(cls, url):
         url = vfs.normalize(url)
+        dataset = cls.getVFSDataset(url)
+        if dataset is not None:
+            return dataset
+            
         matches = cls.identifyall(url)
         if len(matches)>0:
             return matches[0]
@@ -124,23 +258,22 @@ class HyperspectralFileFormat(debugmixin):
             cls.dprint("EXCLUDING %s" % bad)
         
         # Check to see if there's a specific handler provided in the vfs
-        fh = vfs.open(url)
-        cls.dprint("checking for cube handler: %s" % dir(fh))
-        if fh and hasattr(fh, 'metadata') and hasattr(fh.metadata, 'getCube'):
-            dataset = fh.metadata
-            # Only return the dataset if it's not the same class we're trying
-            # to avoid
-            if dataset.__class__ != bad:
-                return dataset
+        dataset = cls.getVFSDataset(url)
+        # Only return the dataset if it's not the same class we're trying
+        # to avoid
+        if dataset is not None and dataset.__class__ != bad:
+            return dataset
         
-        # OK, that didn't return a result, so see if there's a HSI handler 
-        matches = cls.identifyall(url)
-        for format in matches:
+        # OK, that didn't return a result, so see if there's a HSI handler.
+        # The information found while identifying the file is passed to the
+        # handler so it doesn't have to find it again.
+        matches = cls.probe(url)
+        for format, info in matches:
             if format == bad:
                 cls.dprint("Skipping format %s" % format.format_name)
                 continue
             cls.dprint("Loading %s format cube" % format.format_name)
-            dataset = format(url, progress=progress)
+            dataset = format(url, progress=progress, identity=info)
             return dataset
         return None
 
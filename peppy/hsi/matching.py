@@ -0,0 +1,250 @@
+# peppy Copyright (c) 2006-2010 Rob McMullen
+# Licenced under the GPLv2; see http://peppy.flipturn.org for more info
+"""Spectral library matching over whole cubes.
+
+Every pixel of a cube is compared against every spectrum in a spectral
+library, producing a classification cube holding the index of the best
+matching library spectrum and a score cube holding the spectral angle or
+euclidean distance to that spectrum.
+
+The cube is processed in blocks of lines, and each block is compared against
+chunks of the library with matrix products, so the cost is dominated by
+reading the cube rather than by the comparison.
+"""
+
+import numpy
+
+from peppy.debug import *
+
+import cube as HSI
+from utils import SpectralResampler
+
+
+class SpectralLibraryMatcher(debugmixin):
+    """Find the best matching library spectrum for each pixel of a cube.
+
+    The library is a peppy spectral library cube, i.e.  one line with one
+    spectrum per sample, as returned by L{HyperspectralFileFormat.load} for an
+    ENVI spectral library.  If the wavelengths of the library don't match
+    those of the cube, the library is resampled to the cube's wavelengths
+    using L{SpectralResampler}.
+
+    Bad bands of the cube are excluded from the comparison.
+    """
+    #: Memory budget in bytes of the blocks of lines read from the cube, or
+    #: None to use the budget of the cube
+    block_bytes = None
+
+    #: Comparison methods understood by L{match}
+    methods = ['sam', 'euclidean']
+
+    @classmethod
+    def getScale(cls, library, cube):
+        """Get the factor that puts the library values in the units of the
+        cube.
+
+        The ratio of the reflectance scale factors of the cube and the
+        library is used, e.g.  a floating point reflectance library compared
+        against an integer cube with a scale factor of 10000 gives 10000.  If
+        either scale factor is unknown, the values are assumed to already be
+        in the same units.
+
+        @return: scale suitable for the scale argument of the constructor
+        """
+        if library.scale_factor > 0 and cube.scale_factor > 0:
+            return float(cube.scale_factor) / library.scale_factor
+        return 1.0
+
+    def __init__(self, library, cube, scale=1.0):
+        """Prepare the library for comparison with the cube
+
+        @param library: spectral library L{Cube}
+
+        @param cube: L{Cube} that will be matched against the library
+
+        @param scale: factor applied to the library values to put them in the
+        same units as the cube, e.g. 10000 to compare a reflectance library
+        against a cube stored as integer reflectance * 10000.  Only affects
+        the euclidean distance.
+        """
+        self.cube = cube
+        self.names = []
+        for i in range(library.samples):
+            try:
+                self.names.append(library.spectra_names[i])
+            except IndexError:
+                self.names.append("spectra#%d" % (i + 1))
+
+        spectra = numpy.array([library.getSpectraRaw(0, i) for i in range(library.samples)], dtype=numpy.float64)
+        spectra = spectra.reshape(library.samples, library.bands)
+        if library.wavelengths and cube.wavelengths and library.wavelengths != cube.wavelengths:
+            resampler = SpectralResampler.getResampler(library.wavelengths, cube.wavelengths, library.bbl)
+            spectra = resampler.resample(spectra)
+        elif library.bands != cube.bands:
+            raise ValueError("Spectral library has %d bands but cube has %d and no wavelengths to resample" % (library.bands, cube.bands))
+        spectra *= scale
+
+        self.mask = numpy.zeros(cube.bands, dtype=numpy.bool_)
+        self.mask[cube.getGoodBands()] = True
+        self.spectra = spectra * self.mask
+
+        # Squared magnitudes and unit vectors of the library spectra are used
+        # in every block, so calculate them once
+        self.norm2 = (self.spectra * self.spectra).sum(axis=1)
+        norm = numpy.sqrt(self.norm2)
+        self.unit = self.spectra / numpy.where(norm > 0, norm, 1.0)[:, numpy.newaxis]
+
+    def getLinesPerBlock(self):
+        """Number of lines of the cube that fit within L{block_bytes}
+
+        Each pixel of the block needs its float64 spectrum, plus the scores
+        against the library and the temporaries used to find the best one.
+        """
+        pixel_bytes = (self.cube.bands + 2 * len(self.spectra)) * 8
+        line_bytes = self.cube.samples * pixel_bytes
+        return self.cube.getLinesPerBlock(line_bytes, self.block_bytes)
+
+    def getSpectraPerChunk(self, pixels):
+        """Number of library spectra compared at once against the pixels
+
+        Even a single line compared against a large library can exceed
+        L{block_bytes}, so the library is split into chunks whose scores fit
+        within the budget.
+        """
+        return self.cube.getPlanesPerBlock(pixels * 2 * 8, len(self.spectra), self.block_bytes)
+
+    def findSmallest(self, pixels, scorer):
+        """Find the library spectrum with the smallest score for each pixel
+
+        The library is processed in chunks, keeping the best index and score
+        found so far.
+
+        @param pixels: array of (pixels x bands)
+
+        @param scorer: callable taking the pixels and the start and end of a
+        range of library spectra and returning the (pixels x spectra) scores
+
+        @return: tuple of index array, score array
+        """
+        total = len(self.spectra)
+        chunk = self.getSpectraPerChunk(len(pixels))
+        rows = numpy.arange(len(pixels))
+        index = None
+        best = None
+        for start in range(0, total, chunk):
+            end = min(start + chunk, total)
+            scores = scorer(pixels, start, end)
+            local = scores.argmin(axis=1)
+            value = scores[rows, local]
+            if best is None:
+                index = local
+                best = value
+            else:
+                better = value < best
+                index[better] = local[better] + start
+                best[better] = value[better]
+        return index, best
+
+    def getPixels(self, block):
+        """Convert a block of focal planes into an array of spectra
+
+        @param block: array of (lines x bands x samples) as returned by
+        L{Cube.getFocalPlanesRaw}
+
+        @return: float64 array of (pixels x bands) with the bad bands zeroed
+        """
+        pixels = block.transpose(0, 2, 1).reshape(-1, block.shape[1]).astype(numpy.float64)
+        pixels *= self.mask
+        return pixels
+
+    def scoreSpectralAngle(self, pixels, start, end):
+        # negated cosines, so the smallest score is the smallest angle
+        cosines = numpy.dot(pixels, self.unit[start:end].T)
+        numpy.negative(cosines, cosines)
+        return cosines
+
+    def matchSpectralAngle(self, pixels):
+        """Find the library spectrum with the smallest spectral angle
+
+        @param pixels: array of (pixels x bands)
+
+        @return: tuple of index array, angle array in degrees
+        """
+        index, best = self.findSmallest(pixels, self.scoreSpectralAngle)
+        best = -best
+        norm = numpy.sqrt((pixels * pixels).sum(axis=1))
+        best /= numpy.where(norm > 0, norm, 1.0)
+        angle = numpy.degrees(numpy.arccos(numpy.clip(best, -1.0, 1.0)))
+        return index, angle
+
+    def scoreEuclideanDistance(self, pixels, start, end):
+        # the squared distance less the |p|^2 term, which is the same for
+        # every library spectrum
+        dist2 = numpy.dot(pixels, self.spectra[start:end].T)
+        dist2 *= -2.0
+        dist2 += self.norm2[start:end]
+        return dist2
+
+    def matchEuclideanDistance(self, pixels):
+        """Find the library spectrum with the smallest euclidean distance
+
+        The squared distance is expanded into |p|^2 - 2 p.l + |l|^2 so that
+        the comparison against the library is a matrix product.
+
+        @param pixels: array of (pixels x bands)
+
+        @return: tuple of index array, distance array
+        """
+        index, best = self.findSmallest(pixels, self.scoreEuclideanDistance)
+        best += (pixels * pixels).sum(axis=1)
+        distance = numpy.sqrt(numpy.maximum(best, 0.0))
+        return index, distance
+
+    def match(self, method='sam', progress=None):
+        """Match every pixel of the cube against the library
+
+        @param method: 'sam' for the spectral angle or 'euclidean' for the
+        euclidean distance
+
+        @param progress: optional callable taking the percent complete
+
+        @return: tuple of classification cube, score cube.  Both are single
+        band cubes of the same dimensions as the source cube; the
+        classification cube holds the index into the library of the best
+        match and the score cube holds the angle in degrees or the distance
+        to that spectrum.
+        """
+        if method == 'sam':
+            func = self.matchSpectralAngle
+        elif method == 'euclidean':
+            func = self.matchEuclideanDistance
+        else:
+            raise ValueError("Unknown matching method %s" % method)
+        cube = self.cube
+        if len(self.names) < 32768:
+            datatype = numpy.int16
+        else:
+            datatype = numpy.int32
+        classes = HSI.createCube('bsq', cube.lines, cube.samples, 1, datatype)
+        classes.band_names = ['Best match']
+        classes.spectra_names = self.names[:]
+        scores = HSI.createCube('bsq', cube.lines, cube.samples, 1, numpy.float32)
+        if method == 'sam':
+            scores.band_names = ['Spectral angle']
+        else:
+            scores.band_names = ['Euclidean distance']
+        class_band = classes.getBandRaw(0)
+        score_band = scores.getBandRaw(0)
+
+        count = self.getLinesPerBlock()
+        line = 0
+        while line < cube.lines:
+            end = min(line + count, cube.lines)
+            pixels = self.getPixels(cube.getFocalPlanesRaw(line, end))
+            index, score = func(pixels)
+            class_band[line:end,:] = index.reshape(end - line, cube.samples)
+            score_band[line:end,:] = score.reshape(end - line, cube.samples)
+            line = end
+            if progress:
+                progress((line * 100) / cube.lines)
+        return classes, scores
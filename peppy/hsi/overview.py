@@ -0,0 +1,191 @@
+# peppy Copyright (c) 2006-2010 Rob McMullen
+# Licenced under the GPLv2; see http://peppy.flipturn.org for more info
+"""Reduced resolution overviews of the bands of a cube.
+
+Displaying a large cube zoomed out still requires the full resolution band to
+be scaled down to the screen.  The L{OverviewPyramid} holds versions of each
+band that are decimated by powers of two so that zoomed out views can be
+generated from much smaller arrays.  Overviews are built lazily the first
+time a band is viewed at a particular level, and are saved in the user's
+configuration directory so they don't have to be built again.
+"""
+
+import os, glob, hashlib
+
+import numpy
+
+from peppy.debug import *
+from peppy.hsi.utils import bandReduceSampling
+from peppy.hsi.stats import StatsCache
+
+
+class OverviewPyramid(debugmixin):
+    """Lazily built set of decimated bands of a cube.
+
+    Levels are identified by their decimation factor: level 2 has half the
+    lines and samples of the cube, level 4 a quarter, and so on.  Each level
+    is built by averaging 2x2 blocks of the next finer level.  The overviews
+    are kept in the cube's L{TileCache}, and also saved in a subdirectory
+    of L{cache_dir} for each data file.
+
+    The total size of the saved overviews is limited to L{max_bytes}; the
+    least recently used overviews are deleted to make room for new ones.
+    """
+    #: Overviews aren't made smaller than this in either dimension
+    min_size = 64
+
+    #: Directory used to store the overviews, or None to disable
+    cache_dir = None
+
+    #: Maximum total size in bytes of the overviews in the cache directory
+    max_bytes = 512 * 1024 * 1024
+
+    def __init__(self, cube):
+        self.cube = cube
+        self.overview_dir = None
+        self.checked_dir = False
+
+    @classmethod
+    def getMaxLevel(cls, cube):
+        """Return the coarsest level available for the cube"""
+        level = 1
+        size = min(cube.lines, cube.samples)
+        while size / (level * 2) >= cls.min_size:
+            level *= 2
+        return level
+
+    @classmethod
+    def getLevelForZoom(cls, cube, zoom):
+        """Return the coarsest level that still has at least one data pixel
+        per screen pixel at the given zoom factor.
+        """
+        level = 1
+        max_level = cls.getMaxLevel(cube)
+        while level * 2 <= max_level and zoom * level * 2 <= 1.0:
+            level *= 2
+        return level
+
+    def getShape(self, level):
+        """Return the (lines, samples) shape of an overview band"""
+        return (self.cube.lines / level, self.cube.samples / level)
+
+    def getCacheDir(self):
+        """Return the directory holding the saved overviews, or None if the
+        overviews can't be saved.
+
+        Each cube gets its own subdirectory of L{cache_dir}, named from the
+        url and data offset of the cube.  The directory is checked against
+        the key of the data file, and any overviews saved from a previous
+        version of the file are removed.
+        """
+        if self.checked_dir:
+            return self.overview_dir
+        self.checked_dir = True
+        key = StatsCache.getKey(self.cube)
+        if self.cache_dir is None or key is None:
+            return None
+        name = hashlib.md5("|".join([key[0], key[3]])).hexdigest()
+        path = os.path.join(self.cache_dir, name)
+        keyfile = os.path.join(path, "key")
+        key = "|".join(key)
+        try:
+            if not os.path.exists(path):
+                os.makedirs(path)
+            elif os.path.exists(keyfile) and open(keyfile).read() == key:
+                self.overview_dir = path
+                return path
+            for filename in glob.glob(os.path.join(path, "*.npy")):
+                os.remove(filename)
+            fh = open(keyfile, "w")
+            fh.write(key)
+            fh.close()
+            self.overview_dir = path
+        except (IOError, OSError), e:
+            self.dprint("Can't use %s for overviews: %s" % (path, e))
+        return self.overview_dir
+
+    @classmethod
+    def makeRoom(cls, needed):
+        """Delete the least recently used overviews until there is room for
+        another overview of the given size
+        """
+        overviews = []
+        total = 0
+        for filename in glob.glob(os.path.join(cls.cache_dir, "*", "*.npy")):
+            try:
+                size = os.path.getsize(filename)
+                overviews.append((os.path.getmtime(filename), filename, size))
+                total += size
+            except OSError:
+                pass
+        overviews.sort()
+        for mtime, filename, size in overviews:
+            if total + needed <= cls.max_bytes:
+                break
+            cls.dprint("removing %s" % filename)
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            total -= size
+
+    def getFilename(self, band, level):
+        return os.path.join(self.overview_dir, "band%d-level%d.npy" % (band, level))
+
+    def load(self, band, level):
+        if self.getCacheDir() is None:
+            return None
+        filename = self.getFilename(band, level)
+        if os.path.exists(filename):
+            try:
+                data = numpy.load(filename)
+                if data.shape == self.getShape(level):
+                    # mark it as recently used
+                    os.utime(filename, None)
+                    return data
+            except Exception, e:
+                self.dprint("Failed loading %s: %s" % (filename, e))
+        return None
+
+    def save(self, band, level, data):
+        if self.getCacheDir() is None:
+            return
+        if data.nbytes > self.max_bytes:
+            return
+        filename = self.getFilename(band, level)
+        try:
+            self.makeRoom(data.nbytes)
+            numpy.save(filename, data)
+        except Exception, e:
+            self.dprint("Failed saving %s: %s" % (filename, e))
+
+    def build(self, band, level):
+        """Create the overview from the next finer level"""
+        if level == 2:
+            source = self.cube.getBandRaw(band)
+        else:
+            source = self.getBand(band, level / 2)
+        return bandReduceSampling(source, 2)
+
+    def getBand(self, band, level):
+        """Return the overview of a band at the given level.
+
+        @param band: band number
+
+        @param level: decimation factor, a power of two.  Level 1 returns
+        the full resolution band.
+
+        @return: 2D array of (lines / level x samples / level)
+        """
+        if level <= 1:
+            return self.cube.getBandRaw(band)
+        cache = self.cube.tile_cache
+        key = self.cube.getCacheKey('overview', band, level)
+        data = cache.get(key)
+        if data is None:
+            data = self.load(band, level)
+            if data is None:
+                data = self.build(band, level)
+                self.save(band, level, data)
+            cache.put(key, data)
+        return data
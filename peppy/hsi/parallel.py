@@ -0,0 +1,244 @@
+# peppy Copyright (c) 2006-2010 Rob McMullen
+# Licenced under the GPLv2; see http://peppy.flipturn.org for more info
+"""Process-parallel calculations on memory mapped cubes.
+
+Calculations that are performed independently on each line of a cube can be
+split across a pool of worker processes.  Cubes can't be passed between
+processes, so each worker reopens the data files itself using the memory
+mapped cube readers from the description in a L{CubeSource}.  Results are
+written directly into an output buffer in shared memory, so the only data
+passed back to the parent process is the count of lines completed.
+"""
+
+import numpy
+
+try:
+    import multiprocessing
+except ImportError:
+    # Python 2.5 doesn't have the multiprocessing module, so only serial
+    # calculations are available
+    multiprocessing = None
+
+from peppy.debug import *
+
+import cube as HSI
+import utils
+
+
+def getNumProcesses(processes=None):
+    """Return the number of worker processes to use, or 1 if parallel
+    processing isn't available.
+
+    Process parallelism is opt-in, because starting worker processes from a
+    running GUI application isn't safe on every platform: None means a
+    single process, and zero or a negative number means one process per CPU.
+    """
+    if multiprocessing is None or processes is None:
+        return 1
+    if processes < 1:
+        try:
+            processes = multiprocessing.cpu_count()
+        except NotImplementedError:
+            processes = 1
+    return processes
+
+
+class CubeSource(object):
+    """Picklable description of the raw data of a cube stored in a file.
+
+    Only cubes that are read from a local file with one of the plain BIP, BIL
+    or BSQ cube readers can be described, because the worker processes have
+    to be able to memory map the same data using nothing more than the
+    location and layout of the data in the file.
+    """
+    def __init__(self, cube):
+        self.filename = str(cube.url.path)
+        self.interleave = cube.interleave
+        self.lines = cube.lines
+        self.samples = cube.samples
+        self.bands = cube.bands
+        self.data_type = cube.data_type
+        self.byte_order = cube.byte_order
+        self.data_offset = cube.data_offset
+        self.data_bytes = cube.data_bytes
+
+    @classmethod
+    def fromCube(cls, cube):
+        """Return a L{CubeSource} for the cube, or None if the cube's data
+        can't be memory mapped by another process.
+        """
+        if cube.url is None or cube.url.scheme != 'file':
+            return None
+        # The cube module imports this module indirectly, so the reader
+        # classes can't be referenced until the cube module is loaded
+        raw_readers = [HSI.FileBIPCubeReader, HSI.FileBILCubeReader,
+                       HSI.FileBSQCubeReader, HSI.MMapBIPCubeReader,
+                       HSI.MMapBILCubeReader, HSI.MMapBSQCubeReader]
+        if cube.cube_io.__class__ not in raw_readers:
+            return None
+        return cls(cube)
+
+    def open(self):
+        """Create a cube that reads the data using a memory mapped reader"""
+        cube = HSI.Cube(self.filename, self.interleave)
+        cube.lines = self.lines
+        cube.samples = self.samples
+        cube.bands = self.bands
+        cube.data_offset = self.data_offset
+        cube.data_bytes = self.data_bytes
+        cube.initialize(self.data_type, self.byte_order)
+        cube_io_cls = HSI.getMMapCubeReader(cube, check_size=False)
+        cube.cube_io = cube_io_cls(cube, cube.url)
+        return cube
+
+
+# Global state of each worker process, set by the pool initializer
+_worker = {}
+
+def _initCompareWorker(output, source1, source2, line_offset, bbl):
+    _worker['output'] = output
+    _worker['cube1'] = source1.open()
+    _worker['cube2'] = source2.open()
+    _worker['line_offset'] = line_offset
+    _worker['bbl'] = bbl
+
+def _compareLines(lines):
+    """Worker function of L{compareInParallel}.
+
+    Calculates the euclidean distance and spectral angle of a range of lines,
+    using the same calculations as L{CubeCompare.getEuclideanDistance} and
+    L{CubeCompare.getSpectralAngle}.
+
+    @param lines: tuple of (first line, last line + 1)
+
+    @return: number of lines processed
+    """
+    line1, line2 = lines
+    cube1 = _worker['cube1']
+    cube2 = _worker['cube2']
+    offset = _worker['line_offset']
+    output = numpy.frombuffer(_worker['output'], dtype=numpy.float32)
+    output = output.reshape(2, cube2.lines, cube2.samples)
+
+    block1 = cube1.getFocalPlanesRaw(line1 + offset, line2 + offset)
+    block2 = cube2.getFocalPlanesRaw(line1, line2)
+    bblmask = numpy.array(_worker['bbl']).reshape(cube2.bands, 1)
+
+    output[0, line1:line2, :] = utils.getEuclideanDistanceOfBlocks(block1, block2, bblmask)
+    output[1, line1:line2, :] = utils.getSpectralAngleOfBlocks(block1, block2, bblmask)
+    return line2 - line1
+
+
+def iterLineRanges(lines, processes, max_lines):
+    """Split the lines into ranges for the worker processes.
+
+    Several ranges are created for each process so that the work stays
+    balanced and progress is reported smoothly, and each range is limited to
+    max_lines, usually from L{Cube.getLinesPerBlock}.
+    """
+    count = max(lines / (processes * 4), 1)
+    count = max(min(count, max_lines), 1)
+    line = 0
+    while line < lines:
+        end = min(line + count, lines)
+        yield (line, end)
+        line = end
+
+
+def compareInParallel(comp, processes=None, updater=None):
+    """Calculate the euclidean distance and spectral angle between the cubes
+    of a L{CubeCompare} using a pool of worker processes.
+
+    @param comp: L{CubeCompare} instance whose cubes can both be described by
+    a L{CubeSource}
+
+    @param processes: number of worker processes, or 0 to use one per CPU
+
+    @param updater: optional L{ProgressUpdater}
+
+    @return: float32 numpy array of (2, lines, samples) where the first band
+    is the euclidean distance and the second is the spectral angle
+    """
+    source1 = CubeSource.fromCube(comp.cube1)
+    source2 = CubeSource.fromCube(comp.cube2)
+    processes = getNumProcesses(processes)
+    shared = multiprocessing.RawArray('f', 2 * comp.lines * comp.samples)
+    max_lines = comp.getLinesPerBlock()
+
+    pool = multiprocessing.Pool(processes, _initCompareWorker,
+                                (shared, source1, source2, comp.line_offset, comp.bbl))
+    try:
+        done = 0
+        for count in pool.imap_unordered(_compareLines, iterLineRanges(comp.lines, processes, max_lines)):
+            done += count
+            if updater:
+                updater.updateStatus(done, comp.lines, "Calculating Euclidean Distance and Spectral Angle")
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    pool.join()
+
+    output = numpy.frombuffer(shared, dtype=numpy.float32)
+    return output.reshape(2, comp.lines, comp.samples)
+
+
+def _initClassifyWorker(output, source, good, centers):
+    _worker['output'] = output
+    _worker['cube'] = source.open()
+    _worker['good'] = good
+    _worker['centers'] = centers
+
+def _classifyLines(lines):
+    """Worker function of L{classifyInParallel}.
+
+    @param lines: tuple of (first line, last line + 1)
+
+    @return: number of lines processed
+    """
+    line1, line2 = lines
+    cube = _worker['cube']
+    output = numpy.frombuffer(_worker['output'], dtype=numpy.int16)
+    output = output.reshape(cube.lines, cube.samples)
+    block = cube.getFocalPlanesRaw(line1, line2)
+    output[line1:line2, :] = utils.getNearestCentersOfBlock(block, _worker['good'], _worker['centers'])
+    return line2 - line1
+
+
+def classifyInParallel(cube, good, centers, processes=None, progress=None):
+    """Label every pixel of the cube with the index of the nearest cluster
+    center using a pool of worker processes.
+
+    @param cube: L{Cube} that can be described by a L{CubeSource}
+
+    @param good: array of the indexes of the bands used in the centers
+
+    @param centers: float64 array of (classes x good bands)
+
+    @param processes: number of worker processes, or 0 to use one per CPU
+
+    @param progress: optional callable taking the percent complete
+
+    @return: int16 numpy array of (lines, samples)
+    """
+    source = CubeSource.fromCube(cube)
+    processes = getNumProcesses(processes)
+    shared = multiprocessing.RawArray('h', cube.lines * cube.samples)
+    max_lines = cube.getLinesPerBlock(cube.samples * cube.bands * cube.itemsize)
+
+    pool = multiprocessing.Pool(processes, _initClassifyWorker,
+                                (shared, source, good, centers))
+    try:
+        done = 0
+        for count in pool.imap_unordered(_classifyLines, iterLineRanges(cube.lines, processes, max_lines)):
+            done += count
+            if progress:
+                progress((done * 100) / cube.lines)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    pool.join()
+
+    output = numpy.frombuffer(shared, dtype=numpy.int16)
+    return output.reshape(cube.lines, cube.samples)
@@ -0,0 +1,183 @@
+# peppy Copyright (c) 2006-2010 Rob McMullen
+# Licenced under the GPLv2; see http://peppy.flipturn.org for more info
+"""Principal component and minimum noise fraction transforms.
+
+The transforms are calculated out of core in two streaming passes through
+the cube.  The first pass accumulates the band covariance matrix (and for
+the minimum noise fraction, the covariance of the noise estimated from the
+differences between neighboring samples); the second pass projects each
+block of pixels onto the leading eigenvectors and writes the components to
+a new BSQ cube.  Memory use is bounded by the size of the blocks and the
+size of the covariance matrices.
+"""
+
+import numpy
+
+from peppy.debug import *
+
+import cube as HSI
+
+
+class PrincipalComponents(debugmixin):
+    """Principal component transform of a cube.
+
+    Bad bands, as returned by L{Cube.getBadBandList}, are left out of the
+    covariance matrix and the transform.
+    """
+    #: Memory budget in bytes of the float64 blocks of lines, or None to use
+    #: the budget of the cube
+    block_bytes = None
+
+    #: Name of each component, formatted with the component number
+    component_name = "PC %d"
+
+    def __init__(self, cube):
+        self.cube = cube
+        self.good = cube.getGoodBands()
+        if len(self.good) == 0:
+            raise ValueError("All bands of the cube are marked as bad bands")
+        self.count = 0
+        self.mean = None
+        self.covariance = None
+        self.eigenvalues = None
+        self.eigenvectors = None
+
+    def getLinesPerBlock(self):
+        """Number of lines of the cube that fit within L{block_bytes}"""
+        line_bytes = self.cube.samples * len(self.good) * 8
+        return self.cube.getLinesPerBlock(line_bytes, self.block_bytes)
+
+    def getPixels(self, block):
+        """Convert a block of focal planes into a float64 array of (pixels x
+        good bands)"""
+        good = block[:, self.good, :]
+        return good.transpose(0, 2, 1).reshape(-1, len(self.good)).astype(numpy.float64)
+
+    def addBlock(self, block, pixels):
+        """Hook for subclasses that need more than the pixels of the block"""
+        pass
+
+    def calculateStatistics(self, progress=None):
+        """First pass: accumulate the mean and the band covariance matrix
+
+        The values are shifted by the mean of the first block before the
+        cross products are accumulated, which avoids the loss of precision
+        of the textbook sum of squares formula when the mean is large
+        compared to the variation.
+        """
+        cube = self.cube
+        bands = len(self.good)
+        count = 0
+        shift = None
+        total = numpy.zeros(bands, dtype=numpy.float64)
+        cross = numpy.zeros((bands, bands), dtype=numpy.float64)
+        for line, block in cube.iterFocalPlaneBlocks(self.getLinesPerBlock()):
+            pixels = self.getPixels(block)
+            if len(pixels) == 0:
+                continue
+            self.addBlock(block, pixels)
+            if shift is None:
+                shift = pixels.mean(axis=0)
+            pixels -= shift
+            total += pixels.sum(axis=0)
+            cross += numpy.dot(pixels.T, pixels)
+            count += len(pixels)
+            if progress:
+                progress(((line + block.shape[0]) * 100) / max(cube.lines, 1))
+        if count < 2:
+            raise ValueError("Not enough pixels to calculate the covariance")
+        offset = total / count
+        self.count = count
+        self.mean = shift + offset
+        self.covariance = (cross - count * numpy.outer(offset, offset)) / (count - 1)
+
+    def calculateEigenvectors(self):
+        """Sort the eigenvectors of the covariance matrix by decreasing
+        eigenvalue"""
+        values, vectors = numpy.linalg.eigh(self.covariance)
+        order = numpy.argsort(values)[::-1]
+        self.eigenvalues = values[order]
+        self.eigenvectors = vectors[:, order]
+
+    def calculate(self, progress=None):
+        """Calculate the transform in a single pass through the cube"""
+        self.calculateStatistics(progress)
+        self.calculateEigenvectors()
+
+    def getComponentCount(self, count=None):
+        bands = len(self.good)
+        if count is None or count <= 0 or count > bands:
+            return bands
+        return count
+
+    def transform(self, count=None, progress=None):
+        """Second pass: project the cube onto the leading components
+
+        @param count: number of components to keep, or None for all
+
+        @param progress: optional callable taking the percent complete
+
+        @return: float32 BSQ cube holding one component in each band
+        """
+        if self.eigenvectors is None:
+            self.calculate()
+        cube = self.cube
+        count = self.getComponentCount(count)
+        output = HSI.createCube('bsq', cube.lines, cube.samples, count, numpy.float32)
+        output.band_names = [self.component_name % (i + 1) for i in range(count)]
+        raw = output.getNumpyArray()
+        vectors = self.eigenvectors[:, 0:count]
+        for line, block in cube.iterFocalPlaneBlocks(self.getLinesPerBlock()):
+            lines = block.shape[0]
+            pixels = self.getPixels(block)
+            pixels -= self.mean
+            components = numpy.dot(pixels, vectors)
+            raw[:, line:line + lines, :] = components.reshape(lines, cube.samples, count).transpose(2, 0, 1)
+            if progress:
+                progress(((line + lines) * 100) / max(cube.lines, 1))
+        return output
+
+
+class MinimumNoiseFraction(PrincipalComponents):
+    """Minimum noise fraction transform of a cube.
+
+    The noise is estimated from the differences between neighboring samples
+    in each line, which are accumulated in the same pass as the band
+    covariance.  The components are ordered by decreasing signal to noise
+    ratio rather than by decreasing variance.
+    """
+    component_name = "MNF %d"
+
+    def calculateStatistics(self, progress=None):
+        bands = len(self.good)
+        if self.cube.samples < 2:
+            raise ValueError("At least two samples are needed to estimate the noise")
+        self.noise_count = 0
+        self.noise_cross = numpy.zeros((bands, bands), dtype=numpy.float64)
+        PrincipalComponents.calculateStatistics(self, progress)
+        # The difference of two samples with independent noise has twice
+        # the noise variance
+        self.noise = self.noise_cross / (2.0 * self.noise_count)
+
+    def addBlock(self, block, pixels):
+        lines = block.shape[0]
+        samples = self.cube.samples
+        bands = len(self.good)
+        pixels = pixels.reshape(lines, samples, bands)
+        diff = (pixels[:, 1:, :] - pixels[:, :-1, :]).reshape(-1, bands)
+        self.noise_cross += numpy.dot(diff.T, diff)
+        self.noise_count += len(diff)
+
+    def calculateEigenvectors(self):
+        """Whiten the noise, then find the principal components of the
+        noise whitened covariance"""
+        values, vectors = numpy.linalg.eigh(self.noise)
+        if values.max() <= 0.0:
+            raise ValueError("The noise covariance is zero")
+        values = numpy.maximum(values, values.max() * 1e-12)
+        whiten = vectors / numpy.sqrt(values)
+        whitened = numpy.dot(whiten.T, numpy.dot(self.covariance, whiten))
+        values, vectors = numpy.linalg.eigh(whitened)
+        order = numpy.argsort(values)[::-1]
+        self.eigenvalues = values[order]
+        self.eigenvectors = numpy.dot(whiten, vectors[:, order])
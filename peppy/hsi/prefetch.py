@@ -0,0 +1,237 @@
+# peppy Copyright (c) 2006-2010 Rob McMullen
+# Licenced under the GPLv2; see http://peppy.flipturn.org for more info
+"""Background loading of bands that are likely to be viewed next.
+
+When stepping through the bands of a cube that isn't memory mapped, each new
+band has to be read from the file before it can be displayed.  The
+L{BandPrefetcher} watches the direction and speed of the user's navigation and
+loads the bands that are predicted to be requested next into the
+L{Cube.tile_cache} using a background thread.
+"""
+
+import time, threading
+
+from peppy.debug import *
+
+
+class BandPrefetcher(debugmixin):
+    """Background thread that loads predicted planes into the tile cache.
+
+    The prefetcher uses its own cube reader (and therefore its own file
+    handle) so that it doesn't interfere with the reads performed by the GUI
+    thread.  The data is stored in the cube's tile cache using the same key
+    that the cube itself would use, so the next call to L{Cube.getBandRaw}
+    (or L{Cube.getFocalPlaneRaw} for the focal plane view) will be a cache
+    hit.
+
+    Cancellation is checked between planes: a new navigation request discards
+    all the pending predictions, but a plane that is currently being read is
+    allowed to complete.
+    """
+    #: Minimum number of planes to load ahead of the current position
+    min_depth = 2
+
+    #: Maximum number of planes to load ahead of the current position
+    max_depth = 16
+
+    #: Number of seconds of navigation at the current velocity that the
+    #: prefetcher tries to stay ahead of the user
+    lookahead_time = 1.0
+
+    def __init__(self, cube, axis='band'):
+        """Create the prefetcher for a cube.
+
+        @param cube: L{Cube} instance
+
+        @param axis: either 'band' to prefetch bands or 'focalplane' to
+        prefetch focal planes
+        """
+        self.cube = cube
+        self.axis = axis
+        if axis == 'band':
+            self.max_index = cube.bands - 1
+        else:
+            self.max_index = cube.lines - 1
+
+        self.condition = threading.Condition()
+        self.pending = []
+        self.loading = None
+        self.running = False
+        self.thread = None
+        self.reader = None
+
+        self.last_indexes = None
+        self.last_time = 0.0
+        self.velocity = 0.0
+
+    @classmethod
+    def isUseful(cls, cube):
+        """Is it worthwhile to prefetch from this cube?
+
+        Only cubes read through the tile cache need prefetching; memory mapped
+        cubes are already fast.
+        """
+        return cube is not None and cube.url is not None and cube.cube_io is not None and cube.cube_io.use_tile_cache
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="HSI band prefetch")
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop the background thread.
+
+        The thread is not joined; any read in progress is completed in the
+        background and the thread then exits.
+        """
+        self.condition.acquire()
+        try:
+            self.running = False
+            self.pending = []
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+    def cancel(self):
+        """Discard all pending predictions"""
+        self.condition.acquire()
+        try:
+            self.pending = []
+        finally:
+            self.condition.release()
+
+    def getKey(self, index):
+        if self.axis == 'band':
+            return self.cube.getCacheKey('band', index, None)
+        return self.cube.getCacheKey('focalplane', index, None)
+
+    def navigate(self, indexes):
+        """Notify the prefetcher that the view has moved to new indexes.
+
+        The difference from the previous indexes gives the direction and step
+        size, and the time between calls gives the velocity that determines
+        how far ahead to prefetch.
+
+        @param indexes: list of indexes currently displayed
+        """
+        now = time.time()
+        step = 0
+        if self.last_indexes and len(self.last_indexes) == len(indexes):
+            step = indexes[0] - self.last_indexes[0]
+            elapsed = now - self.last_time
+            if elapsed > 0.0 and step != 0:
+                # exponential moving average smooths out the jitter in the
+                # arrival times of slider events
+                current = abs(step) / elapsed
+                self.velocity = 0.5 * self.velocity + 0.5 * current
+        self.last_indexes = list(indexes)
+        self.last_time = now
+
+        if step == 0:
+            # Jumped to the same place or no history; prefetch in both
+            # directions from the current location
+            self.predict(indexes, [1, -1], 1)
+        elif step > 0:
+            self.predict(indexes, [1], step)
+        else:
+            self.predict(indexes, [-1], -step)
+
+    def hint(self, index):
+        """Request a prefetch around a position that isn't displayed yet.
+
+        Used by the band slider when the image isn't updated while dragging:
+        the band under the slider is loaded first, followed by its neighbors.
+        """
+        self.navigate([index])
+        self.condition.acquire()
+        try:
+            self.pending[0:0] = [index]
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+    def getDepth(self, step):
+        """Number of planes to prefetch given the current navigation speed"""
+        depth = int(self.velocity * self.lookahead_time / max(step, 1))
+        return max(self.min_depth, min(depth, self.max_depth))
+
+    def predict(self, indexes, directions, step):
+        """Replace the pending list with new predictions"""
+        depth = self.getDepth(step)
+        pending = []
+        for i in range(1, depth + 1):
+            for direction in directions:
+                for index in indexes:
+                    predicted = index + (direction * step * i)
+                    if predicted >= 0 and predicted <= self.max_index and predicted not in pending:
+                        pending.append(predicted)
+        self.dprint("velocity=%f predicted=%s" % (self.velocity, pending))
+        self.condition.acquire()
+        try:
+            self.pending = pending
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+    def waitIfLoading(self, index, timeout=10.0):
+        """Block until the given index is no longer being loaded.
+
+        The GUI thread calls this before reading a plane so that it doesn't
+        duplicate a read that is already in progress in the background.
+        """
+        self.condition.acquire()
+        try:
+            end = time.time() + timeout
+            while self.loading == index and time.time() < end:
+                self.condition.wait(end - time.time())
+        finally:
+            self.condition.release()
+
+    def getReader(self):
+        """Open a private reader so the file position isn't shared with the
+        GUI thread."""
+        if self.reader is None:
+            cls = self.cube.cube_io.__class__
+            self.reader = cls(self.cube, self.cube.url)
+        return self.reader
+
+    def load(self, index):
+        reader = self.getReader()
+        if self.axis == 'band':
+            return reader.getBandRaw(index, use_progress=False)
+        return reader.getFocalPlaneRaw(index, use_progress=False)
+
+    def run(self):
+        cache = self.cube.tile_cache
+        while True:
+            self.condition.acquire()
+            try:
+                while self.running and not self.pending:
+                    self.condition.wait()
+                if not self.running:
+                    break
+                index = self.pending.pop(0)
+                key = self.getKey(index)
+                if key in cache:
+                    continue
+                self.loading = index
+            finally:
+                self.condition.release()
+
+            try:
+                data = self.load(index)
+                cache.put(key, data)
+                self.dprint("prefetched %s %d" % (self.axis, index))
+            except Exception, e:
+                self.dprint("failed prefetching %s %d: %s" % (self.axis, index, e))
+
+            self.condition.acquire()
+            try:
+                self.loading = None
+                self.condition.notifyAll()
+            finally:
+                self.condition.release()
+
+        if self.reader is not None and hasattr(self.reader, 'fh'):
+            self.reader.fh.close()
@@ -0,0 +1,107 @@
+# peppy Copyright (c) 2006-2010 Rob McMullen
+# Licenced under the GPLv2; see http://peppy.flipturn.org for more info
+"""Reading blocks of a cube ahead of the code that processes them.
+
+Passes through an entire cube alternate between waiting for the disk and
+waiting for the processor.  The L{ReadAheadIterator} loads the next blocks
+of data in a background thread while the caller works on the current block,
+so that the reads and the calculations overlap.
+"""
+
+import sys, threading, Queue
+
+from peppy.debug import *
+
+
+class ReadAheadIterator(debugmixin):
+    """Iterate over blocks of data loaded by a background thread.
+
+    The thread stays at most L{depth} blocks ahead of the caller, so with
+    the default depth of 1 the next block is read while the caller works on
+    the current one and only two blocks are held in memory at any time.
+    Exceptions raised when loading a block are raised again in the caller.
+
+    The thread is stopped if the caller stops iterating early.
+    """
+    #: Number of blocks loaded ahead of the block being used by the caller
+    depth = 1
+
+    def __init__(self, loader, ranges, depth=None, cleanup=None):
+        """Create the iterator
+
+        @param loader: callable taking a start and end index and returning
+        the block of data for that range
+
+        @param ranges: list of (start, end) tuples passed to the loader
+
+        @param depth: optional override of L{depth}
+
+        @param cleanup: optional callable that is called from the background
+        thread after the last block is loaded, e.g. to close the file used
+        by the loader
+        """
+        self.loader = loader
+        self.ranges = ranges
+        if depth is not None:
+            self.depth = depth
+        self.cleanup = cleanup
+        self.queue = Queue.Queue()
+        self.slots = threading.Semaphore(self.depth + 1)
+        self.stopping = False
+        self.thread = None
+
+    def run(self):
+        try:
+            try:
+                for start, end in self.ranges:
+                    self.slots.acquire()
+                    if self.stopping:
+                        break
+                    self.queue.put((start, self.loader(start, end)))
+            except Exception:
+                self.queue.put(sys.exc_info())
+        finally:
+            if self.cleanup:
+                self.cleanup()
+            self.queue.put(None)
+
+    def __iter__(self):
+        """Iterate over the blocks
+
+        @return: tuple of (start index, block) for each range
+        """
+        self.thread = threading.Thread(target=self.run, name="HSI read ahead")
+        self.thread.setDaemon(True)
+        self.thread.start()
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                if len(item) == 3:
+                    raise item[0], item[1], item[2]
+                yield item
+                # The caller is finished with the previous block, so the
+                # thread can start loading another
+                self.slots.release()
+        finally:
+            self.stop()
+
+    def stop(self):
+        """Stop the background thread and wait for it to finish"""
+        self.stopping = True
+        self.slots.release()
+        if self.thread is not None and self.thread is not threading.currentThread():
+            self.thread.join()
+
+
+def getRanges(total, count, start=0):
+    """Return a list of (start, end) tuples dividing the range from start
+    to total into pieces of count items"""
+    ranges = []
+    count = max(count, 1)
+    while start < total:
+        end = min(start + count, total)
+        ranges.append((start, end))
+        start = end
+    return ranges
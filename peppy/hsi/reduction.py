@@ -0,0 +1,281 @@
+# peppy Copyright (c) 2006-2010 Rob McMullen
+# Licenced under the GPLv2; see http://peppy.flipturn.org for more info
+"""Streaming reductions of hyperspectral cubes.
+
+A reduction collapses one axis of a cube -- lines, samples or bands -- into
+a single value using an operation like the mean, standard deviation or
+median.  Reducing over the lines of a pushbroom cube, for instance, gives
+the average focal plane used as a flat field or dark frame.
+
+All the requested operations are calculated in a single streaming pass over
+blocks of focal planes, using float64 accumulators.
+"""
+
+import numpy
+
+from peppy.debug import *
+
+
+class CubeReduction(debugmixin):
+    """Calculate reductions of a cube along one axis.
+
+    The results are 2d arrays of the two axes that remain: (bands x samples)
+    when reducing lines, (lines x bands) when reducing samples, and (lines x
+    samples) when reducing bands.
+
+    Samples and bands are complete within each block of focal planes, so all
+    of their reductions are exact.  Lines span all the blocks, so the mean
+    and variance of the lines are combined between blocks using the parallel
+    algorithm of Chan et al., and the median and percentiles are estimated
+    from a histogram kept for each element of the focal plane.  Like
+    L{BandStatistics}, each histogram uses a fixed number of bins whose
+    width doubles whenever new data falls outside its current range.
+    """
+    #: Axes that can be reduced
+    axes = ['lines', 'samples', 'bands']
+
+    #: Operations understood by L{compute}; in addition, percentiles are
+    #: named by a 'p' followed by the percentile, e.g.  'p5' or 'p99.5'
+    operations = ['mean', 'variance', 'stddev', 'minimum', 'maximum', 'median']
+
+    #: Number of histogram bins used to estimate percentiles of lines; must
+    #: be even so bins can be merged in pairs
+    bins = 64
+
+    def __init__(self, cube, axis='lines'):
+        if axis not in self.axes:
+            raise ValueError("Unknown axis %s" % axis)
+        self.cube = cube
+        self.axis = axis
+        self.integer = numpy.issubdtype(cube.data_type, numpy.integer)
+
+    @classmethod
+    def getPercentile(cls, operation):
+        """Return the percentile named by the operation, or None if the
+        operation isn't a percentile.
+
+        @raises ValueError: if the operation isn't known
+        """
+        if operation == 'median':
+            return 50.0
+        if operation in cls.operations:
+            return None
+        if operation.startswith('p'):
+            try:
+                percent = float(operation[1:])
+            except ValueError:
+                percent = -1.0
+            if percent >= 0.0 and percent <= 100.0:
+                return percent
+        raise ValueError("Unknown reduction %s" % operation)
+
+    def getShape(self):
+        """Return the shape of the result arrays"""
+        cube = self.cube
+        if self.axis == 'lines':
+            return (cube.bands, cube.samples)
+        elif self.axis == 'samples':
+            return (cube.lines, cube.bands)
+        return (cube.lines, cube.samples)
+
+    def compute(self, operations, progress=None):
+        """Calculate the reductions in a single pass through the cube
+
+        @param operations: list of operation names, see L{operations}
+
+        @param progress: optional callable taking the percent complete
+
+        @return: dict mapping the operation name to a float64 array of the
+        shape given by L{getShape}
+        """
+        percentiles = {}
+        for operation in operations:
+            percent = self.getPercentile(operation)
+            if percent is not None:
+                percentiles[operation] = percent
+        if self.axis == 'lines':
+            results = self.reduceLines(operations, percentiles, progress)
+        else:
+            if self.axis == 'samples':
+                axis = 2
+            else:
+                # bands are the middle axis, leaving (lines x samples)
+                axis = 1
+            results = self.reduceWithinBlocks(axis, operations, percentiles, progress)
+        return results
+
+    def reduceWithinBlocks(self, axis, operations, percentiles, progress):
+        """Reduce an axis that is complete in each block of focal planes"""
+        cube = self.cube
+        shape = self.getShape()
+        results = {}
+        for operation in operations:
+            results[operation] = numpy.zeros(shape, dtype=numpy.float64)
+        for line, block in cube.iterFocalPlaneBlocks():
+            end = line + block.shape[0]
+            data = block.astype(numpy.float64)
+            ordered = None
+            for operation in operations:
+                if operation in percentiles:
+                    if ordered is None:
+                        ordered = numpy.sort(data, axis=axis)
+                    value = self.getSortedPercentile(ordered, percentiles[operation], axis)
+                elif operation == 'mean':
+                    value = data.mean(axis=axis)
+                elif operation == 'variance':
+                    value = data.var(axis=axis)
+                elif operation == 'stddev':
+                    value = data.std(axis=axis)
+                elif operation == 'minimum':
+                    value = data.min(axis=axis)
+                else:
+                    value = data.max(axis=axis)
+                results[operation][line:end, :] = value
+            if progress:
+                progress((end * 100) / max(cube.lines, 1))
+        return results
+
+    def getSortedPercentile(self, ordered, percent, axis):
+        """Return the percentile of data that is sorted along the axis.
+
+        Values are linearly interpolated between the two nearest ranks like
+        numpy.percentile, which isn't available in older versions of numpy.
+        """
+        count = ordered.shape[axis]
+        rank = (count - 1) * percent / 100.0
+        below = int(numpy.floor(rank))
+        above = min(below + 1, count - 1)
+        fraction = rank - below
+        value = numpy.take(ordered, below, axis=axis)
+        if fraction > 0.0:
+            value = value + (numpy.take(ordered, above, axis=axis) - value) * fraction
+        return value
+
+    def reduceLines(self, operations, percentiles, progress):
+        """Reduce over the lines, combining the results of each block"""
+        cube = self.cube
+        shape = self.getShape()
+        size = shape[0] * shape[1]
+        count = 0
+        minimum = numpy.zeros(size, dtype=numpy.float64)
+        maximum = numpy.zeros(size, dtype=numpy.float64)
+        mean = numpy.zeros(size, dtype=numpy.float64)
+        m2 = numpy.zeros(size, dtype=numpy.float64)
+        if percentiles:
+            self.counts = numpy.zeros((size, self.bins), dtype=numpy.int32)
+            self.lo = numpy.zeros(size, dtype=numpy.float64)
+            self.width = numpy.zeros(size, dtype=numpy.float64)
+        for line, block in cube.iterFocalPlaneBlocks():
+            n = block.shape[0]
+            if n == 0:
+                continue
+            data = block.reshape(n, size).astype(numpy.float64)
+            bmin = data.min(axis=0)
+            bmax = data.max(axis=0)
+            bmean = data.mean(axis=0)
+            diff = data - bmean
+            bm2 = (diff * diff).sum(axis=0)
+            total = count + n
+            if count == 0:
+                minimum[:] = bmin
+                maximum[:] = bmax
+                mean[:] = bmean
+                m2[:] = bm2
+                if percentiles:
+                    self.initHistogram(bmin, bmax)
+            else:
+                numpy.minimum(minimum, bmin, minimum)
+                numpy.maximum(maximum, bmax, maximum)
+                delta = bmean - mean
+                mean += delta * (float(n) / total)
+                m2 += bm2 + delta * delta * (float(count) * n / total)
+                if percentiles:
+                    self.expandHistogram(bmin, bmax)
+            if percentiles:
+                self.addToHistogram(data)
+            count = total
+            if progress:
+                progress(((line + n) * 100) / max(cube.lines, 1))
+
+        results = {}
+        for operation in operations:
+            if operation in percentiles:
+                value = self.getHistogramPercentile(percentiles[operation], count, minimum, maximum)
+            elif operation == 'mean':
+                value = mean
+            elif operation == 'variance':
+                value = m2 / max(count, 1)
+            elif operation == 'stddev':
+                value = numpy.sqrt(m2 / max(count, 1))
+            elif operation == 'minimum':
+                value = minimum
+            else:
+                value = maximum
+            results[operation] = value.reshape(shape).copy()
+        return results
+
+    def initHistogram(self, vmin, vmax):
+        self.lo[:] = vmin
+        if self.integer:
+            # integer values are placed in the bin containing [v, v+1)
+            width = (vmax - vmin + 1.0) / self.bins
+        else:
+            width = (vmax - vmin) / self.bins
+        self.width[:] = numpy.where(width > 0.0, width, 1.0 / self.bins)
+
+    def expandHistogram(self, vmin, vmax):
+        """Double the bin width of each histogram until its range covers
+        vmin to vmax"""
+        half = self.bins / 2
+        if self.integer:
+            vmax = vmax + 1.0
+        while True:
+            which = numpy.nonzero(vmax > self.lo + self.bins * self.width)[0]
+            if len(which) == 0:
+                break
+            counts = self.counts[which]
+            merged = counts.reshape(len(which), half, 2).sum(axis=2)
+            counts[:, :half] = merged
+            counts[:, half:] = 0
+            self.counts[which] = counts
+            self.width[which] *= 2.0
+        while True:
+            which = numpy.nonzero(vmin < self.lo)[0]
+            if len(which) == 0:
+                break
+            counts = self.counts[which]
+            merged = counts.reshape(len(which), half, 2).sum(axis=2)
+            counts[:, half:] = merged
+            counts[:, :half] = 0
+            self.counts[which] = counts
+            self.lo[which] -= self.bins * self.width[which]
+            self.width[which] *= 2.0
+
+    def addToHistogram(self, data):
+        """Add a (lines x elements) array to the histograms"""
+        flat = self.counts.reshape(-1)
+        offset = numpy.arange(data.shape[1]) * self.bins
+        for row in data:
+            index = numpy.floor((row - self.lo) / self.width).astype(numpy.int32)
+            numpy.clip(index, 0, self.bins - 1, index)
+            # Each line holds one value of every element, so the indexes are
+            # unique and can be incremented without bincount
+            flat[offset + index] += 1
+
+    def getHistogramPercentile(self, percent, count, minimum, maximum):
+        """Estimate the percentile of each element by interpolating within
+        the histogram bin that contains it"""
+        cumulative = self.counts.cumsum(axis=1)
+        target = count * percent / 100.0
+        index = (cumulative < target).sum(axis=1)
+        numpy.clip(index, 0, self.bins - 1, index)
+        rows = numpy.arange(len(index))
+        below = numpy.where(index > 0, cumulative[rows, index - 1], 0)
+        inbin = self.counts[rows, index]
+        fraction = (target - below) / numpy.where(inbin > 0, inbin, 1)
+        numpy.clip(fraction, 0.0, 1.0, fraction)
+        value = self.lo + (index + fraction) * self.width
+        if self.integer:
+            # the bin of v covers [v, v+1), so the last value is one less
+            value = numpy.floor(value)
+        return numpy.clip(value, minimum, maximum)
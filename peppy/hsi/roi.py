@@ -69,6 +69,29 @@ class ROISpectrum(object):
                                  wavelengths, spectra, self.bbl)
         return (sam, dist)
 
+class ROIStatistics(object):
+    """Per-band statistics of the spectra in a region of interest.
+
+    All statistics are calculated at once from the (points x bands) array
+    of spectra, resulting in arrays of (bands) for the mean, the standard
+    deviation, and the minimum and maximum envelope.
+    """
+    def __init__(self, spectra):
+        self.count = spectra.shape[0]
+        if self.count > 0:
+            values = spectra.astype(numpy.float64)
+            self.mean = values.mean(axis=0)
+            self.stddev = values.std(axis=0)
+            self.minimum = values.min(axis=0)
+            self.maximum = values.max(axis=0)
+        else:
+            empty = numpy.zeros(spectra.shape[1], dtype=numpy.float64)
+            self.mean = self.stddev = self.minimum = self.maximum = empty
+
+    def __str__(self):
+        return "count=%d mean=%s stddev=%s min=%s max=%s" % (self.count, str(self.mean), str(self.stddev), str(self.minimum), str(self.maximum))
+
+
 class ROI(object):
     def __init__(self, name):
         self.name = name
@@ -96,28 +119,39 @@ class ROI(object):
         self.points.append((x, y))
 
     def getSpectra(self, cube):
-        for i in self.points:
+        for i, spectra in zip(self.points, self.getSpectraArray(cube)):
             print i
-            spectra = cube.getSpectra(i[1],i[0])
             print spectra
 
+    def getPointArrays(self):
+        """Return the points as a tuple of (line array, sample array)"""
+        points = numpy.asarray(self.points, dtype=numpy.int64).reshape(-1, 2)
+        return points[:, 1], points[:, 0]
+
+    def getSpectraArray(self, cube):
+        """Return the spectra of all the points as an array of (points x
+        bands), gathered from the cube in a single bulk read"""
+        lines, samples = self.getPointArrays()
+        return cube.getSpectraAtPoints(lines, samples)
+
+    def getStatistics(self, cube):
+        """Return the L{ROIStatistics} of the spectra of all the points"""
+        return ROIStatistics(self.getSpectraArray(cube))
+
     def getAllColumns(self, cube):
         cols = []
+        spectra = self.getSpectraArray(cube) / 10000.0
         for i in range(len(self.points)):
             label = '%s-%s' % (self.name, self.labels[i])
-            spectra = cube.getSpectra(self.points[i][1],self.points[i][0])/10000.0
-            col = ROISpectrum(label, self.color, spectra, cube)
+            col = ROISpectrum(label, self.color, spectra[i], cube)
             cols.append(col)
         #print cols
         return cols
 
     def getAverageOfColumns(self, cube):
         cols = []
-        total = cube.getSpectra(self.points[0][1],self.points[0][0]).astype(numpy.float32)
-        for i in range(1,len(self.points),1):
-            total += cube.getSpectra(self.points[i][1],self.points[i][0])
-        total /= len(self.points)
-        total /= 10000.0
+        stats = self.getStatistics(cube)
+        total = (stats.mean / 10000.0).astype(numpy.float32)
         label = '%s-%s-%s' % (self.name, self.labels[0], self.labels[-1])
         col = ROISpectrum(label, self.color, total, cube)
         cols.append(col)
@@ -0,0 +1,249 @@
+# peppy Copyright (c) 2006-2010 Rob McMullen
+# Licenced under the GPLv2; see http://peppy.flipturn.org for more info
+"""Spectrum-ordered copies of BSQ cubes.
+
+Reading a spectrum from a BSQ cube that isn't memory mapped requires a seek
+into every band, which is too slow to follow the mouse in the spectrum plot.
+The L{SpectralShadow} is a BIP ordered copy of the cube that is built in a
+background thread and saved in a size limited cache directory.  Once it is
+ready, the cube reads its spectra from the copy, where each spectrum is
+contiguous.
+"""
+
+import os, threading, hashlib, glob
+
+import numpy
+
+from peppy.debug import *
+from peppy.hsi.stats import StatsCache
+
+
+class SpectralShadow(debugmixin):
+    """BIP ordered copy of a BSQ cube used for spectra lookups.
+
+    The copy is stored in the byte order of the cube in L{cache_dir}, named
+    after the L{StatsCache} key of the data file, along with a key file
+    holding the key itself.  The copy is rebuilt if the data file changes.
+    It is memory mapped once it is complete, so lookups don't use the cube's
+    file reader at all.
+
+    The total size of the copies is limited to L{max_bytes}; the least
+    recently used copies are deleted to make room for a new one, and cubes
+    larger than the limit aren't copied at all.
+    """
+    #: Directory used to store the copies, or None to disable them
+    cache_dir = None
+
+    #: Maximum total size in bytes of the copies in the cache directory
+    max_bytes = 2 * 1024 * 1024 * 1024
+
+    #: Suffix of the file names of the copies
+    suffix = ".spectra"
+
+    #: Memory budget in bytes of each block of lines read from the cube, or
+    #: None to use the budget of the cube
+    block_bytes = None
+
+    def __init__(self, cube):
+        self.cube = cube
+        self.data = None
+        self.thread = None
+        self.stopping = False
+
+    @classmethod
+    def isUseful(cls, cube):
+        """Is it worthwhile to build a copy of this cube?
+
+        Only BSQ cubes read through the file reader benefit; other
+        interleaves and memory mapped cubes can already return spectra
+        quickly.
+        """
+        return cls.cache_dir is not None and \
+               cube is not None and cube.url is not None and \
+               cube.url.scheme == 'file' and cube.interleave == 'bsq' and \
+               cube.bands > 1 and cube.cube_io is not None and \
+               cube.cube_io.use_tile_cache
+
+    def getFilename(self):
+        name = hashlib.md5(self.getKey()).hexdigest()
+        return os.path.join(self.cache_dir, name + self.suffix)
+
+    def getSize(self):
+        cube = self.cube
+        return cube.lines * cube.samples * cube.bands * cube.getDtype().itemsize
+
+    @classmethod
+    def makeRoom(cls, needed):
+        """Delete the least recently used copies until there is room for
+        another copy of the given size
+        """
+        copies = []
+        total = 0
+        for filename in glob.glob(os.path.join(cls.cache_dir, "*" + cls.suffix)):
+            try:
+                size = os.path.getsize(filename)
+                copies.append((os.path.getmtime(filename), filename, size))
+                total += size
+            except OSError:
+                pass
+        copies.sort()
+        for mtime, filename, size in copies:
+            if total + needed <= cls.max_bytes:
+                break
+            cls.dprint("removing %s" % filename)
+            for name in [filename, filename + ".key"]:
+                if os.path.exists(name):
+                    os.remove(name)
+            total -= size
+
+    def getKey(self):
+        """Return the text identifying the data file, or None"""
+        key = StatsCache.getKey(self.cube)
+        if key is None:
+            return None
+        return "|".join(key)
+
+    def isReady(self):
+        return self.data is not None
+
+    def open(self):
+        """Memory map the copy if it exists and matches the data file
+
+        @return: True if the copy is ready to use
+        """
+        key = self.getKey()
+        if key is None or self.cache_dir is None:
+            return False
+        filename = self.getFilename()
+        keyfile = filename + ".key"
+        cube = self.cube
+        if not os.path.exists(filename) or not os.path.exists(keyfile):
+            return False
+        try:
+            if open(keyfile).read() != key:
+                return False
+            dtype = cube.getDtype()
+            if os.path.getsize(filename) != self.getSize():
+                return False
+            self.data = numpy.memmap(filename, dtype=dtype, mode='r',
+                                     shape=(cube.lines, cube.samples, cube.bands))
+            # mark as recently used so it's the last to be removed
+            os.utime(filename, None)
+        except (IOError, OSError), e:
+            self.dprint("Can't open %s: %s" % (filename, e))
+            return False
+        return True
+
+    def build(self, reader=None, progress=None):
+        """Write the BIP copy of the cube and open it
+
+        The copy is written to a temporary file that is renamed when
+        complete, so an interrupted build never leaves a partial copy that
+        looks valid.
+
+        @param reader: optional cube reader used in place of the cube's own
+        reader, for instance when building in a background thread
+
+        @param progress: optional callable taking the percent complete
+
+        @return: True if the copy was built and is ready to use
+        """
+        cube = self.cube
+        if reader is None:
+            reader = cube.cube_io
+        key = self.getKey()
+        if key is None or self.cache_dir is None:
+            return False
+        size = self.getSize()
+        if size > self.max_bytes:
+            self.dprint("%s is too large to copy" % cube.url)
+            return False
+        filename = self.getFilename()
+        temp = filename + ".tmp"
+        dtype = cube.getDtype()
+        block_lines = cube.getLinesPerBlock(cube.samples * cube.bands * cube.itemsize, self.block_bytes)
+        try:
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            self.makeRoom(size)
+            fh = open(temp, "wb")
+            try:
+                line = 0
+                while line < cube.lines:
+                    if self.stopping:
+                        break
+                    end = min(line + block_lines, cube.lines)
+                    block = reader.getFocalPlanesRaw(line, end).transpose(0, 2, 1)
+                    fh.write(numpy.asarray(block, dtype=dtype).tostring())
+                    line = end
+                    if progress:
+                        progress((line * 100) / cube.lines)
+            finally:
+                fh.close()
+            if self.stopping:
+                os.remove(temp)
+                return False
+            if os.path.exists(filename):
+                os.remove(filename)
+            os.rename(temp, filename)
+            fh = open(filename + ".key", "w")
+            fh.write(key)
+            fh.close()
+        except (IOError, OSError), e:
+            self.dprint("Can't build %s: %s" % (filename, e))
+            if os.path.exists(temp):
+                os.remove(temp)
+            return False
+        return self.open()
+
+    def start(self):
+        """Use the saved copy if it is current, otherwise start building it
+        in a background thread.
+
+        The thread uses its own cube reader so that the file position isn't
+        shared with the GUI thread.
+        """
+        if self.open() or self.thread is not None:
+            return
+        self.stopping = False
+        self.thread = threading.Thread(target=self.run, name="HSI spectral copy")
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def run(self):
+        cube = self.cube
+        reader = None
+        try:
+            try:
+                reader = cube.cube_io.__class__(cube, cube.url)
+                self.build(reader)
+            except Exception, e:
+                dprint("Failed building spectral copy of %s: %s" % (cube.url, e))
+        finally:
+            if reader is not None and hasattr(reader, 'fh'):
+                reader.fh.close()
+            self.thread = None
+
+    def stop(self):
+        """Stop the background thread, discarding a partially built copy"""
+        self.stopping = True
+        thread = self.thread
+        if thread is not None:
+            thread.join()
+
+    def getSpectraRaw(self, line, sample):
+        """Get the spectra at the given pixel"""
+        return self.data[line, sample, :]
+
+    def getSpectraAtPointsRaw(self, lines, samples):
+        """Get an array of (points x bands) of the spectra at many pixels"""
+        return self.data[lines, samples, :]
+
+
+def startInBackground(cube):
+    """Attach a L{SpectralShadow} to the cube if it would be useful and start
+    building it if it isn't already available.
+    """
+    if cube.spectral_shadow is None and SpectralShadow.isUseful(cube):
+        cube.spectral_shadow = SpectralShadow(cube)
+        cube.spectral_shadow.start()
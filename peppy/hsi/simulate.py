@@ -64,8 +64,9 @@ class SimulatedCube(debugmixin):
     def resampleSpectra(self, spectra):
         #dprint(spectra.wavelengths)
         #dprint(self.cube.wavelengths)
-        values = HSI.resampleSingle(self.cube.wavelengths,
-                                    spectra.wavelengths, spectra.values, self.cube.bbl)
+        resampler = HSI.SpectralResampler.getResampler(spectra.wavelengths,
+                                                       self.cube.wavelengths, spectra.bbl)
+        values = resampler.resample(numpy.asarray(spectra.values, dtype=numpy.float64)).tolist()
         #dprint(values)
         #dprint("Number of values: %d" % len(values))
         s = Spectra()
@@ -0,0 +1,359 @@
+# peppy Copyright (c) 2006-2010 Rob McMullen
+# Licenced under the GPLv2; see http://peppy.flipturn.org for more info
+"""Per-band statistics of hyperspectral cubes.
+
+The statistics of each band -- minimum, maximum, mean, standard deviation and
+a histogram -- are calculated in a single streaming pass through the cube
+and saved to a sidecar file so that they don't have to be calculated again
+the next time the cube is opened.
+"""
+
+import os, hashlib, threading
+
+import numpy
+
+import peppy.vfs as vfs
+from peppy.debug import *
+
+
+class BandSummary(object):
+    """Statistics of a single band, or of a plane derived from a band.
+
+    Only the extrema are required; the histogram is optional and is only
+    available when the summary comes directly from L{BandStatistics}.
+    """
+    def __init__(self, minimum, maximum, counts=None, lo=None, width=None):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.counts = counts
+        self.lo = lo
+        self.width = width
+
+    def getExtrema(self):
+        return (self.minimum, self.maximum)
+
+    def hasHistogram(self):
+        return self.counts is not None
+
+    def getStretchRange(self, fraction):
+        """Return the range of values after removing the given fraction of
+        pixels from each end of the histogram.
+
+        The returned values are the lower edges of the histogram bins,
+        matching the calculation used in L{ContrastFilter}.
+        """
+        cumulative = self.counts.cumsum()
+        total = cumulative[-1]
+        bins = len(self.counts)
+        lo_count = total * fraction
+        hi_count = total * (1.0 - fraction)
+        if lo_count > 0:
+            i = min(numpy.searchsorted(cumulative, lo_count, side='left') + 1, bins - 1)
+        else:
+            i = 0
+        j = max(numpy.searchsorted(cumulative, hi_count, side='right') - 1, 0)
+        minscaled = max(self.lo + i * self.width, self.minimum)
+        maxscaled = min(self.lo + j * self.width, self.maximum)
+        return (minscaled, maxscaled)
+
+
+class BandStatistics(debugmixin):
+    """Streaming calculation of per-band statistics.
+
+    Data is added in blocks of (lines x bands x samples) as returned by
+    L{Cube.getFocalPlanesRaw}.  The mean and variance are combined between
+    blocks using the parallel algorithm of Chan et al., and the histogram of
+    each band uses a fixed number of bins whose width doubles whenever new
+    data falls outside the current range, so the data only has to be read
+    once.
+    """
+    #: Number of histogram bins; must be even so bins can be merged in pairs
+    bins = 256
+
+    def __init__(self, bands, integer=True):
+        self.bands = bands
+        self.integer = integer
+        self.count = 0
+        self.minimum = numpy.zeros(bands, dtype=numpy.float64)
+        self.maximum = numpy.zeros(bands, dtype=numpy.float64)
+        self.mean = numpy.zeros(bands, dtype=numpy.float64)
+        self.m2 = numpy.zeros(bands, dtype=numpy.float64)
+        self.counts = numpy.zeros((bands, self.bins), dtype=numpy.int64)
+        self.lo = numpy.zeros(bands, dtype=numpy.float64)
+        self.width = numpy.zeros(bands, dtype=numpy.float64)
+
+    @classmethod
+    def fromCube(cls, cube, reader=None, progress=None):
+        """Calculate the statistics of every band of the cube.
+
+        @param cube: L{Cube} instance
+
+        @param reader: optional cube reader used in place of the cube's own
+        reader, for instance when the calculation is performed in a
+        background thread
+
+        @param progress: optional callable taking the percent complete
+        """
+        if reader is None:
+            reader = cube.cube_io
+        integer = numpy.issubdtype(cube.data_type, numpy.integer)
+        stats = cls(cube.bands, integer)
+        block_lines = cube.getLinesPerBlock(cube.samples * cube.bands * cube.itemsize)
+        line = 0
+        while line < cube.lines:
+            end = min(line + block_lines, cube.lines)
+            stats.addBlock(reader.getFocalPlanesRaw(line, end))
+            line = end
+            if progress:
+                progress((line * 100) / cube.lines)
+        return stats
+
+    def addBlock(self, block):
+        """Add a block of (lines x bands x samples) data to the statistics"""
+        n = block.shape[0] * block.shape[2]
+        if n == 0:
+            return
+        total = self.count + n
+        for band in range(self.bands):
+            data = block[:, band, :].astype(numpy.float64)
+            bmin = data.min()
+            bmax = data.max()
+            bmean = data.mean()
+            diff = data - bmean
+            bm2 = (diff * diff).sum()
+            if self.count == 0:
+                self.minimum[band] = bmin
+                self.maximum[band] = bmax
+                self.mean[band] = bmean
+                self.m2[band] = bm2
+                self.initHistogram(band, bmin, bmax)
+            else:
+                self.minimum[band] = min(self.minimum[band], bmin)
+                self.maximum[band] = max(self.maximum[band], bmax)
+                delta = bmean - self.mean[band]
+                self.mean[band] += delta * n / total
+                self.m2[band] += bm2 + delta * delta * self.count * n / total
+                self.expandHistogram(band, bmin, bmax)
+            self.addToHistogram(band, data)
+        self.count = total
+
+    def initHistogram(self, band, vmin, vmax):
+        self.lo[band] = vmin
+        if self.integer:
+            # integer values are placed in the bin containing [v, v+1)
+            width = (vmax - vmin + 1.0) / self.bins
+        else:
+            width = (vmax - vmin) / self.bins
+        if width <= 0.0:
+            width = 1.0 / self.bins
+        self.width[band] = width
+
+    def expandHistogram(self, band, vmin, vmax):
+        """Double the bin width until the range covers vmin to vmax"""
+        half = self.bins / 2
+        counts = self.counts[band]
+        if self.integer:
+            vmax += 1.0
+        while vmax > self.lo[band] + self.bins * self.width[band]:
+            merged = counts.reshape(half, 2).sum(axis=1)
+            counts[:half] = merged
+            counts[half:] = 0
+            self.width[band] *= 2.0
+        while vmin < self.lo[band]:
+            merged = counts.reshape(half, 2).sum(axis=1)
+            counts[half:] = merged
+            counts[:half] = 0
+            self.lo[band] -= self.bins * self.width[band]
+            self.width[band] *= 2.0
+
+    def addToHistogram(self, band, data):
+        index = numpy.floor((data.ravel() - self.lo[band]) / self.width[band]).astype(numpy.int32)
+        numpy.clip(index, 0, self.bins - 1, index)
+        counts = numpy.bincount(index)
+        self.counts[band, 0:len(counts)] += counts
+
+    def getStdDev(self):
+        """Return an array of the standard deviation of each band"""
+        if self.count == 0:
+            return numpy.zeros(self.bands, dtype=numpy.float64)
+        return numpy.sqrt(self.m2 / self.count)
+    stddev = property(getStdDev)
+
+    def getCubeExtrema(self):
+        """Return a tuple of the minimum and maximum of the whole cube"""
+        return (self.minimum.min(), self.maximum.max())
+
+    def getBandSummary(self, band):
+        """Return a L{BandSummary} for the given band"""
+        return BandSummary(self.minimum[band], self.maximum[band],
+                           self.counts[band], self.lo[band], self.width[band])
+
+    def getHistogram(self, band):
+        """Return a tuple of counts and bin edges for the given band, like
+        numpy.histogram
+        """
+        edges = self.lo[band] + numpy.arange(self.bins + 1) * self.width[band]
+        return self.counts[band], edges
+
+    def save(self, filename, key):
+        """Save the statistics along with the key that identifies the source
+        file
+        """
+        fh = open(filename, 'wb')
+        try:
+            numpy.savez(fh, key=numpy.array(key), count=numpy.array(self.count),
+                        integer=numpy.array(self.integer),
+                        minimum=self.minimum, maximum=self.maximum,
+                        mean=self.mean, m2=self.m2, counts=self.counts,
+                        lo=self.lo, width=self.width)
+        finally:
+            fh.close()
+
+    @classmethod
+    def load(cls, filename, key):
+        """Load the statistics from a file, returning None if the key
+        doesn't match the key used when the file was saved.
+        """
+        data = numpy.load(filename)
+        try:
+            if list(data['key']) != list(key):
+                return None
+            if data['counts'].shape[1] != cls.bins:
+                return None
+            stats = cls(len(data['minimum']), bool(data['integer']))
+            stats.count = int(data['count'])
+            for name in ['minimum', 'maximum', 'mean', 'm2', 'counts', 'lo', 'width']:
+                setattr(stats, name, data[name])
+            return stats
+        finally:
+            if hasattr(data, 'close'):
+                data.close()
+
+
+class StatsCache(debugmixin):
+    """Sidecar storage of L{BandStatistics}.
+
+    Statistics are stored in L{cache_dir}, one file per data cube, and are
+    keyed on the path, size and modification time of the data file so that
+    stale statistics are ignored after the file changes.  If no cache
+    directory is set, statistics are not saved.
+    """
+    #: Directory used to store the sidecar files, or None to disable
+    cache_dir = None
+
+    @classmethod
+    def getKey(cls, cube):
+        """Return the key identifying the data of the cube, or None if the
+        cube isn't backed by a file that can be identified.
+        """
+        if cube.url is None:
+            return None
+        try:
+            size = vfs.get_size(cube.url)
+            mtime = vfs.get_mtime(cube.url)
+        except Exception, e:
+            cls.dprint("can't identify %s: %s" % (cube.url, e))
+            return None
+        # Different cubes can share the same file (e.g.  multiple cubes in a
+        # FITS or NITF file), so the data offset is part of the key as well.
+        return (str(cube.url), str(size), str(mtime), str(cube.data_offset))
+
+    @classmethod
+    def getFilename(cls, key):
+        name = hashlib.md5("|".join(key)).hexdigest()
+        return os.path.join(cls.cache_dir, "%s.npz" % name)
+
+    @classmethod
+    def load(cls, cube):
+        """Return the saved statistics of the cube, or None if not available"""
+        if cls.cache_dir is None:
+            return None
+        key = cls.getKey(cube)
+        if key is None:
+            return None
+        filename = cls.getFilename(key)
+        if not os.path.exists(filename):
+            return None
+        try:
+            stats = BandStatistics.load(filename, key)
+        except Exception, e:
+            cls.dprint("failed loading %s: %s" % (filename, e))
+            return None
+        if stats is not None and stats.bands != cube.bands:
+            return None
+        return stats
+
+    @classmethod
+    def save(cls, cube, stats):
+        """Save the statistics of the cube if the cache directory is set"""
+        if cls.cache_dir is None:
+            return
+        key = cls.getKey(cube)
+        if key is None:
+            return
+        filename = cls.getFilename(key)
+        try:
+            if not os.path.exists(cls.cache_dir):
+                os.makedirs(cls.cache_dir)
+            stats.save(filename, key)
+        except Exception, e:
+            cls.dprint("failed saving %s: %s" % (filename, e))
+
+
+class StatisticsThread(threading.Thread):
+    """Background calculation of the statistics of a cube.
+
+    Readers that access the file directly get their own reader instance so
+    that the file position isn't shared with the GUI thread.
+    """
+    pending = {}
+    lock = threading.Lock()
+
+    def __init__(self, cube):
+        threading.Thread.__init__(self, name="HSI statistics")
+        self.setDaemon(True)
+        self.cube = cube
+
+    def run(self):
+        cube = self.cube
+        reader = None
+        try:
+            try:
+                if cube.cube_io.use_tile_cache:
+                    reader = cube.cube_io.__class__(cube, cube.url)
+                cube.getStatistics(reader=reader)
+            except Exception, e:
+                dprint("Failed calculating statistics of %s: %s" % (cube.url, e))
+        finally:
+            if reader is not None and hasattr(reader, 'fh'):
+                reader.fh.close()
+            self.lock.acquire()
+            try:
+                del self.pending[id(cube)]
+            finally:
+                self.lock.release()
+
+
+def calculateInBackground(cube):
+    """Make sure the statistics of the cube are available, calculating them
+    in a background thread if they aren't already in the sidecar cache.
+
+    @return: True if the statistics are available now, False if they are
+    being calculated or can't be calculated in the background
+    """
+    if cube.getStatistics(compute=False) is not None:
+        return True
+    cube_io = cube.cube_io
+    if not cube_io.use_tile_cache and getattr(cube_io, 'mmap', None) is None:
+        # Only file readers (which get a private copy of the reader) and
+        # memory mapped files can be safely read from another thread
+        return False
+    StatisticsThread.lock.acquire()
+    try:
+        if id(cube) not in StatisticsThread.pending:
+            thread = StatisticsThread(cube)
+            StatisticsThread.pending[id(cube)] = thread
+            thread.start()
+    finally:
+        StatisticsThread.lock.release()
+    return False
@@ -107,6 +107,27 @@ class SubCubeReader(HSI.CubeReader):
         s=self.parent.getFocalPlaneRaw(self.l1 + line)[self.b1:self.b2, self.s1:self.s2]
         return s
 
+    def getFocalPlanesRaw(self, line1, line2):
+        """Get the (lines x bands x samples) slice of the data array for a
+        range of lines.
+        """
+        s=self.parent.getFocalPlanesRaw(self.l1 + line1, self.l1 + line2)[:, self.b1:self.b2, self.s1:self.s2]
+        return s
+
+    def getBandLinesRaw(self, band, line1, line2):
+        """Get the (lines x samples) slice of the data array for a range of
+        lines of the specified band.
+        """
+        s=self.parent.getBandLinesRaw(self.b1 + band, self.l1 + line1, self.l1 + line2)[:, self.s1:self.s2]
+        return s
+
+    def getBandsRaw(self, band1, band2):
+        """Get the (bands x lines x samples) slice of the data array for a
+        range of bands.
+        """
+        s=self.parent.getBandsRaw(self.b1 + band1, self.b1 + band2)[:, self.l1:self.l2, self.s1:self.s2]
+        return s
+
     def getFocalPlaneDepthRaw(self, sample, band):
         """Get the slice of the data array through the cube at the specified
         sample and band.  This points to the actual in-memory array.
@@ -120,6 +141,11 @@ class SubCubeReader(HSI.CubeReader):
         spectra=self.parent.getSpectraRaw(self.l1 + line, self.s1 + sample)[self.b1:self.b2]
         return spectra
 
+    def getSpectraAtPointsRaw(self, lines, samples):
+        """Get an array of (points x bands) of the spectra at many pixels"""
+        spectra=self.parent.getSpectraAtPointsRaw(self.l1 + lines, self.s1 + samples)[:, self.b1:self.b2]
+        return spectra
+
     def getLineOfSpectraCopy(self,line):
         """Get the all the spectra along the given line.  Calculate
         the extrema as we go along."""
@@ -0,0 +1,255 @@
+# peppy Copyright (c) 2006-2010 Rob McMullen
+# Licenced under the GPLv2; see http://peppy.flipturn.org for more info
+"""Out-of-core conversion of cubes between interleaves.
+
+Converting a cube between BIP, BIL and BSQ one band or one focal plane at a
+time is very slow for file-backed cubes, because every band of a BIP or BIL
+file is spread across the entire file.  The L{InterleaveTransposer} instead
+reads large blocks of lines at once, rearranges them in memory, and writes
+the output interleave in long sequential runs.  The amount of memory used is
+limited by L{InterleaveTransposer.max_bytes}.
+"""
+
+from cStringIO import OutputType
+
+import numpy
+
+from peppy.debug import *
+
+
+def writeBuffer(fh, array):
+    """Write a contiguous array to the file handle without copying it.
+
+    Python file objects and cStringIO copy the data out of the buffer
+    immediately, so they can be handed the array's memory directly.  Other
+    file-like objects may hold on to the object passed to write, so they get
+    a string copy instead because the array may be reused.
+    """
+    if isinstance(fh, (file, OutputType)):
+        fh.write(buffer(array))
+    else:
+        fh.write(array.tostring())
+
+
+class InterleaveTransposer(debugmixin):
+    """Convert the data of a cube into a different interleave in blocks.
+
+    The source cube is read in blocks of lines using
+    L{Cube.iterFocalPlaneBlocks} (or in whole bands using
+    L{Cube.iterBandBlocks} if both the source and destination are BSQ).  BIP
+    and BIL output is produced sequentially from a single pass through the
+    source.  BSQ output from a BIP or BIL source is written in a single pass
+    if the output file handle is seekable, with each band of a block written
+    as a contiguous run at its final location.  Otherwise, the output bands
+    are built in groups that fit in memory, needing one pass over the source
+    for each group.
+    """
+    #: Memory budget in bytes for the blocks held in memory at once
+    max_bytes = 64 * 1024 * 1024
+
+    #: Size in bytes of the scratch array used to rearrange or byte swap data
+    #: before it is written
+    write_bytes = 4 * 1024 * 1024
+
+    def __init__(self, cube, interleave=None, max_bytes=None):
+        """Create the transposer.
+
+        @param cube: source L{Cube}
+
+        @param interleave: output interleave, one of 'bip', 'bil' or 'bsq'.
+        Defaults to the interleave of the source cube.
+
+        @param max_bytes: optional override of the memory budget
+        """
+        self.cube = cube
+        if interleave is None:
+            interleave = cube.interleave
+        self.interleave = interleave.lower()
+        if self.interleave not in ['bip', 'bil', 'bsq']:
+            raise ValueError("Unknown interleave %s" % interleave)
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+        self.itemsize = cube.itemsize
+        self.scratch = None
+
+    def getLinesPerBlock(self):
+        """Number of whole lines of the cube that fit within the budget.
+
+        Half of the budget is used for each block, because the next block is
+        read while the current one is being converted.
+        """
+        line_bytes = self.cube.samples * self.cube.bands * self.itemsize
+        return self.cube.getLinesPerBlock(line_bytes, self.max_bytes / 2)
+
+    def getBandsPerGroup(self):
+        """Number of whole bands of the cube that fit within the budget"""
+        band_bytes = self.cube.samples * self.cube.lines * self.itemsize
+        count = max(self.max_bytes / max(band_bytes, 1), 1)
+        return min(count, self.cube.bands)
+
+    def isSourceBSQ(self):
+        return self.cube.interleave.lower() == 'bsq'
+
+    def getNumPasses(self, seekable=False):
+        """Return the number of passes needed through the source data"""
+        if self.interleave == 'bsq' and not self.isSourceBSQ() and not seekable:
+            groups = self.getBandsPerGroup()
+            return (self.cube.bands + groups - 1) / groups
+        return 1
+
+    def iterLineBlocks(self):
+        """Iterate over the source in blocks of lines.
+
+        File-backed cubes read the next block in the background while the
+        current block is converted and written.
+
+        @return: tuple of (first line of block, array) where the array is
+        (lines x bands x samples)
+        """
+        return self.cube.iterFocalPlaneBlocks(self.getLinesPerBlock())
+
+    def iterScattered(self):
+        """Iterate over the output data in pieces that may not be in file
+        order.
+
+        Each piece is a tuple of (item offset, array) where item offset is
+        the location of the first element of the array within the output
+        data (in units of items, not bytes), and array is the data in the
+        order in which it should be written.  Only BSQ output from a BIP or
+        BIL source produces non-sequential offsets.
+        """
+        if self.interleave != 'bsq' or self.isSourceBSQ():
+            offset = 0
+            for piece in self.iterSequential():
+                yield offset, piece
+                offset += piece.size
+            return
+
+        lines = self.cube.lines
+        samples = self.cube.samples
+        band_size = lines * samples
+        for line, block in self.iterLineBlocks():
+            for band in range(self.cube.bands):
+                yield (band * band_size) + (line * samples), block[:, band, :]
+
+    def iterSequential(self):
+        """Iterate over the output data in file order.
+
+        @return: arrays whose elements, in C order, are the next items of the
+        output interleave
+        """
+        if self.interleave == 'bsq':
+            if self.isSourceBSQ():
+                count = max(self.getBandsPerGroup() / 2, 1)
+                for band, group in self.cube.iterBandBlocks(count):
+                    yield group
+            else:
+                for group in self.iterBandGroups():
+                    yield group
+        elif self.interleave == 'bil':
+            for line, block in self.iterLineBlocks():
+                yield block
+        else:
+            for line, block in self.iterLineBlocks():
+                yield block.transpose(0, 2, 1)
+
+    def iterBandGroups(self):
+        """Build groups of complete bands from line blocks of the source.
+
+        Each group requires a full pass through the source cube.
+        """
+        group_size = self.getBandsPerGroup()
+        lines = self.cube.lines
+        samples = self.cube.samples
+        band = 0
+        while band < self.cube.bands:
+            end = min(band + group_size, self.cube.bands)
+            self.dprint("pass for bands %d - %d" % (band, end))
+            group = None
+            for line, block in self.iterLineBlocks():
+                if group is None:
+                    group = numpy.empty((end - band, lines, samples), dtype=block.dtype)
+                group[:, line:line + block.shape[0], :] = block[:, band:end, :].transpose(1, 0, 2)
+            yield group
+            band = end
+
+    def isSeekable(self, fh):
+        """Check whether the file handle supports random access writes"""
+        if not hasattr(fh, 'seek') or not hasattr(fh, 'tell'):
+            return False
+        try:
+            fh.tell()
+        except Exception:
+            return False
+        return True
+
+    def getScratch(self, dtype, count):
+        """Return a reusable 1D array of count items of the given dtype"""
+        nbytes = count * dtype.itemsize
+        if self.scratch is None or self.scratch.nbytes < nbytes:
+            self.scratch = numpy.empty(nbytes, dtype=numpy.uint8)
+        return self.scratch[0:nbytes].view(dtype)
+
+    def writeArray(self, fh, array, endian):
+        """Write an array in C order using the requested byte order.
+
+        Contiguous arrays that are already in the correct byte order are
+        passed to the file handle directly.  Otherwise, the array is copied
+        in pieces into a scratch array of the output dtype, letting numpy
+        perform the transpose and byte swap in a single assignment.
+
+        @param fh: output file handle
+
+        @param array: numpy array of any shape or strides
+
+        @param endian: '<' or '>' representing the desired output endian
+        state
+        """
+        dtype = array.dtype
+        if dtype.byteorder != '|':
+            dtype = dtype.newbyteorder(endian)
+        if array.flags.c_contiguous and dtype == array.dtype:
+            writeBuffer(fh, array)
+            return
+
+        if array.ndim == 0:
+            array = array.reshape(1)
+        rows = array.shape[0]
+        row_items = array.size / max(rows, 1)
+        rows_per_write = max(self.write_bytes / max(row_items * dtype.itemsize, 1), 1)
+        row = 0
+        while row < rows:
+            end = min(row + rows_per_write, rows)
+            piece = array[row:end]
+            scratch = self.getScratch(dtype, piece.size).reshape(piece.shape)
+            scratch[...] = piece
+            writeBuffer(fh, scratch)
+            row = end
+
+    def write(self, fh, endian, progress=None):
+        """Write the data of the cube in the new interleave.
+
+        @param fh: output file handle, positioned at the start of the data
+
+        @param endian: '<' or '>' representing the desired output endian
+        state
+
+        @param progress: optional callable taking the percent complete
+        """
+        total = self.cube.lines * self.cube.samples * self.cube.bands
+        done = 0
+        if self.interleave == 'bsq' and not self.isSourceBSQ() and self.isSeekable(fh):
+            start = fh.tell()
+            for offset, piece in self.iterScattered():
+                fh.seek(start + (offset * self.itemsize))
+                self.writeArray(fh, piece, endian)
+                done += piece.size
+                if progress:
+                    progress((done * 100) / total)
+            fh.seek(start + (total * self.itemsize))
+        else:
+            for piece in self.iterSequential():
+                self.writeArray(fh, piece, endian)
+                done += piece.size
+                if progress:
+                    progress((done * 100) / total)
@@ -7,7 +7,7 @@ hyperspectral classes.  These functions shouldn't have external
 dependencies on any other classes in the hsi package.
 """
 
-import os, sys, math, time, threading
+import os, sys, math, time, threading, itertools
 from cStringIO import StringIO
 
 from peppy.debug import *
@@ -15,6 +15,7 @@ from peppy.debug import *
 import numpy
 
 import cube as HSI
+import parallel
 
 # number of meters per unit
 units_scale={
@@ -70,6 +71,131 @@ def getRangeIntersection(x1, x2, bbl1=None):
     return (i1start, i1end)
 
 
+class SpectralResampler(debugmixin):
+    """Linear interpolation of spectra onto a new set of wavelengths.
+    
+    The interpolation is described by a weight matrix of (target x source)
+    wavelengths, where each row contains the weights of the two source
+    wavelengths that bracket the target wavelength.  Target wavelengths
+    outside the range of the source take the value of the nearest end of
+    the source.  Once the matrix is calculated, any number of spectra can be
+    resampled with a single matrix multiply.
+    
+    Use L{getResampler} to reuse the weight matrix for the same combination
+    of wavelengths.
+    """
+    #: Maximum number of resamplers kept by L{getResampler}
+    max_cached = 32
+    
+    #: Memory budget in bytes of the source blocks used by L{resampleCube},
+    #: or None to use the budget of the cube
+    block_bytes = None
+    
+    _cache = {}
+    
+    def __init__(self, source, target, bbl=None):
+        """Calculate the weight matrix
+        
+        @param source: list of wavelengths of the spectra to be resampled
+        
+        @param target: list of wavelengths of the resampled spectra
+        
+        @param bbl: optional bad band list of the source (0 = bad, 1 = good).
+        Bad source bands are not used; target wavelengths are interpolated
+        between the nearest good source bands.
+        """
+        self.source = numpy.asarray(source, dtype=numpy.float64)
+        self.target = numpy.asarray(target, dtype=numpy.float64)
+        self.weights = numpy.zeros((len(self.target), len(self.source)), dtype=numpy.float64)
+        
+        good = numpy.arange(len(self.source))
+        if bbl is not None and len(bbl) > 0:
+            good = good[numpy.asarray(bbl[0:len(self.source)]) != 0]
+        good = good[numpy.argsort(self.source[good], kind='mergesort')]
+        if len(good) == 0 or len(self.target) == 0:
+            return
+        if len(good) == 1:
+            self.weights[:, good[0]] = 1.0
+            return
+        
+        x = self.source[good]
+        left = numpy.searchsorted(x, self.target, side='right') - 1
+        left = numpy.clip(left, 0, len(x) - 2)
+        dx = x[left + 1] - x[left]
+        frac = numpy.where(dx > 0, (self.target - x[left]) / numpy.where(dx > 0, dx, 1.0), 0.0)
+        frac = numpy.clip(frac, 0.0, 1.0)
+        rows = numpy.arange(len(self.target))
+        self.weights[rows, good[left]] += 1.0 - frac
+        self.weights[rows, good[left + 1]] += frac
+    
+    @classmethod
+    def getResampler(cls, source, target, bbl=None):
+        """Return a resampler for the wavelengths, reusing a previously
+        calculated weight matrix if available"""
+        if bbl is not None and len(bbl) > 0:
+            bbl_key = tuple(numpy.asarray(bbl).tolist())
+        else:
+            bbl_key = None
+        key = (tuple(source), tuple(target), bbl_key)
+        resampler = cls._cache.get(key, None)
+        if resampler is None:
+            if len(cls._cache) >= cls.max_cached:
+                cls._cache.clear()
+            resampler = cls(source, target, bbl)
+            cls._cache[key] = resampler
+        return resampler
+    
+    def resample(self, spectra):
+        """Resample one or many spectra
+        
+        @param spectra: array of (..., source wavelengths), e.g. a single
+        spectrum or an array of (number of spectra x source wavelengths)
+        
+        @return: float64 array of (..., target wavelengths)
+        """
+        return numpy.dot(spectra, self.weights.T)
+    
+    def resampleBlock(self, block):
+        """Resample a block of focal planes
+        
+        @param block: array of (lines x source bands x samples) as returned
+        by L{Cube.getFocalPlanesRaw}
+        
+        @return: float64 array of (lines x target bands x samples)
+        """
+        return numpy.tensordot(self.weights, block, axes=([1], [1])).transpose(1, 0, 2)
+    
+    def resampleCube(self, cube, datatype=numpy.float32, progress=None):
+        """Resample every pixel of a cube
+        
+        A spectral library stored as a cube (one spectrum per sample) is
+        resampled the same way.
+        
+        @param cube: L{Cube} whose bands match the source wavelengths
+        
+        @param datatype: data type of the new cube
+        
+        @param progress: optional callable taking the percent complete
+        
+        @return: new BIL L{Cube} with the target wavelengths
+        """
+        output = HSI.createCubeLike(cube, interleave='bil', bands=len(self.target), datatype=datatype)
+        output.wavelengths = self.target.tolist()
+        output.wavelength_units = cube.wavelength_units
+        output.spectra_names = cube.spectra_names[:]
+        output.bbl = [1] * len(self.target)
+        count = cube.getLinesPerBlock(cube.samples * cube.bands * cube.itemsize, self.block_bytes)
+        line = 0
+        while line < cube.lines:
+            end = min(line + count, cube.lines)
+            block = output.getFocalPlanesRaw(line, end)
+            block[:,:,:] = self.resampleBlock(cube.getFocalPlanesRaw(line, end))
+            line = end
+            if progress:
+                progress((line * 100) / cube.lines)
+        return output
+
+
 def resample(x1, y1, x2, y2, bbl1=None):
     """Resample using linear interpolation.
 
@@ -78,65 +204,35 @@ def resample(x1, y1, x2, y2, bbl1=None):
 
     @returns tuple (sampling, data1, data2)
     """
-    xout = []
-    y1out = []
-    y2out = []
-
     # only operate on the intersection of the ranges
     i1start, i1end = getRangeIntersection(x1, x2, bbl1)
-
-    # find first value of 2nd set less than intersection
-    i2 = 0
-    while i2<len(x2)-1 and x2[i2+1] < x1[i1start]:
-        i2 += 1
-
-    x2left = x2[i2]
-    x2right = x2[i2+1]
-    for i in range(i1start, i1end):
-        xinterp = x1[i]
-        while xinterp > x2right:
-            x2left = x2right
-            i2 += 1
-            x2right = x2[i2+1]
-        yinterp = (xinterp - x2left)/(x2right - x2left)*(y2[i2+1] - y2[i2]) + y2[i2]
-        xout.append(xinterp)
-        y1out.append(y1[i])
-        y2out.append(yinterp)
-    return (xout, y1out, y2out)
+    xout = list(x1[i1start:i1end])
+    resampler = SpectralResampler.getResampler(x2, xout)
+    y2out = resampler.resample(numpy.asarray(y2, dtype=numpy.float64))
+    return (xout, list(y1[i1start:i1end]), y2out.tolist())
         
 def resampleSingle(x1, x2, y2, bbl1=None):
     """Resample using linear interpolation.
 
     Given a set of x, y values and a new set of x values, resample the y values
-    onto the new domain.
+    onto the new domain.  Values outside the range of the set of x values are
+    set to the value at the nearest end of the range.
+    
+    @param bbl1: optional bad band list of x1 (0 = bad, 1 = good).  Bad bands
+    at either end of x1 are outside the range, so they are set to the value
+    at the nearest good band.
 
     @returns new y values
     """
-    y1 = []
-
-    # only operate on the intersection of the ranges
-    i1start, i1end = getRangeIntersection(x1, x2, bbl1)
-
-    # find first value of 2nd set less than intersection
-    i2 = 0
-    while i2<len(x2)-1 and x2[i2+1] < x1[i1start]:
-        i2 += 1
-
-    x2left = x2[i2]
-    x2right = x2[i2+1]
-    for i in range(0, i1start):
-        y1.append(y2[i2])
-    for i in range(i1start, i1end):
-        xinterp = x1[i]
-        while xinterp > x2right:
-            x2left = x2right
-            i2 += 1
-            x2right = x2[i2+1]
-        yinterp = (xinterp - x2left)/(x2right - x2left)*(y2[i2+1] - y2[i2]) + y2[i2]
-        y1.append(yinterp)
-    for i in range(i1end, len(x1)):
-        y2.append(y2[i2])
-    return y1
+    resampler = SpectralResampler.getResampler(x2, x1)
+    weights = resampler.weights
+    if bbl1 is not None:
+        i1start, i1end = getRangeIntersection(x1, x2, bbl1)
+        if i1start < i1end:
+            weights = weights.copy()
+            weights[0:i1start] = weights[i1start]
+            weights[i1end:] = weights[i1end - 1]
+    return numpy.dot(numpy.asarray(y2, dtype=numpy.float64), weights.T).tolist()
         
 def spectralAngle(lam1, spectra1, lam2, spectra2, bbl=None):
     """Determine spectral angle between two vectors.
@@ -218,35 +314,39 @@ def bandReduceSampling(band, scale):
     
     @return: copy of band scaled to the new dimensions
     """
-    # This is a slow implementation of a pixel resampling function
-    # that simply averages the pixels in a moving square of [scale
-    # x scale] pixels in the source image.  I couldn't find a quick
-    # resampling/interpolation/decimation function in numpy.
-    output = numpy.empty((band.shape[0] / scale, band.shape[1] / scale), dtype=band.dtype)
-    for sample in range(0, output.shape[1]):
-        for line in range(0, output.shape[0]):
-            s1 = sample * scale
-            s2 = s1 + scale
-            if s2 > band.shape[1]:
-                s2 = band.shape[1]
-            l1 = line * scale
-            l2 = l1 + scale
-            if l2 > band.shape[0]:
-                l2 = band.shape[0]
-            avg = numpy.average(band[l1:l2, s1:s2])
-            output[line, sample] = avg
+    # Average each [scale x scale] square of source pixels by reshaping the
+    # band so that each square occupies its own pair of axes.  Groups of
+    # output lines are processed at a time to limit the size of the floating
+    # point temporary array.
+    lines = band.shape[0] / scale
+    samples = band.shape[1] / scale
+    output = numpy.empty((lines, samples), dtype=band.dtype)
+    if lines == 0 or samples == 0:
+        return output
+    chunk = max((4 * 1024 * 1024) / (samples * scale * scale), 1)
+    for l1 in range(0, lines, chunk):
+        l2 = min(l1 + chunk, lines)
+        source = band[l1 * scale:l2 * scale, 0:samples * scale]
+        blocks = source.reshape(l2 - l1, scale, samples, scale)
+        avg = blocks.mean(axis=3, dtype=numpy.float64).mean(axis=1)
+        output[l1:l2, :] = avg
     return output
 
 
 class Histogram(object):
+    """Per-band histogram of the differences between two cubes.
+    
+    The histogram has one bin per integer difference value from 0 to nbins.
+    It is filled in a single streaming pass by calling L{addBlock} with
+    blocks of differences, and the accumulation and threshold counts are
+    then calculated from cumulative sums of the histogram.
+    """
     def __init__(self,cube,nbins=500,bbl=None):
         self.cube=cube
         self.width=cube.bands
         self.nbins=nbins
         self.pixelsperband=cube.samples*cube.lines
 
-        # NOTE!  This type must remain numpy.int32, or otherwise the C code
-        # must be changed.
         self.data=numpy.zeros((self.width,self.nbins),dtype=numpy.int32)
         self.maxvalue=numpy.zeros((self.width,),dtype=numpy.int32)
         self.maxdiff=numpy.zeros((self.width,),dtype=numpy.int32)
@@ -261,20 +361,52 @@ class Histogram(object):
             self.bbl=self.cube.getBadBandList()
         # print "Histogram: self.bbl=%s" % self.bbl
 
+    def addBlock(self, diff, values=None):
+        """Add a block of differences to the histogram
+        
+        The bins are the same as numpy.histogram(band, bins=nbins,
+        range=(0, nbins)): differences outside that range are not counted,
+        and a difference of exactly nbins is counted in the last bin.
+        
+        @param diff: array of (lines x bands x samples) of absolute
+        differences
+        
+        @param values: optional array of (lines x bands x samples) of the
+        values of the first cube, used to keep track of the maximum value in
+        each band
+        """
+        if diff.size == 0:
+            return
+        flat = diff.transpose(1, 0, 2).reshape(self.width, -1)
+        valid = (flat >= 0) & (flat <= self.nbins)
+        index = numpy.minimum(flat, self.nbins - 1).astype(numpy.int32)
+        index += (numpy.arange(self.width, dtype=numpy.int32) * self.nbins)[:, numpy.newaxis]
+        counts = numpy.bincount(index[valid])
+        self.data.flat[0:len(counts)] += counts.astype(numpy.int32)
+        
+        self.maxdiff[:] = numpy.maximum(self.maxdiff, flat.max(axis=1))
+        if values is not None:
+            self.maxvalue[:] = numpy.maximum(self.maxvalue, values.max(axis=2).max(axis=0))
+
+    def getLastBins(self):
+        """Return an array containing the index of the last bin with a
+        non-zero value in each band, or 0 if the band has no counts.
+        """
+        nonzero = self.data > 0
+        last = self.nbins - 1 - numpy.argmax(nonzero[:, ::-1], axis=1)
+        return numpy.where(nonzero.any(axis=1), last, 0)
+
     def info(self):
-        lastbin=[]
+        good = numpy.array(self.bbl, dtype=numpy.bool_)
+        last = self.getLastBins()
+        lastbin = []
         for band in range(self.width):
-            if not self.bbl[band]:
-                lastbin.append('bad')
-                self.maxdiff[band]=0
+            if good[band]:
+                lastbin.append(int(last[band]))
             else:
-                last=0
-                for bin in range(0,self.nbins):
-                    if self.data[band][bin]>0:
-                        last=bin
-                lastbin.append(last)
-            if self.maxvalue[band]==0:
-                self.maxvalue[band]=1
+                lastbin.append('bad')
+        self.maxdiff[~good] = 0
+        self.maxvalue[self.maxvalue == 0] = 1
                 
         print "last bin with non-zero value:"
         print lastbin
@@ -290,54 +422,43 @@ class Histogram(object):
         self.info()
         
         self.accumulation=numpy.zeros((self.width,numcolors),dtype=numpy.int32)
-
-        temp=numpy.zeros((self.nbins,),dtype=numpy.int32)
-
-        validpixels=0
-        pixelsbelowthreshold=[0]*len(self.thresholds)
-
-        for band in range(self.width):
-            if not self.bbl[band]: continue # only operate on valid bands
-            
-            accum=self.pixelsperband
-            validpixels+=accum
-
-            # create temp, a monotonically decreasing list where the
-            # first index contains all the pixels, and each subsequent
-            # bin subtracts the histogram value for that bin
-            for bin in range(0,self.nbins):
-                temp[bin]=accum
-                num=self.data[band][bin]
-                for i in range(len(self.thresholds)):
-                    if bin<=self.thresholds[i]:
-                        pixelsbelowthreshold[i]+=num
-                accum-=num
-            
-            # print temp
-
-            # Now turn the temp list into an color index based array
-            # (so that it can eventually be plotted) by downsampling
-            # the ranges of numbers into buckets.  So, if there are 20
-            # colors to be plotted and there are 1000 pixels per band,
-            # then accumulations between 1000 & 951 get index 0, 950 &
-            # 901 get index 1, etc.
-            lastheight=numcolors-1
-            currentheight=0
-            lastindex=0
-            for bin in range(self.nbins):
-                index=int(float(((self.pixelsperband-temp[bin])*numcolors)/self.pixelsperband))
-                if index>=numcolors: index=numcolors-1
-                
-                #if index>currentheight:
-                
-                self.accumulation[band][index]=bin
-
-            height=0
-            for index in range(numcolors):
-                curr=self.accumulation[band][index]
-                if curr>0:
-                    self.accumulation[band][index]-=height
-                    height=curr
+        good = numpy.array(self.bbl, dtype=numpy.bool_)
+        data = self.data[good].astype(numpy.int64)
+        
+        # cumulative[band, bin] is the number of pixels less than or equal to
+        # bin, so the threshold counts can be read directly from it
+        cumulative = data.cumsum(axis=1)
+        validpixels = self.pixelsperband * len(data)
+        pixelsbelowthreshold = []
+        for threshold in self.thresholds:
+            pixelsbelowthreshold.append(int(cumulative[:, min(threshold, self.nbins - 1)].sum()))
+
+        # temp is a monotonically decreasing list where the first index
+        # contains all the pixels, and each subsequent bin subtracts the
+        # histogram value for the previous bin
+        temp = self.pixelsperband - (cumulative - data)
+
+        # Now turn temp into an color index based array (so that it can
+        # eventually be plotted) by downsampling the ranges of numbers into
+        # buckets.  So, if there are 20 colors to be plotted and there are
+        # 1000 pixels per band, then accumulations between 1000 & 951 get
+        # index 0, 950 & 901 get index 1, etc.  Each color index gets the
+        # last bin that maps to it.
+        index = ((self.pixelsperband - temp) * numcolors) / self.pixelsperband
+        numpy.clip(index, 0, numcolors - 1, index)
+        last = numpy.ones(index.shape, dtype=numpy.bool_)
+        last[:, :-1] = index[:, 1:] != index[:, :-1]
+        rows, bins = numpy.nonzero(last)
+        accumulation = numpy.zeros((len(data), numcolors), dtype=numpy.int32)
+        accumulation[rows, index[rows, bins]] = bins
+        
+        # Convert to heights relative to the previous non-zero color index.
+        # The non-zero bins increase with the color index, so the previous
+        # non-zero bin is the running maximum.
+        previous = numpy.zeros(accumulation.shape, dtype=numpy.int32)
+        previous[:, 1:] = numpy.maximum.accumulate(accumulation, axis=1)[:, :-1]
+        accumulation = numpy.where(accumulation > 0, accumulation - previous, 0)
+        self.accumulation[good] = accumulation
 
         print "Total pixels from good bands=%d" % validpixels
 ##        if (hist.isTemperature()) {
@@ -354,6 +475,81 @@ class Histogram(object):
             print "  Threshold %f reflectance units: valid=%d  percentage=%f" % ((self.thresholds[i]*1.0),pixelsbelowthreshold[i],(pixelsbelowthreshold[i]*100.0/validpixels))
 
 
+def getEuclideanDistanceOfBlocks(block1, block2, bblmask):
+    """Calculate the euclidean distance between corresponding pixels of two
+    blocks of focal planes.
+    
+    @param block1, block2: arrays of (lines x bands x samples)
+    
+    @param bblmask: bad band mask that can be broadcast against the blocks,
+    zero for bad bands
+    
+    @return: array of (lines x samples)
+    """
+    p1 = block1 * bblmask
+    p2 = block2 * bblmask
+    diff = p1 - p2
+    return numpy.sqrt(numpy.add.reduce(diff * diff, axis=1))
+
+def getSpectralAngleOfBlocks(block1, block2, bblmask):
+    """Calculate the spectral angle in degrees between corresponding pixels
+    of two blocks of focal planes.
+    
+    @param block1, block2: arrays of (lines x bands x samples)
+    
+    @param bblmask: bad band mask that can be broadcast against the blocks,
+    zero for bad bands
+    
+    @return: array of (lines x samples)
+    """
+    p1 = numpy.cast[numpy.float32](block1 * bblmask)
+    p2 = numpy.cast[numpy.float32](block2 * bblmask)
+    zerotest = numpy.add.reduce(block1 - block2, axis=1)
+    
+    top = numpy.add.reduce(p1 * p2, axis=1)
+    bot = numpy.sqrt(numpy.add.reduce(p1 * p1, axis=1)) * numpy.sqrt(numpy.add.reduce(p2 * p2, axis=1))
+    # the arccos may not be zero if the spectra are exactly the same due
+    # to round-off error in the squaring/sqrt.  So, we add this check
+    # here to force the total to 1.0 if any pixel in plane1 is exactly
+    # equal to the pixel in plane 2
+    tot = numpy.where(zerotest == 0.0, 1.0, top/bot)
+    return numpy.nan_to_num(numpy.arccos(tot) * (180.0 / math.pi))
+
+def getNearestCenters(pixels, centers):
+    """Find the nearest cluster center of each pixel.
+    
+    The squared euclidean distance is expanded into |p|^2 - 2 p.c + |c|^2;
+    |p|^2 is the same for all centers, so only the remaining terms are
+    needed to find the nearest one.
+    
+    @param pixels: float64 array of (pixels x bands)
+    
+    @param centers: float64 array of (classes x bands)
+    
+    @return: array of the index of the nearest center of each pixel
+    """
+    dist2 = numpy.dot(pixels, centers.T)
+    dist2 *= -2.0
+    dist2 += (centers * centers).sum(axis=1)
+    return dist2.argmin(axis=1)
+
+def getNearestCentersOfBlock(block, good, centers):
+    """Find the nearest cluster center of each pixel of a block of focal
+    planes.
+    
+    @param block: array of (lines x bands x samples)
+    
+    @param good: array of the indexes of the bands used in the centers
+    
+    @param centers: float64 array of (classes x good bands)
+    
+    @return: array of (lines x samples)
+    """
+    lines, bands, samples = block.shape
+    pixels = block[:, good, :].transpose(0, 2, 1).reshape(-1, len(good)).astype(numpy.float64)
+    return getNearestCenters(pixels, centers).reshape(lines, samples)
+
+
 class CubeCompare(debugmixin):
     """Compare two HSI cubes for differences.
     
@@ -391,7 +587,15 @@ class CubeCompare(debugmixin):
                 val = band1[samp,line] - band2[samp,line]
                 bin = abs(val)
                 histogram[band][bin] += 1
+    
+    The driver methods read both cubes in blocks of lines using
+    L{iterLineBlocks}, so they are fast regardless of the interleave of
+    either cube.
     """
+    #: Memory budget in bytes for the blocks of both cubes held in memory at
+    #: once by L{iterLineBlocks}, or None to use the budget of the cubes
+    block_bytes = None
+    
     def __init__(self, c1, c2, line_offset=0):
         """Create the comparitor instance
         
@@ -446,6 +650,29 @@ class CubeCompare(debugmixin):
             plane2 = self.cube2.getFocalPlaneRaw(i)
             yield i, plane1, plane2
     
+    def getLinesPerBlock(self):
+        """Number of lines of both cubes that fit within L{block_bytes}"""
+        line_bytes = self.samples * self.bands * (self.cube1.itemsize + self.cube2.itemsize)
+        return self.cube2.getLinesPerBlock(line_bytes, self.block_bytes)
+    
+    def iterLineBlocks(self):
+        """Iterate by blocks of lines returning the same lines in each cube
+        
+        Each cube is read using L{Cube.iterFocalPlaneBlocks}, which uses the
+        fastest access method for the interleave of that cube: BIP and BIL
+        cubes are read sequentially, and BSQ cubes are read as one tile from
+        each band.  File-backed cubes read the next block in the background
+        while the current block is compared.
+        
+        @return: first line number of the block, block from cube 1, block
+        from cube 2, where the blocks are arrays of (lines x bands x samples)
+        """
+        count = self.getLinesPerBlock()
+        iter1 = self.cube1.iterFocalPlaneBlocks(count, self.line_offset, self.lines + self.line_offset)
+        iter2 = self.cube2.iterFocalPlaneBlocks(count, 0, self.lines)
+        for (line1, block1), (line, block2) in itertools.izip(iter1, iter2):
+            yield line, block1, block2
+    
     def getFocalPlaneBadBandMask(self):
         """Calculate the bad band mask for focal plane data
         
@@ -479,6 +706,8 @@ class CubeCompare(debugmixin):
             self.dprint("band %d: local min/max=(%d,%d) " % (i,mn,mx))
             counts, bins = numpy.histogram(band, bins=nbins, range=(0, nbins))
             h[i,:] = counts
+            self.histogram.maxdiff[i] = mx
+            self.histogram.maxvalue[i] = band1.max()
         self.dprint(h)
         return self.histogram
     
@@ -496,34 +725,34 @@ class CubeCompare(debugmixin):
         work is done by numpy.
         """
         self.histogram = Histogram(self.cube1,nbins,self.bbl)
-        h = self.histogram.data
 
-        bandrange = range(self.bands)
         for i, plane1, plane2 in iter:
+            # The focal plane is treated as a block of one line
             plane = abs(plane1 - plane2)
-            
-            # Need to accumulate by bands, so loop through each band in the
-            # focal plane image (bands x samples) and calculate the histogram
-            # of those samples.  The small histogram is then accumulated into
-            # the total histogram at the band.
-            for band in bandrange:
-                counts, bins = numpy.histogram(plane[band], bins=nbins, range=(0, nbins))
-                h[band,:] += counts
-
+            self.histogram.addBlock(plane[numpy.newaxis], plane1[numpy.newaxis])
             self.dprint("line %d" % (i))
-        self.dprint(h)
+        self.dprint(self.histogram.data)
+        return self.histogram
+    
+    def getHistogramByLineBlock(self, iter, nbins=500):
+        """Generate a histogram using blocks of lines
+        
+        Fast for any interleave when used with L{iterLineBlocks}.
+        """
+        self.histogram = Histogram(self.cube1,nbins,self.bbl)
+
+        for line, block1, block2 in iter:
+            self.histogram.addBlock(abs(block1 - block2), block1)
+            self.dprint("line %d" % (line))
+        self.dprint(self.histogram.data)
         return self.histogram
     
     def getHistogram(self, nbins=500):
         """Generate a histogram.
         
-        The driver method for generating a histogram.  Selects the best
-        histogram calculation method as appropriate for both cubes.
+        The driver method for generating a histogram.
         """
-        if self.isBILBIP():
-            iter = self.iterBILBIP()
-            return self.getHistogramByFocalPlane(iter, nbins)
-        return self.getHistogramByBand(nbins)
+        return self.getHistogramByLineBlock(self.iterLineBlocks(), nbins)
     
     def getHeatMapByBand(self,nbins=500):
         """Generate a heat map using bands
@@ -571,16 +800,28 @@ class CubeCompare(debugmixin):
         self.dprint(data)
         return self.heatmap
     
+    def getHeatMapByLineBlock(self, iter):
+        """Generate a heat map using blocks of lines
+        
+        Fast for any interleave when used with L{iterLineBlocks}.
+        """
+        self.heatmap = HSI.createCube('bsq', self.lines, self.samples, 1, self.dtype)
+        data = self.heatmap.getBandRaw(0)
+        bblmask = self.getFocalPlaneBadBandMask()
+
+        for line, block1, block2 in iter:
+            p1 = block1 * bblmask
+            p2 = block2 * bblmask
+            data[line:line + block1.shape[0],:] = numpy.add.reduce(abs(p1 - p2), axis=1)
+        self.dprint(data)
+        return self.heatmap
+    
     def getHeatMap(self):
         """Generate a heat map
         
-        The driver method -- selects the fastest calculation method based
-        on the interleave of both cubes.
+        The driver method -- reads both cubes in blocks of lines.
         """
-        if self.isBILBIP():
-            iter = self.iterBILBIP()
-            return self.getHeatMapByFocalPlane(iter)
-        return self.getHeatMapByBand()
+        return self.getHeatMapByLineBlock(self.iterLineBlocks())
     
     def getDifferenceByFocalPlane(self, iter):
         """Difference the cubes using focal planes
@@ -618,17 +859,25 @@ class CubeCompare(debugmixin):
                 self.dprint(band)
         return self.difference
     
+    def getDifferenceByLineBlock(self, iter):
+        """Difference the cubes using blocks of lines
+        
+        Fast for any interleave when used with L{iterLineBlocks}.
+        """
+        self.difference = HSI.createCube('bil', self.lines, self.samples, self.bands, self.dtype)
+        bblmask = self.getFocalPlaneBadBandMask()
+
+        for line, block1, block2 in iter:
+            block = self.difference.getFocalPlanesRaw(line, line + block1.shape[0])
+            block[:,:,:] = block1 * bblmask - block2 * bblmask
+        return self.difference
+    
     def getDifference(self):
         """Generate a cube containing the difference between the two cubes
         
-        The driver method -- selects the fastest calculation method based
-        on the interleave of both cubes.
+        The driver method -- reads both cubes in blocks of lines.
         """
-        if self.isBILBIP():
-            iter = self.iterBILBIP()
-            self.getDifferenceByFocalPlane(iter)
-        else:
-            self.getDifferenceByBand()
+        self.getDifferenceByLineBlock(self.iterLineBlocks())
         self.difference.bbl = self.bbl[:]
         return self.difference
     
@@ -677,17 +926,29 @@ class CubeCompare(debugmixin):
         self.dprint(data)
         return euclidean
     
+    def getEuclideanDistanceByLineBlock(self, iter, updater=None):
+        """Calculate the euclidean distance for every pixel in two cubes using
+        blocks of lines
+        
+        Fast for any interleave when used with L{iterLineBlocks}.
+        """
+        euclidean = HSI.createCube('bsq', self.lines, self.samples, 1, numpy.float32)
+        data = euclidean.getBandRaw(0)
+        bblmask = self.getFocalPlaneBadBandMask()
+
+        for line, block1, block2 in iter:
+            if updater:
+                updater.updateStatus(line, self.lines, "Calculating Euclidean Distance")
+            data[line:line + block1.shape[0],:] = getEuclideanDistanceOfBlocks(block1, block2, bblmask)
+        self.dprint(data)
+        return euclidean
+    
     def getEuclideanDistance(self, updater=None):
         """Generate a cube containing the euclidean distance between the two cubes
         
-        The driver method -- selects the fastest calculation method based
-        on the interleave of both cubes.
+        The driver method -- reads both cubes in blocks of lines.
         """
-        if self.isBILBIP():
-            iter = self.iterBILBIP()
-            cube = self.getEuclideanDistanceByFocalPlane(iter, updater)
-        else:
-            cube = self.getEuclideanDistanceByBand(updater)
+        cube = self.getEuclideanDistanceByLineBlock(self.iterLineBlocks(), updater)
         self.calcStatistics(cube)
         self.euclidean = cube
         return self.euclidean
@@ -751,21 +1012,61 @@ class CubeCompare(debugmixin):
         self.dprint(data)
         return sam
     
+    def getSpectralAngleByLineBlock(self, iter, updater=None):
+        """Calculate the spectral angle between every pixel in two cubes using
+        blocks of lines
+        
+        Fast for any interleave when used with L{iterLineBlocks}.
+        """
+        sam = HSI.createCube('bsq', self.lines, self.samples, 1, numpy.float32)
+        data = sam.getBandRaw(0)
+        bblmask = self.getFocalPlaneBadBandMask()
+
+        for line, block1, block2 in iter:
+            if updater:
+                updater.updateStatus(line, self.lines, "Calculating Spectral Angle")
+            data[line:line + block1.shape[0],:] = getSpectralAngleOfBlocks(block1, block2, bblmask)
+        self.dprint(data)
+        return sam
+    
     def getSpectralAngle(self, updater=None):
         """Generate a cube containing the spectral angle between the two cubes
         
-        The driver method -- selects the fastest calculation method based
-        on the interleave of both cubes.
+        The driver method -- reads both cubes in blocks of lines.
         """
-        if self.isBILBIP():
-            iter = self.iterBILBIP()
-            sam = self.getSpectralAngleByFocalPlane(iter, updater)
-        else:
-            sam = self.getSpectralAngleByBand(updater)
+        sam = self.getSpectralAngleByLineBlock(self.iterLineBlocks(), updater)
         self.calcStatistics(sam)
         self.sam = sam
         return self.sam
     
+    def canCompareInParallel(self):
+        """Test to see if both cubes can be memory mapped by worker processes
+        for L{getDistancesInParallel}.
+        """
+        return parallel.multiprocessing is not None and \
+               parallel.CubeSource.fromCube(self.cube1) is not None and \
+               parallel.CubeSource.fromCube(self.cube2) is not None
+    
+    def getDistancesInParallel(self, updater=None, processes=None):
+        """Generate cubes containing the euclidean distance and the spectral
+        angle between the two cubes using a pool of worker processes.
+        
+        The line range is split among the workers, each of which memory maps
+        both cubes and writes its results into an output array in shared
+        memory.  Only usable if L{canCompareInParallel} is True.
+        
+        @return: tuple of euclidean distance cube, spectral angle cube
+        """
+        output = parallel.compareInParallel(self, processes, updater)
+        cubes = []
+        for band in range(2):
+            cube = HSI.createCube('bsq', self.lines, self.samples, 1, numpy.float32)
+            cube.getBandRaw(0)[:,:] = output[band]
+            self.calcStatistics(cube)
+            cubes.append(cube)
+        self.euclidean, self.sam = cubes
+        return self.euclidean, self.sam
+    
     def calcStatistics(self, cube):
         """Calculate the min, max, mean, and std dev of the data cube
         
@@ -806,41 +1107,50 @@ class CubeCompare(debugmixin):
         return (minval,maxval)
     
     def getExtremaChunk(self):
-        """Really just a test function to see how long it takes to
-        seek all the way through one file."""
-
-        minval=100000
-        maxval=0
-        
-        for i1 in range(self.cube1.bands):
-            band=self.cube1.getBand(i1)
-            mx=band.max()
-            mn=band.min()
-            if (mx>maxval): maxval=mx
-            if (mn<minval): minval=mn
-            self.dprint("band %d: local min/max=(%d,%d)  accumulated min/max=(%d,%d)" % (i1,mn,mx,minval,maxval))
-            
-        return (minval,maxval)
+        """Get the extrema of the first cube using the per-band statistics,
+        which are only calculated if they aren't already available from the
+        sidecar cache."""
+        stats = self.cube1.getStatistics()
+        return stats.getCubeExtrema()
 
 class ThreadedCubeCompare(threading.Thread):
     """Background file loading thread.
     
     Uses peppy.lib.threadutils.ThreadStatus to communicate with GUI thread
     """
-    def __init__(self, cube1, cube2, updater):
+    #: Default number of worker processes, set from the worker_processes
+    #: preference of the HSI mode
+    processes = 1
+    
+    def __init__(self, cube1, cube2, updater, processes=None):
+        """Create the comparison thread
+        
+        @param processes: number of worker processes used when both cubes
+        can be compared in parallel, or 0 to use one process per CPU.  If 1,
+        the comparison is performed serially in this thread.  Defaults to
+        the class attribute L{processes}.
+        """
         threading.Thread.__init__(self)
         self.comp = CubeCompare(cube1, cube2)
         self.updater = updater
+        if processes is None:
+            processes = self.__class__.processes
+        self.processes = parallel.getNumProcesses(processes)
         self.output = None
     
     def run(self):
         try:
             comp = self.comp
-            self.updater.setNumberOfWorkItems(2)
-            dist = comp.getEuclideanDistance(updater=self.updater)
-            self.updater.finishedWorkItem()
-            sam = comp.getSpectralAngle(updater=self.updater)
-            self.updater.finishedWorkItem()
+            if self.processes > 1 and comp.canCompareInParallel():
+                self.updater.setNumberOfWorkItems(1)
+                dist, sam = comp.getDistancesInParallel(self.updater, self.processes)
+                self.updater.finishedWorkItem()
+            else:
+                self.updater.setNumberOfWorkItems(2)
+                dist = comp.getEuclideanDistance(updater=self.updater)
+                self.updater.finishedWorkItem()
+                sam = comp.getSpectralAngle(updater=self.updater)
+                self.updater.finishedWorkItem()
             dtype = numpy.find_common_type([dist.data_type, sam.data_type], [])
             self.output = HSI.createCubeLike(dist, 'bsq', bands=2, datatype=dtype)
             outputband = self.output.getBandRaw(0)
@@ -16,6 +16,11 @@ from peppy.actions import *
 
 from peppy.debug import *
 from peppy.hsi.common import *
+from peppy.hsi.prefetch import BandPrefetcher
+from peppy.hsi.stats import calculateInBackground
+from peppy.hsi.shadow import startInBackground
+from peppy.hsi.overview import OverviewPyramid
+from peppy.hsi.filter import clipValues
 
 import numpy
 
@@ -34,11 +39,15 @@ class CubeView(debugmixin):
     imageDirectionLabel = "Band"
     prev_index_icon = 'icons/hsi-band-prev.png'
     next_index_icon = 'icons/hsi-band-next.png'
+    
+    #: Type of plane loaded by the L{BandPrefetcher}
+    prefetch_axis = 'band'
 
     def __init__(self, mode, cube, display_rgb=True):
         self.mode = mode
         self.display_rgb = display_rgb
         self.cube = None
+        self.prefetcher = None
         self.setCube(cube)
     
     def setCube(self, cube):
@@ -55,12 +64,68 @@ class CubeView(debugmixin):
         # read in
         self.extrema=(0,1)
 
+        # (min, max) of each of the filtered planes, or None if not known
+        self.plane_extrema = None
+        
+        # (min, max) clip still to be applied to each of the planes, or None
+        # if the plane is already completely filtered
+        self.plane_clips = []
+        
+        # RGB array of the last image, reused if the size doesn't change
+        self.rgb = None
+
         # simple list of arrays, one array for each color plane r, g, b
         self.image = None
         self.contraststretch=0.0 # percentage
 
+        # decimation factor of the displayed bands; 1 is full resolution
+        self.overview_level = 1
+        self.overviews = None
+
         self.initBitmap(cube)
+        if self.cube:
+            self.overviews = OverviewPyramid(self.cube)
         self.initDisplayIndexes()
+        self.initPrefetcher()
+        self.initStatistics()
+        self.initSpectralShadow()
+    
+    def initStatistics(self):
+        """Load the band statistics from the sidecar cache, or start
+        calculating them in the background if they haven't been saved.
+        """
+        if self.cube and self.cube.url is not None:
+            calculateInBackground(self.cube)
+    
+    def initSpectralShadow(self):
+        """Use or start building the spectrum ordered copy of BSQ cubes so
+        that the depth profile can follow the cursor.
+        """
+        if self.cube and self.mode.classprefs.use_spectral_copy:
+            startInBackground(self.cube)
+    
+    def getBandSummary(self, index):
+        """Return the L{BandSummary} of the band if it is available"""
+        if self.swap:
+            return None
+        return self.cube.getBandSummary(index)
+    
+    def initPrefetcher(self):
+        """Start the background loader for cubes that are slow to read"""
+        self.stopPrefetcher()
+        if BandPrefetcher.isUseful(self.cube):
+            self.prefetcher = BandPrefetcher(self.cube, self.prefetch_axis)
+            self.prefetcher.start()
+    
+    def stopPrefetcher(self):
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+            self.prefetcher = None
+    
+    def prefetchHint(self, index):
+        """Start loading a band that is likely to be displayed soon"""
+        if self.prefetcher is not None:
+            self.prefetcher.hint(index)
 
     def initBitmap(self, cube=None, width=None, height=None):
         if cube:
@@ -94,10 +159,36 @@ class CubeView(debugmixin):
     def getWorkingMessage(self):
         return "Building %dx%d bitmap..." % (self.cube.samples, self.cube.lines)
     
+    def getOverviewLevelForZoom(self, zoom):
+        """Return the overview level appropriate for the zoom factor, where
+        zoom is relative to the full resolution cube."""
+        if not self.cube or not self.mode.classprefs.use_overviews:
+            return 1
+        return OverviewPyramid.getLevelForZoom(self.cube, zoom)
+    
+    def setOverviewLevel(self, level):
+        """Display the bands at the given overview level
+        
+        @return: True if the level changed
+        """
+        if level == self.overview_level:
+            return False
+        self.overview_level = level
+        self.height, self.width = self.overviews.getShape(level)
+        
+        # force the bands to be reloaded at the new resolution
+        self.bands = []
+        return True
+    
     def getBand(self, index):
-        raw = self.cube.getBandInPlace(index)
+        if self.prefetcher is not None:
+            self.prefetcher.waitIfLoading(index)
+        if self.overview_level > 1:
+            raw = self.overviews.getBand(index, self.overview_level)
+        else:
+            raw = self.cube.getBandInPlace(index)
         if self.swap:
-            raw = raw.byteswap()
+            raw = getSwappedView(raw)
         return raw
     
     def loadBands(self, progress=None):
@@ -109,8 +200,12 @@ class CubeView(debugmixin):
         emax=None
         for i in self.indexes:
             raw=self.getBand(i)
-            minval=raw.min()
-            maxval=raw.max()
+            summary = self.getBandSummary(i)
+            if summary is not None:
+                minval, maxval = summary.getExtrema()
+            else:
+                minval=raw.min()
+                maxval=raw.max()
             self.bands.append((i,raw,minval,maxval))
             count+=1
             if emin==None or minval<emin:
@@ -125,7 +220,7 @@ class CubeView(debugmixin):
         if (swap != self.swap):
             newbands = []
             for index, raw, v1, v2 in self.bands:
-                swapped = raw.byteswap()
+                swapped = getSwappedView(raw)
                 newbands.append((index, swapped, swapped.min(), swapped.max()))
             self.bands = newbands
             self.swap = swap
@@ -182,9 +277,10 @@ class CubeView(debugmixin):
 
     def getDepthProfile(self, x, y):
         """Get the profile into the monitor at the given x,y position"""
-        profile = self.cube.getSpectra(y,x)
+        level = self.overview_level
+        profile = self.cube.getSpectra(y * level, x * level)
         if self.swap:
-            profile.byteswap(True) # swap in place
+            profile = getSwappedView(profile)
         return profile
     
     def getBandName(self, band_index):
@@ -248,6 +344,8 @@ class CubeView(debugmixin):
         if display:
             for i in range(len(self.indexes)):
                 self.indexes[i]=newbands[i]
+            if self.prefetcher is not None:
+                self.prefetcher.navigate(self.indexes)
         return display
 
     def setFilterOrder(self, filters):
@@ -258,16 +356,41 @@ class CubeView(debugmixin):
         
         """
         self.planes = []
+        self.plane_extrema = []
+        self.plane_clips = []
         for band in self.bands:
             assert self.dprint("getRGB: band=%s" % str(band))
             plane = band[1]
+            summary = self.getBandSummary(band[0])
+            
+            # Filters that only clip the range of values aren't applied
+            # here; the clip is passed to the colormapper so that the plane
+            # doesn't have to be copied.
+            clip = None
             for filt in self.filters:
-                plane = filt.getPlane(plane)
+                found = filt.getClipWithSummary(plane, summary)
+                if found is not None and clip is None:
+                    lo, hi, summary = found
+                    if lo is not None or hi is not None:
+                        clip = (lo, hi)
+                else:
+                    plane = clipValues(plane, clip)
+                    clip = None
+                    plane, summary = filt.getPlaneWithSummary(plane, summary)
             self.planes.append(plane)
+            self.plane_clips.append(clip)
+            if summary is not None:
+                self.plane_extrema.append(summary.getExtrema())
+            else:
+                self.plane_extrema.append(None)
             if progress: progress.Update(50+((count+1)*50)/len(self.bands))
 
     def getCurrentPlanes(self):
-        return self.planes
+        """Return the list of filtered planes"""
+        planes = []
+        for plane, clip in zip(self.planes, self.plane_clips):
+            planes.append(clipValues(plane, clip))
+        return planes
 
     def show(self, colormapper, progress=None):
         if not self.cube: return
@@ -291,10 +414,10 @@ class CubeView(debugmixin):
                 self.loadBands()
             
             self.processFilters(progress)
-            rgb = colormapper.getRGB(self.height, self.width, self.planes)
+            self.rgb = colormapper.getRGB(self.height, self.width, self.planes, self.plane_extrema, self.plane_clips, self.rgb)
             
             # image uses the rgb data and doesn't create a new copy
-            self.image = wx.ImageFromBuffer(self.width, self.height, rgb)
+            self.image = wx.ImageFromBuffer(self.width, self.height, self.rgb)
             # self.Refresh()
         except Exception, e:
             import traceback
@@ -323,9 +446,17 @@ class CubeView(debugmixin):
         """Convert the coordinates from the display x, y to sample, line, band.
         
         In the standard cube view, x is samples, y is lines, and the band is
-        the first band in the indexes list.
+        the first band in the indexes list.  If an overview is displayed,
+        the coordinates are scaled to the full resolution cube.
         """
-        return (y, x, self.indexes[0])
+        level = self.overview_level
+        return (y * level, x * level, self.indexes[0])
+    
+    def getFullResolutionBox(self, box):
+        """Convert an (x, y, w, h) box in display coordinates to the
+        equivalent box in the full resolution cube"""
+        level = self.overview_level
+        return tuple([v * level for v in box])
 
 class FocalPlaneView(CubeView):
     name = "Focal Plane View"
@@ -334,6 +465,7 @@ class FocalPlaneView(CubeView):
     imageDirectionLabel = "Frame"
     prev_index_icon = 'icons/hsi-frame-prev.png'
     next_index_icon = 'icons/hsi-frame-next.png'
+    prefetch_axis = 'focalplane'
 
     def initBitmap(self, cube):
         if cube:
@@ -362,10 +494,21 @@ class FocalPlaneView(CubeView):
         """
         return (self.indexes[0], x, y)
     
+    def getBandSummary(self, index):
+        # Statistics are calculated for spectral bands, not focal planes
+        return None
+    
+    def getOverviewLevelForZoom(self, zoom):
+        # Focal planes are only as large as the number of bands, so they are
+        # always displayed at full resolution
+        return 1
+    
     def getBand(self, index):
+        if self.prefetcher is not None:
+            self.prefetcher.waitIfLoading(index)
         raw = self.cube.getFocalPlaneInPlace(index)
         if self.swap:
-            raw = raw.byteswap()
+            raw = getSwappedView(raw)
         return raw
 
     def getAvailableXAxisLabels(self):
@@ -391,7 +534,7 @@ class FocalPlaneView(CubeView):
         """Get the profile into the monitor at the given x,y position"""
         profile = self.cube.getFocalPlaneDepthInPlace(x, y)
         if self.swap:
-            profile = profile.byteswap()
+            profile = getSwappedView(profile)
         return profile
 
     def getBandLegend(self, band_index):
@@ -10,6 +10,14 @@ import os,sys
 import __builtin__
 __builtin__._ = unicode
 
+# Worker processes of the frozen executable are started by running the
+# executable again, so they have to be dispatched before the GUI starts
+try:
+    import multiprocessing
+    multiprocessing.freeze_support()
+except ImportError:
+    pass
+
 import peppy.main
 
 peppy.main.main()
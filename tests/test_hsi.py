@@ -3,14 +3,31 @@
 Test the capabilities of HSI.Cube
 
 """
-import os,os.path,sys,re,time,commands
+import os,os.path,sys,re,time,commands,tempfile,shutil
 
 from nose.tools import *
 
 import peppy.vfs as vfs
 
 import peppy.hsi.common as HSI
+from peppy.hsi.cube import FileCubeReader
+from peppy.hsi.prefetch import BandPrefetcher
+from peppy.hsi.transpose import InterleaveTransposer
+from peppy.hsi.stats import BandStatistics, StatsCache
+from peppy.hsi.overview import OverviewPyramid
+from peppy.hsi.matching import SpectralLibraryMatcher
+from peppy.hsi.shadow import SpectralShadow
+from peppy.hsi.readahead import ReadAheadIterator, getRanges
+from peppy.hsi.reduction import CubeReduction
+from peppy.hsi.bandmath import BandMath
+from peppy.hsi.pca import PrincipalComponents, MinimumNoiseFraction
+from peppy.hsi.classify import MiniBatchKMeans
+from peppy.hsi.chunked import ChunkedDataset
+import peppy.hsi.utils as utils
+from peppy.hsi.utils import CubeCompare, Histogram
+from peppy.lib.threadutils import ProgressUpdater
 import peppy.hsi.ENVI as ENVI
+import peppy.hsi.FITS as FITS
 
 from cStringIO import StringIO
 import numpy
@@ -92,6 +109,34 @@ def loadCube(filename):
     cube.open()
     return cube
 
+def fileCube(dirname, interleave, lines=7, samples=5, bands=3, byte_order=HSI.nativeByteOrder):
+    """Write a cube to disk and reopen it using the direct file access
+    cube readers.
+    
+    The data values are the same as in L{fakeCube}: a sequence of increasing
+    integers in the order of the interleave.
+    """
+    mem = HSI.createCube(interleave, lines, samples, bands, numpy.int16, byte_order)
+    data = numpy.arange(lines * samples * bands).astype(mem.data_type)
+    if byte_order != HSI.nativeByteOrder:
+        data.byteswap(True)
+    filename = os.path.join(dirname, "test.%s" % interleave)
+    fh = open(filename, "wb")
+    fh.write(data.tostring())
+    fh.close()
+    header = ENVI.Header(mem)
+    header['interleave'] = interleave
+    header['byte order'] = str(byte_order)
+    header.save(filename + ".hdr")
+    
+    save = HSI.Cube.mmap_size_limit
+    HSI.Cube.mmap_size_limit = 1
+    try:
+        cube = loadCube(filename)
+    finally:
+        HSI.Cube.mmap_size_limit = save
+    return cube
+
 
 class fakeFooCube(object):
     def testFail(self):
@@ -329,3 +374,1238 @@ class testGuessBands(object):
         eq_(bands,[7])
         bands = self.cube.getBandListByWavelength(680.0,units='nm')
         eq_(bands,[7])
+
+
+class NonSeekableWriter(object):
+    def __init__(self):
+        self.fh = StringIO()
+    
+    def write(self, data):
+        self.fh.write(data)
+    
+    def getvalue(self):
+        return self.fh.getvalue()
+
+class baseFileCube(object):
+    interleave = None
+    byte_order = HSI.nativeByteOrder
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.cube = fileCube(self.dirname, self.interleave, byte_order=self.byte_order)
+        data = numpy.arange(7 * 5 * 3).astype(numpy.int16)
+        self.mem = HSI.createCube(self.interleave, 7, 5, 3, numpy.int16, data=data.tostring())
+        
+    def tearDown(self):
+        self.cube.cube_io.fh.close()
+        shutil.rmtree(self.dirname)
+    
+    def testFileReader(self):
+        assert isinstance(self.cube.cube_io, FileCubeReader)
+    
+    def testBands(self):
+        for band in range(self.cube.bands):
+            eq_(self.cube.getBandRaw(band).tolist(), self.mem.getBandRaw(band).tolist())
+    
+    def testBandsSmallBlocks(self):
+        # force reads of two lines at a time so the band must be assembled
+        # from several blocks, the last of which is a partial block
+        self.cube.cube_io.block_bytes = 2 * 5 * 3 * 2
+        for band in range(self.cube.bands):
+            eq_(self.cube.getBandRaw(band).tolist(), self.mem.getBandRaw(band).tolist())
+    
+    def testBandLines(self):
+        for band in range(self.cube.bands):
+            eq_(self.cube.getBandLinesRaw(band, 2, 5).tolist(), self.mem.getBandRaw(band)[2:5].tolist())
+    
+    def testDepth(self):
+        self.cube.cube_io.block_bytes = 3 * 5 * 3 * 2
+        for sample in range(self.cube.samples):
+            for band in range(self.cube.bands):
+                eq_(self.cube.getFocalPlaneDepthRaw(sample, band).tolist(), self.mem.getFocalPlaneDepthRaw(sample, band).tolist())
+    
+    def testSpectra(self):
+        eq_(self.cube.getSpectraRaw(3, 2).tolist(), self.mem.getSpectraRaw(3, 2).tolist())
+        
+    def testDtype(self):
+        # data is returned in the byte order of the file without swapping
+        dtype = self.cube.getDtype()
+        eq_(dtype.isnative, self.byte_order == HSI.nativeByteOrder)
+        eq_(self.cube.getBandRaw(1).dtype, dtype)
+        eq_(self.cube.getFocalPlanesRaw(0, 3).dtype, dtype)
+        swapped = HSI.getSwappedView(self.mem.getBandRaw(1))
+        eq_(swapped.tolist(), self.mem.getBandRaw(1).byteswap().tolist())
+        
+    def testBlockIterators(self):
+        expected = [self.mem.getFocalPlaneRaw(i).tolist() for i in range(7)]
+        planes = []
+        for line, block in self.cube.iterFocalPlaneBlocks(3):
+            eq_(line, len(planes))
+            planes.extend(block.tolist())
+        eq_(planes, expected)
+        eq_([fp.tolist() for fp in self.cube.iterFocalPlanes()], expected)
+        expected = [self.mem.getBandRaw(i).tolist() for i in range(3)]
+        bands = []
+        for band, block in self.cube.iterBandBlocks(2):
+            eq_(band, len(bands))
+            bands.extend(block.tolist())
+        eq_(bands, expected)
+        eq_([b.tolist() for b in self.cube.iterBands()], expected)
+        
+    def testSpectraAtPoints(self):
+        lines = [6, 0, 3, 3, 1, 6]
+        samples = [4, 0, 2, 1, 3, 0]
+        expected = [self.mem.getSpectraRaw(l, s).tolist() for l, s in zip(lines, samples)]
+        eq_(self.mem.getSpectraAtPointsRaw(lines, samples).tolist(), expected)
+        # blocks of two lines, so the points are gathered from several reads
+        self.cube.cube_io.block_bytes = 2 * 5 * 3 * 2
+        eq_(self.cube.getSpectraAtPointsRaw(lines, samples).tolist(), expected)
+        eq_(self.cube.getSpectraAtPointsRaw([], []).shape, (0, 3))
+        
+    def testFocalPlane(self):
+        eq_(self.cube.getFocalPlaneRaw(4).tolist(), self.mem.getFocalPlaneRaw(4).tolist())
+    
+    def testFocalPlanes(self):
+        expected = [self.mem.getFocalPlaneRaw(i).tolist() for i in range(2, 6)]
+        eq_(self.cube.getFocalPlanesRaw(2, 6).tolist(), expected)
+        eq_(self.mem.getFocalPlanesRaw(2, 6).tolist(), expected)
+    
+    def testExport(self):
+        bsq = numpy.array([self.mem.getBandRaw(i) for i in range(3)])
+        expected = {'bsq': bsq,
+                    'bil': bsq.transpose(1, 0, 2),
+                    'bip': bsq.transpose(1, 2, 0),
+                    }
+        options = {'byte_order': HSI.nativeByteOrder}
+        for interleave, data in expected.iteritems():
+            options['interleave'] = interleave
+            # memory budget of two lines, so the last block is partial
+            fh = StringIO()
+            self.cube.writeRawData(fh, options, max_bytes=2 * 5 * 3 * 2)
+            eq_(fh.getvalue(), data.tostring())
+            
+            # non-seekable output requires multiple passes for BSQ
+            fh = NonSeekableWriter()
+            self.cube.writeRawData(fh, options, max_bytes=2 * 5 * 3 * 2)
+            eq_(fh.getvalue(), data.tostring())
+    
+    def testExportSwapped(self):
+        bsq = numpy.array([self.mem.getBandRaw(i) for i in range(3)])
+        bip = bsq.transpose(1, 2, 0).byteswap()
+        transposer = InterleaveTransposer(self.cube, 'bip', 2 * 5 * 3 * 2)
+        # scratch array only large enough for one line at a time
+        transposer.write_bytes = 5 * 3 * 2
+        endian = HSI.byteordertext[1 - HSI.nativeByteOrder]
+        fh = StringIO()
+        transposer.write(fh, endian)
+        eq_(fh.getvalue(), bip.tostring())
+
+class testFileBIPCube(baseFileCube):
+    interleave = 'bip'
+
+class testFileBILCube(baseFileCube):
+    interleave = 'bil'
+
+class testFileBSQCube(baseFileCube):
+    interleave = 'bsq'
+
+class testFileBIPSwappedCube(baseFileCube):
+    interleave = 'bip'
+    byte_order = 1 - HSI.nativeByteOrder
+
+class testFileBILSwappedCube(baseFileCube):
+    interleave = 'bil'
+    byte_order = 1 - HSI.nativeByteOrder
+
+class testFileBSQSwappedCube(baseFileCube):
+    interleave = 'bsq'
+    byte_order = 1 - HSI.nativeByteOrder
+
+class testStatistics(baseFileCube):
+    interleave = 'bil'
+    
+    def setUp(self):
+        baseFileCube.setUp(self)
+        self.save_dir = StatsCache.cache_dir
+        StatsCache.cache_dir = os.path.join(self.dirname, "stats")
+    
+    def tearDown(self):
+        StatsCache.cache_dir = self.save_dir
+        baseFileCube.tearDown(self)
+    
+    def testStats(self):
+        # two lines per block so the statistics are combined across blocks
+        stats = BandStatistics(3)
+        for line in range(0, 7, 2):
+            stats.addBlock(self.cube.getFocalPlanesRaw(line, min(line + 2, 7)))
+        for band in range(3):
+            data = self.mem.getBandRaw(band).astype(numpy.float64)
+            eq_(stats.minimum[band], data.min())
+            eq_(stats.maximum[band], data.max())
+            assert abs(stats.mean[band] - data.mean()) < 1e-9
+            assert abs(stats.stddev[band] - data.std()) < 1e-9
+            counts, edges = stats.getHistogram(band)
+            eq_(counts.sum(), data.size)
+            eq_(numpy.histogram(data, edges)[0].tolist(), counts.tolist())
+    
+    def testHistogramExpansion(self):
+        stats = BandStatistics(1)
+        stats.addBlock(numpy.arange(10, 20).reshape(1, 1, 10))
+        stats.addBlock(numpy.arange(-1000, 1000).reshape(1, 1, 2000))
+        counts, edges = stats.getHistogram(0)
+        eq_(counts.sum(), 2010)
+        assert edges[0] <= -1000
+        assert edges[-1] > 999
+        data = numpy.concatenate([numpy.arange(10, 20), numpy.arange(-1000, 1000)])
+        eq_(numpy.histogram(data, edges)[0].tolist(), counts.tolist())
+    
+    def reload(self, filename):
+        self.cube.cube_io.fh.close()
+        save = HSI.Cube.mmap_size_limit
+        HSI.Cube.mmap_size_limit = 1
+        try:
+            self.cube = loadCube(filename)
+        finally:
+            HSI.Cube.mmap_size_limit = save
+        return self.cube
+    
+    def testSidecar(self):
+        stats = self.cube.getStatistics()
+        eq_(self.cube.getUpdatedExtrema(), [0, 7 * 5 * 3 - 1])
+        
+        # reopening the cube uses the saved statistics
+        filename = str(self.cube.url.path)
+        cube = self.reload(filename)
+        loaded = cube.getStatistics(compute=False)
+        assert loaded is not None
+        eq_(loaded.mean.tolist(), stats.mean.tolist())
+        eq_(loaded.counts.tolist(), stats.counts.tolist())
+        
+        # changing the file invalidates the saved statistics
+        fh = open(filename, "ab")
+        fh.write("xx")
+        fh.close()
+        cube = self.reload(filename)
+        eq_(cube.getStatistics(compute=False), None)
+    
+    def testContrastFromSummary(self):
+        from peppy.hsi.filter import ContrastFilter
+        filt = ContrastFilter(0.1)
+        raw = self.mem.getBandRaw(1)
+        summary = self.cube.getStatistics().getBandSummary(1)
+        plane, result = filt.getPlaneWithSummary(raw, summary)
+        
+        # the histogram bins differ slightly from the bins calculated from
+        # the plane, but the stretch should be nearly the same
+        tolerance = (raw.max() - raw.min()) / 50.0
+        for expected, actual in zip(filt.getStretchRange(raw), result.getExtrema()):
+            assert abs(expected - actual) <= tolerance
+        eq_(plane.min(), result.minimum)
+        eq_(plane.max(), result.maximum)
+
+
+class RecordingUpdater(ProgressUpdater):
+    def __init__(self):
+        ProgressUpdater.__init__(self)
+        self.status = []
+        self.percent = []
+        self.result = None
+    
+    def updateStatus(self, cur=-1, max=-1, text=None):
+        self.status.append((cur, max))
+        self.percent.append(self.calcPercentComplete(cur, max))
+    
+    def reportSuccess(self, text, data=None):
+        self.result = data
+
+class testParallelCompare(baseFileCube):
+    interleave = 'bil'
+    
+    def setUp(self):
+        baseFileCube.setUp(self)
+        self.dirname2 = tempfile.mkdtemp()
+        self.cube2 = fileCube(self.dirname2, 'bip')
+        data = numpy.arange(7 * 5 * 3)[::-1] % 17
+        fh = open(str(self.cube2.url.path), "wb")
+        fh.write(data.astype(numpy.int16).tostring())
+        fh.close()
+        HSI.Cube.tile_cache.clear()
+    
+    def tearDown(self):
+        self.cube2.cube_io.fh.close()
+        shutil.rmtree(self.dirname2)
+        baseFileCube.tearDown(self)
+    
+    def testParallel(self):
+        comp = CubeCompare(self.cube, self.cube2)
+        assert comp.canCompareInParallel()
+        dist = comp.getEuclideanDistance().getBandRaw(0).copy()
+        sam = comp.getSpectralAngle().getBandRaw(0).copy()
+        assert dist.max() > 0
+        
+        updater = RecordingUpdater()
+        pdist, psam = comp.getDistancesInParallel(updater, processes=2)
+        assert numpy.allclose(dist, pdist.getBandRaw(0))
+        assert numpy.allclose(sam, psam.getBandRaw(0))
+        eq_(updater.status[-1], (7, 7))
+    
+    def testThreaded(self):
+        save = utils.ThreadedCubeCompare.processes
+        utils.ThreadedCubeCompare.processes = 2
+        try:
+            updater = RecordingUpdater()
+            # left over from a previous use of the updater
+            updater.setNumberOfWorkItems(3)
+            thread = utils.ThreadedCubeCompare(self.cube, self.cube2, updater)
+            eq_(thread.processes, 2)
+            thread.run()
+        finally:
+            utils.ThreadedCubeCompare.processes = save
+        eq_(updater.result.band_names, ['Euclidean Distance', 'Spectral Angle'])
+        # the parallel comparison is a single work item
+        eq_(updater.percent[-1], 100.0)
+    
+    def testMemoryCube(self):
+        comp = CubeCompare(self.cube, self.mem)
+        assert not comp.canCompareInParallel()
+
+
+class testKMeans(object):
+    def setUp(self):
+        rs = numpy.random.RandomState(4)
+        self.centers = numpy.array([[100, 100, 100, 100], [1000, 200, 1000, 200], [0, 2000, 0, 4000]], dtype=numpy.float64)
+        self.truth = rs.randint(0, 3, (20, 10))
+        data = self.centers[self.truth] + rs.normal(0, 5, (20, 10, 4))
+        self.cube = HSI.createCube('bip', 20, 10, 4, numpy.float32, data=data.astype(numpy.float32).tostring())
+    
+    def testClusters(self):
+        kmeans = MiniBatchKMeans(self.cube, 3, seed=1)
+        kmeans.tile_bytes = 4 * 10 * 4 * 4
+        kmeans.tiles = 3
+        kmeans.batch_size = 20
+        kmeans.train()
+        # each true cluster is found, in some order
+        order = [numpy.argmin(((kmeans.centers - center) ** 2).sum(axis=1)) for center in self.centers]
+        eq_(sorted(order), [0, 1, 2])
+        assert numpy.allclose(kmeans.centers[order], self.centers, atol=20)
+        result = kmeans.classify(processes=1)
+        eq_((result.lines, result.samples, result.bands), (20, 10, 1))
+        eq_(result.spectra_names, ['Class 1', 'Class 2', 'Class 3'])
+        labels = result.getBandRaw(0)
+        eq_(labels.tolist(), numpy.array(order)[self.truth].tolist())
+    
+    def testBadBands(self):
+        self.cube.bbl = [1, 0, 1, 0]
+        kmeans = MiniBatchKMeans(self.cube, 3, seed=1)
+        kmeans.train()
+        eq_(kmeans.centers.shape, (3, 2))
+    
+    def testErrors(self):
+        assert_raises(ValueError, MiniBatchKMeans, self.cube, 0)
+        assert_raises(ValueError, MiniBatchKMeans(self.cube, 300).train)
+
+
+class testParallelKMeans(baseFileCube):
+    interleave = 'bsq'
+    
+    def testParallel(self):
+        kmeans = MiniBatchKMeans(self.cube, 4, seed=2)
+        kmeans.train()
+        serial = kmeans.classify(processes=1).getBandRaw(0).copy()
+        expected = utils.getNearestCentersOfBlock(self.mem.getFocalPlanesRaw(0, 7), kmeans.good, kmeans.centers)
+        eq_(serial.tolist(), expected.tolist())
+        result = kmeans.classify(processes=2)
+        eq_(result.getBandRaw(0).tolist(), serial.tolist())
+
+
+class testMixedInterleaveCompare(testParallelCompare):
+    interleave = 'bsq'
+    
+    def testLineBlocks(self):
+        comp = CubeCompare(self.cube, self.cube2)
+        comp.block_bytes = 2 * 5 * 3 * 4
+        eq_(comp.getLinesPerBlock(), 2)
+        
+        dist = comp.getEuclideanDistanceByFocalPlane(comp.iterBILBIP())
+        sam = comp.getSpectralAngleByFocalPlane(comp.iterBILBIP())
+        heatmap = comp.getHeatMapByFocalPlane(comp.iterBILBIP()).getBandRaw(0).copy()
+        diff = comp.getDifferenceByFocalPlane(comp.iterBILBIP())
+        hist = comp.getHistogramByFocalPlane(comp.iterBILBIP(), 20).data.copy()
+        
+        assert numpy.allclose(dist.getBandRaw(0), comp.getEuclideanDistance().getBandRaw(0))
+        assert numpy.allclose(sam.getBandRaw(0), comp.getSpectralAngle().getBandRaw(0))
+        eq_(heatmap.tolist(), comp.getHeatMap().getBandRaw(0).tolist())
+        eq_(diff.getFocalPlanesRaw(0, 7).tolist(), comp.getDifference().getFocalPlanesRaw(0, 7).tolist())
+        eq_(hist.tolist(), comp.getHistogram(20).data.tolist())
+
+
+class testReadAhead(object):
+    def setUp(self):
+        self.loaded = []
+    
+    def load(self, start, end):
+        if start == 6:
+            raise ValueError("failed at %d" % start)
+        self.loaded.append(start)
+        return range(start, end)
+    
+    def testOrder(self):
+        eq_(getRanges(10, 4), [(0, 4), (4, 8), (8, 10)])
+        eq_(getRanges(10, 4, 2), [(2, 6), (6, 10)])
+        blocks = list(ReadAheadIterator(self.load, getRanges(6, 2)))
+        eq_(blocks, [(0, [0, 1]), (2, [2, 3]), (4, [4, 5])])
+    
+    def testError(self):
+        it = iter(ReadAheadIterator(self.load, getRanges(10, 2)))
+        eq_(it.next(), (0, [0, 1]))
+        eq_(it.next(), (2, [2, 3]))
+        eq_(it.next(), (4, [4, 5]))
+        assert_raises(ValueError, it.next)
+    
+    def testStop(self):
+        reader = ReadAheadIterator(self.load, getRanges(100, 1, 10))
+        for start, block in reader:
+            break
+        assert not reader.thread.isAlive()
+        # the thread is never more than depth blocks ahead of the caller
+        assert len(self.loaded) <= 3
+
+
+class testResampler(object):
+    def setUp(self):
+        self.source = [400.0, 410.0, 430.0, 460.0, 500.0]
+        self.target = [395.0, 405.0, 415.0, 430.0, 480.0, 520.0]
+        numpy.random.seed(0)
+        self.spectra = numpy.random.rand(50, len(self.source))
+    
+    def testInterpolation(self):
+        resampler = HSI.SpectralResampler(self.source, self.target)
+        resampled = resampler.resample(self.spectra)
+        eq_(resampled.shape, (50, 6))
+        for i in range(50):
+            expected = numpy.interp(self.target, self.source, self.spectra[i])
+            assert numpy.allclose(resampled[i], expected)
+        single = HSI.resampleSingle(self.target, self.source, list(self.spectra[0]))
+        assert numpy.allclose(single, resampled[0])
+    
+    def testBadBands(self):
+        bbl = [1, 1, 0, 1, 1]
+        resampler = HSI.SpectralResampler(self.source, self.target, bbl)
+        eq_(resampler.weights[:, 2].tolist(), [0.0] * 6)
+        good = [0, 1, 3, 4]
+        expected = numpy.interp(self.target, numpy.take(self.source, good), self.spectra[0, good])
+        assert numpy.allclose(resampler.resample(self.spectra[0]), expected)
+        resampler = HSI.SpectralResampler(self.source, self.target, numpy.array(bbl))
+        assert numpy.allclose(resampler.resample(self.spectra[0]), expected)
+    
+    def testSingleBadBands(self):
+        # the ends of the target outside the good bands are held at the
+        # value of the nearest good band
+        spectrum = list(self.spectra[0])
+        single = HSI.resampleSingle(self.target, self.source, spectrum, [1, 1, 1, 1, 0, 1])
+        expected = numpy.interp(self.target, self.source, spectrum)
+        assert numpy.allclose(single[1:4], expected[1:4])
+        assert numpy.allclose(single[0], expected[1])
+        assert numpy.allclose(single[4:], [expected[3]] * 2)
+    
+    def testCache(self):
+        r1 = HSI.SpectralResampler.getResampler(self.source, self.target)
+        r2 = HSI.SpectralResampler.getResampler(list(self.source), list(self.target))
+        assert r1 is r2
+        assert r1 is not HSI.SpectralResampler.getResampler(self.source, self.target, [1, 0, 1, 1, 1])
+        r3 = HSI.SpectralResampler.getResampler(self.source, self.target, numpy.array([1, 0, 1, 1, 1]))
+        assert r3 is HSI.SpectralResampler.getResampler(self.source, self.target, [1, 0, 1, 1, 1])
+    
+    def testCube(self):
+        data = (numpy.arange(4 * 3 * 5) % 11).astype(numpy.int16)
+        cube = HSI.createCube('bip', 4, 3, 5, numpy.int16, data=data.tostring())
+        cube.wavelengths = self.source[:]
+        resampler = HSI.SpectralResampler(self.source, self.target)
+        resampler.block_bytes = 3 * 5 * 2
+        output = resampler.resampleCube(cube)
+        eq_(output.bands, 6)
+        eq_(output.wavelengths, self.target)
+        for line in range(4):
+            for sample in range(3):
+                expected = numpy.interp(self.target, self.source, cube.getSpectra(line, sample))
+                assert numpy.allclose(output.getSpectra(line, sample), expected)
+
+
+class testLibraryMatch(object):
+    def setUp(self):
+        numpy.random.seed(1)
+        self.library = HSI.createCube('bip', 1, 4, 6, numpy.float32)
+        self.library.getFocalPlaneRaw(0)[:,:] = numpy.random.rand(6, 4) + 0.1
+        self.library.spectra_names = ['a', 'b', 'c', 'd']
+        self.cube = HSI.createCube('bil', 5, 3, 6, numpy.float32)
+        for line in range(5):
+            plane = self.cube.getFocalPlaneRaw(line)
+            plane[:,:] = numpy.random.rand(6, 3) * 2.0
+    
+    def brute(self, line, sample):
+        pixel = self.cube.getSpectra(line, sample).astype(numpy.float64)
+        angles = []
+        distances = []
+        for i in range(4):
+            spectrum = self.library.getSpectra(0, i).astype(numpy.float64)
+            cosine = numpy.dot(pixel, spectrum) / numpy.sqrt(numpy.dot(pixel, pixel) * numpy.dot(spectrum, spectrum))
+            angles.append(numpy.degrees(numpy.arccos(min(cosine, 1.0))))
+            distances.append(numpy.sqrt(((pixel - spectrum) ** 2).sum()))
+        return angles, distances
+    
+    def testMatch(self):
+        self.checkMatch(2 * 3 * 6 * 8)
+    
+    def testLibraryChunks(self):
+        # one library spectrum compared at a time
+        matcher = SpectralLibraryMatcher(self.library, self.cube)
+        matcher.block_bytes = 3 * 2 * 8
+        eq_(matcher.getSpectraPerChunk(3), 1)
+        self.checkMatch(3 * 2 * 8)
+    
+    def checkMatch(self, block_bytes):
+        matcher = SpectralLibraryMatcher(self.library, self.cube)
+        matcher.block_bytes = block_bytes
+        sam_class, sam_score = matcher.match('sam')
+        euc_class, euc_score = matcher.match('euclidean')
+        eq_(sam_class.spectra_names, ['a', 'b', 'c', 'd'])
+        for line in range(5):
+            for sample in range(3):
+                angles, distances = self.brute(line, sample)
+                eq_(sam_class.getPixel(line, sample, 0), numpy.argmin(angles))
+                assert numpy.allclose(sam_score.getPixel(line, sample, 0), min(angles), atol=1e-3)
+                eq_(euc_class.getPixel(line, sample, 0), numpy.argmin(distances))
+                assert numpy.allclose(euc_score.getPixel(line, sample, 0), min(distances), atol=1e-4)
+    
+    def testResampledLibrary(self):
+        self.cube.wavelengths = [400.0, 410.0, 420.0, 430.0, 440.0, 450.0]
+        self.library.wavelengths = [400.0, 420.0, 440.0, 460.0, 480.0, 500.0]
+        matcher = SpectralLibraryMatcher(self.library, self.cube, scale=2.0)
+        expected = numpy.interp(self.cube.wavelengths, self.library.wavelengths, self.library.getSpectra(0, 1)) * 2.0
+        assert numpy.allclose(matcher.spectra[1], expected)
+        assert_raises(ValueError, matcher.match, 'unknown')
+    
+    def testScale(self):
+        self.library.scale_factor = 1.0
+        self.cube.scale_factor = 10000.0
+        eq_(SpectralLibraryMatcher.getScale(self.library, self.cube), 10000.0)
+        # unknown or inconsistent scale factors leave the library unscaled
+        self.cube.scale_factor = -1.0
+        eq_(SpectralLibraryMatcher.getScale(self.library, self.cube), 1.0)
+        self.cube.scale_factor = 10000.0
+        self.library.scale_factor = None
+        eq_(SpectralLibraryMatcher.getScale(self.library, self.cube), 1.0)
+
+
+class testROIStatistics(object):
+    def setUp(self):
+        data = numpy.arange(6 * 4 * 3).astype(numpy.int16)
+        self.cube = HSI.createCube('bsq', 6, 4, 3, numpy.int16, data=data.tostring())
+        self.roi = HSI.ROI('test')
+        for i, (x, y) in enumerate([(0, 0), (3, 1), (1, 5), (2, 2)]):
+            self.roi.addPoint(i, x, y)
+    
+    def testStatistics(self):
+        spectra = numpy.array([self.cube.getSpectra(y, x) for x, y in self.roi.points], dtype=numpy.float64)
+        eq_(self.roi.getSpectraArray(self.cube).tolist(), spectra.tolist())
+        stats = self.roi.getStatistics(self.cube)
+        eq_(stats.count, 4)
+        assert numpy.allclose(stats.mean, spectra.mean(axis=0))
+        assert numpy.allclose(stats.stddev, spectra.std(axis=0))
+        eq_(stats.minimum.tolist(), spectra.min(axis=0).tolist())
+        eq_(stats.maximum.tolist(), spectra.max(axis=0).tolist())
+        cols = self.roi.getAverageOfColumns(self.cube)
+        assert numpy.allclose(cols[0].spectra, spectra.mean(axis=0) / 10000.0)
+
+
+class testHistogram(object):
+    def setUp(self):
+        self.cube = HSI.createCube('bil', 2, 5, 2, numpy.int16)
+        self.diff = numpy.array([[[0, 0, 0, 0, 0], [3, 3, 3, 3, 3]],
+                                 [[1, 1, 2, 5, 9], [3, 3, 3, 3, 12]]])
+    
+    def testAddBlock(self):
+        h = Histogram(self.cube, 10, [1, 1])
+        h.addBlock(self.diff[0:1], self.diff[0:1] + 100)
+        h.addBlock(self.diff[1:2], self.diff[1:2] + 100)
+        for band in range(2):
+            counts, bins = numpy.histogram(self.diff[:, band, :], bins=10, range=(0, 10))
+            eq_(h.data[band].tolist(), counts.tolist())
+        eq_(h.maxdiff.tolist(), [9, 12])
+        eq_(h.maxvalue.tolist(), [109, 112])
+        eq_(h.getLastBins().tolist(), [9, 3])
+    
+    def testAccumulation(self):
+        h = Histogram(self.cube, 10, [1, 0])
+        h.addBlock(self.diff)
+        h.calcAccumulation(2)
+        eq_(h.accumulation.tolist(), [[0, 9], [0, 0]])
+
+
+class testRGBMapper(object):
+    def setUp(self):
+        numpy.random.seed(0)
+        self.int16 = (numpy.random.randn(37, 11) * 1000).astype(numpy.int16)
+        self.swapped = self.int16.byteswap().newbyteorder()
+        self.float32 = numpy.random.randn(37, 11).astype(numpy.float32)
+        self.bip = numpy.arange(37 * 11 * 3).astype(numpy.uint8).reshape(37, 11, 3)[:,:,1]
+    
+    def getReference(self, plane, extrema, clip, colormap=None):
+        from peppy.hsi.filter import RGBMapper, clipValues
+        gray = RGBMapper().getGray(clipValues(plane, clip), extrema=extrema)
+        if colormap is None:
+            return numpy.dstack([gray, gray, gray])
+        return colormap(gray, bytes=True)[:,:,0:3]
+    
+    def checkMapper(self, mapper, colormap=None):
+        from peppy.hsi.filter import ContrastFilter
+        mapper.tile_lines = 8
+        filt = ContrastFilter(0.1)
+        output = None
+        for plane in [self.int16, self.swapped, self.float32, self.bip]:
+            for clip, extrema in [(None, None), ((-500, 700), (-500, 700)),
+                                  ((None, 0), None)]:
+                output = mapper.getRGB(37, 11, [plane], [extrema], [clip], output)
+                ref = self.getReference(plane, extrema, clip, colormap)
+                eq_(output.tolist(), ref.tolist())
+            lo, hi, summary = filt.getClipWithSummary(plane)
+            rgb = mapper.getRGB(37, 11, [plane], [summary.getExtrema()], [(lo, hi)])
+            filtered, summary = filt.getPlaneWithSummary(plane)
+            eq_(rgb.tolist(), self.getReference(filtered, summary.getExtrema(), None, colormap).tolist())
+    
+    def testGray(self):
+        from peppy.hsi.filter import RGBMapper
+        self.checkMapper(RGBMapper())
+    
+    def testPalette(self):
+        from peppy.hsi.filter import PaletteMapper
+        mapper = PaletteMapper('jet')
+        self.checkMapper(mapper, mapper.colormap)
+    
+    def testRGB(self):
+        from peppy.hsi.filter import RGBMapper
+        planes = [self.int16, self.float32, self.bip]
+        rgb = RGBMapper().getRGB(37, 11, planes)
+        for i in range(3):
+            eq_(rgb[:,:,i].tolist(), self.getReference(planes[i], None, None)[:,:,0].tolist())
+
+
+class SmallOverviewPyramid(OverviewPyramid):
+    min_size = 2
+
+class testOverviews(baseFileCube):
+    interleave = 'bsq'
+    
+    def setUp(self):
+        baseFileCube.setUp(self)
+        HSI.Cube.tile_cache.clear()
+        self.save = (OverviewPyramid.cache_dir, OverviewPyramid.max_bytes)
+        OverviewPyramid.cache_dir = os.path.join(self.dirname, "overviews")
+    
+    def tearDown(self):
+        OverviewPyramid.cache_dir, OverviewPyramid.max_bytes = self.save
+        baseFileCube.tearDown(self)
+    
+    def testReduceSampling(self):
+        band = numpy.arange(7 * 9, dtype=numpy.int16).reshape(7, 9)
+        reduced = HSI.bandReduceSampling(band, 2)
+        eq_(reduced.shape, (3, 4))
+        for line in range(3):
+            for sample in range(4):
+                avg = numpy.average(band[line*2:line*2+2, sample*2:sample*2+2])
+                eq_(reduced[line, sample], int(avg))
+    
+    def testLevels(self):
+        eq_(SmallOverviewPyramid.getMaxLevel(self.cube), 2)
+        eq_(SmallOverviewPyramid.getLevelForZoom(self.cube, 1.0), 1)
+        eq_(SmallOverviewPyramid.getLevelForZoom(self.cube, 0.5), 2)
+        eq_(SmallOverviewPyramid.getLevelForZoom(self.cube, 0.125), 2)
+    
+    def testSaved(self):
+        pyramid = SmallOverviewPyramid(self.cube)
+        overview = pyramid.getBand(1, 2)
+        expected = HSI.bandReduceSampling(self.mem.getBandRaw(1), 2)
+        eq_(overview.tolist(), expected.tolist())
+        path = pyramid.getCacheDir()
+        eq_(os.path.dirname(path), OverviewPyramid.cache_dir)
+        assert os.path.exists(os.path.join(path, "band1-level2.npy"))
+        assert not os.path.exists(str(self.cube.url.path) + ".overviews")
+        
+        # a new pyramid should load the overview from disk
+        HSI.Cube.tile_cache.clear()
+        pyramid = SmallOverviewPyramid(self.cube)
+        pyramid.build = None
+        eq_(pyramid.getBand(1, 2).tolist(), expected.tolist())
+    
+    def testCacheSize(self):
+        pyramid = SmallOverviewPyramid(self.cube)
+        pyramid.getBand(0, 2)
+        old = pyramid.getFilename(0, 2)
+        os.utime(old, (time.time() - 100, time.time() - 100))
+        
+        # the old overview is removed to make room for the new one
+        OverviewPyramid.max_bytes = os.path.getsize(old)
+        pyramid.getBand(1, 2)
+        assert not os.path.exists(old)
+        assert os.path.exists(pyramid.getFilename(1, 2))
+        
+        # overviews larger than the limit aren't saved at all
+        OverviewPyramid.max_bytes = 1
+        pyramid.getBand(2, 2)
+        assert not os.path.exists(pyramid.getFilename(2, 2))
+    
+    def testNotSaved(self):
+        OverviewPyramid.cache_dir = None
+        pyramid = SmallOverviewPyramid(self.cube)
+        expected = HSI.bandReduceSampling(self.mem.getBandRaw(1), 2)
+        eq_(pyramid.getBand(1, 2).tolist(), expected.tolist())
+        eq_(pyramid.getCacheDir(), None)
+
+
+class testBlockHelpers(object):
+    def setUp(self):
+        self.cube = HSI.createCube('bil', 10, 4, 5, numpy.int16)
+    
+    def testGoodBands(self):
+        eq_(self.cube.getGoodBands().tolist(), [0, 1, 2, 3, 4])
+        self.cube.bbl = [1, 0, 1, 0, 1]
+        eq_(self.cube.getGoodBands().tolist(), [0, 2, 4])
+    
+    def testLinesPerBlock(self):
+        self.cube.readahead_bytes = 100
+        eq_(self.cube.getLinesPerBlock(30), 3)
+        eq_(self.cube.getLinesPerBlock(30, 65), 2)
+        eq_(self.cube.getLinesPerBlock(1000), 1)
+        eq_(self.cube.getLinesPerBlock(1), 10)
+
+
+class testCubeReduction(object):
+    def setUp(self):
+        numpy.random.seed(2)
+        self.data = numpy.random.randint(0, 1000, size=(40, 3, 5)).astype(numpy.int16)
+        self.cube = HSI.createCube('bil', 40, 5, 3, numpy.int16, data=self.data.tostring())
+        # force several blocks so values are combined between blocks
+        self.cube.readahead_bytes = 7 * 3 * 5 * 2
+    
+    def testLines(self):
+        ops = ['mean', 'variance', 'stddev', 'minimum', 'maximum', 'median', 'p90']
+        results = self.cube.getReduction('lines', ops)
+        data = self.data.astype(numpy.float64)
+        eq_(results['mean'].shape, (3, 5))
+        assert numpy.allclose(results['mean'], data.mean(axis=0))
+        assert numpy.allclose(results['variance'], data.var(axis=0))
+        assert numpy.allclose(results['stddev'], data.std(axis=0))
+        eq_(results['minimum'].tolist(), data.min(axis=0).tolist())
+        eq_(results['maximum'].tolist(), data.max(axis=0).tolist())
+        # percentiles are estimated from histograms, so allow a couple of
+        # bin widths of error
+        tolerance = 2 * 1000.0 / CubeReduction.bins
+        assert numpy.allclose(results['median'], numpy.median(data, axis=0), atol=2 * tolerance)
+        assert numpy.allclose(results['p90'], numpy.percentile(data, 90, axis=0), atol=2 * tolerance)
+    
+    def testWithinBlocks(self):
+        data = self.data.astype(numpy.float64)
+        results = self.cube.getReduction('samples', ['mean', 'median'])
+        eq_(results['mean'].shape, (40, 3))
+        assert numpy.allclose(results['mean'], data.mean(axis=2))
+        assert numpy.allclose(results['median'], numpy.median(data, axis=2))
+        results = self.cube.getReduction('bands', ['maximum', 'p25'])
+        eq_(results['maximum'].shape, (40, 5))
+        eq_(results['maximum'].tolist(), data.max(axis=1).tolist())
+        assert numpy.allclose(results['p25'], numpy.percentile(data, 25, axis=1))
+        results = self.cube.getReduction('samples', ['p0', 'p37.5', 'p100'])
+        eq_(results['p0'].tolist(), data.min(axis=2).tolist())
+        eq_(results['p100'].tolist(), data.max(axis=2).tolist())
+        assert numpy.allclose(results['p37.5'], numpy.percentile(data, 37.5, axis=2))
+    
+    def testReducedCube(self):
+        self.cube.wavelengths = [400.0, 500.0, 600.0]
+        results = self.cube.getReduction('lines', ['mean'])
+        reduced = self.cube.createReducedCube('lines', results['mean'])
+        eq_((reduced.lines, reduced.samples, reduced.bands), (1, 5, 3))
+        eq_(reduced.wavelengths, [400.0, 500.0, 600.0])
+        assert numpy.allclose(reduced.getFocalPlaneRaw(0), results['mean'])
+        results = self.cube.getReduction('bands', ['stddev'])
+        reduced = self.cube.createReducedCube('bands', results['stddev'], 'stddev')
+        eq_((reduced.lines, reduced.samples, reduced.bands), (40, 5, 1))
+        eq_(reduced.band_names, ['stddev'])
+        assert numpy.allclose(reduced.getBandRaw(0), results['stddev'])
+    
+    def testUnknown(self):
+        assert_raises(ValueError, self.cube.getReduction, 'lines', ['mode'])
+        assert_raises(ValueError, self.cube.getReduction, 'lines', ['p101'])
+        assert_raises(ValueError, self.cube.getReduction, 'pixels', ['mean'])
+
+
+class testBandMath(object):
+    def setUp(self):
+        data = numpy.arange(9 * 4 * 5).astype(numpy.int16)
+        self.cube = HSI.createCube('bsq', 9, 4, 5, numpy.int16, data=data.tostring())
+        self.bands = [self.cube.getBand(i).astype(numpy.float64) for i in range(5)]
+    
+    def testNormalizedDifference(self):
+        expression = BandMath("(b[3]-b[1])/(b[3]+b[1])")
+        eq_(expression.bands, [3, 1])
+        # the difference and sum share the two band registers and only need
+        # two temporaries
+        eq_(expression.registers, 4)
+        expression.block_bytes = 1
+        result = expression.apply(self.cube)
+        eq_((result.lines, result.samples, result.bands), (9, 4, 1))
+        b = self.bands
+        assert numpy.allclose(result.getBandRaw(0), (b[3] - b[1]) / (b[3] + b[1]))
+    
+    def testFunctions(self):
+        expression = BandMath("-sqrt(abs(b[2] - 2 * 50)) + max(b[0], b[4] / 2.0) ** 2", band_offset=0)
+        result = expression.apply(self.cube)
+        b = self.bands
+        expected = -numpy.sqrt(numpy.abs(b[2] - 100)) + numpy.maximum(b[0], b[4] / 2.0) ** 2
+        assert numpy.allclose(result.getBandRaw(0), expected)
+    
+    def testBandOffset(self):
+        result = BandMath("b[1]", band_offset=1).apply(self.cube)
+        assert numpy.allclose(result.getBandRaw(0), self.bands[0])
+        result = BandMath("(1 + 2) * 3").apply(self.cube)
+        assert numpy.allclose(result.getBandRaw(0), 9.0)
+    
+    def testReferencedBandsOnly(self):
+        # a BSQ file cube must only read the lines of the referenced bands
+        dirname = tempfile.mkdtemp()
+        try:
+            cube = fileCube(dirname, 'bsq', lines=9, samples=4, bands=5)
+            reads = []
+            def getBandLinesRaw(band, line1, line2, original=cube.cube_io.getBandLinesRaw):
+                reads.append(band)
+                return original(band, line1, line2)
+            cube.cube_io.getBandLinesRaw = getBandLinesRaw
+            cube.cube_io.getFocalPlanesRaw = None
+            expression = BandMath("b[4] - b[2]", band_offset=1)
+            expression.block_bytes = 1
+            result = expression.apply(cube)
+            eq_(sorted(set(reads)), [1, 3])
+            eq_(len(reads), 2 * 9)
+            b = self.bands
+            assert numpy.allclose(result.getBandRaw(0), b[3] - b[1])
+            cube.cube_io.fh.close()
+        finally:
+            shutil.rmtree(dirname)
+    
+    def testErrors(self):
+        assert_raises(ValueError, BandMath, "b[1] +")
+        assert_raises(ValueError, BandMath, "b[1.5]")
+        assert_raises(ValueError, BandMath, "c[1]")
+        assert_raises(ValueError, BandMath, "__import__('os')")
+        assert_raises(ValueError, BandMath, "sqrt(b[1], b[2])")
+        assert_raises(ValueError, BandMath("b[5]").apply, self.cube)
+
+
+class testPrincipalComponents(object):
+    def setUp(self):
+        numpy.random.seed(3)
+        self.data = (numpy.random.rand(12, 6, 7) * 1000 + 5000).astype(numpy.float32)
+        self.cube = HSI.createCube('bil', 12, 7, 6, numpy.float32, data=self.data.tostring())
+        self.cube.bbl = [1, 1, 0, 1, 1, 1]
+        pixels = self.data.transpose(0, 2, 1).reshape(-1, 6).astype(numpy.float64)
+        self.pixels = pixels[:, [0, 1, 3, 4, 5]]
+    
+    def testCovariance(self):
+        pca = PrincipalComponents(self.cube)
+        pca.block_bytes = 3 * 7 * 5 * 8
+        pca.calculate()
+        eq_(pca.count, 12 * 7)
+        assert numpy.allclose(pca.mean, self.pixels.mean(axis=0))
+        assert numpy.allclose(pca.covariance, numpy.cov(self.pixels, rowvar=False))
+        assert numpy.all(numpy.diff(pca.eigenvalues) <= 0)
+    
+    def testTransform(self):
+        pca = PrincipalComponents(self.cube)
+        pca.block_bytes = 5 * 7 * 5 * 8
+        result = pca.transform(3)
+        eq_((result.lines, result.samples, result.bands), (12, 7, 3))
+        eq_(result.band_names, ['PC 1', 'PC 2', 'PC 3'])
+        expected = numpy.dot(self.pixels - self.pixels.mean(axis=0), pca.eigenvectors[:, 0:3])
+        expected = expected.reshape(12, 7, 3).transpose(2, 0, 1)
+        assert numpy.allclose(result.getNumpyArray(), expected, atol=1e-2)
+        # components are uncorrelated and ordered by variance
+        variances = [result.getBandRaw(i).astype(numpy.float64).var(ddof=1) for i in range(3)]
+        assert numpy.allclose(variances, pca.eigenvalues[0:3], rtol=1e-4)
+    
+    def testMinimumNoiseFraction(self):
+        mnf = MinimumNoiseFraction(self.cube)
+        result = mnf.transform()
+        eq_(result.bands, 5)
+        eq_(result.band_names[0], 'MNF 1')
+        # the transform whitens the noise estimate
+        whitened = numpy.dot(mnf.eigenvectors.T, numpy.dot(mnf.noise, mnf.eigenvectors))
+        assert numpy.allclose(whitened, numpy.identity(5), atol=1e-6)
+    
+    def testAllBad(self):
+        self.cube.bbl = [0] * 6
+        assert_raises(ValueError, PrincipalComponents, self.cube)
+
+
+class testChunkedCube(object):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        data = numpy.arange(9 * 7 * 5).astype(numpy.int16)
+        self.mem = HSI.createCube('bip', 9, 7, 5, numpy.int16, data=data.tostring())
+        self.mem.wavelengths = [400.0, 500.0, 600.0, 700.0, 800.0]
+        self.mem.band_names = ['a', 'b', 'c', 'd', 'e']
+        self.mem.bbl = [1, 1, 0, 1, 1]
+        self.filename = os.path.join(self.dirname, "test.pcc")
+    
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+    
+    def export(self, **options):
+        ChunkedDataset.export(self.filename, self.mem, options=options)
+        dataset = HSI.HyperspectralFileFormat.load(self.filename)
+        assert isinstance(dataset, ChunkedDataset)
+        return dataset.getCube()
+    
+    def checkCube(self, cube):
+        eq_((cube.lines, cube.samples, cube.bands), (9, 7, 5))
+        eq_(cube.wavelengths, [400.0, 500.0, 600.0, 700.0, 800.0])
+        eq_(cube.band_names, ['a', 'b', 'c', 'd', 'e'])
+        eq_(cube.bbl, [1, 1, 0, 1, 1])
+        eq_(cube.getFocalPlanesRaw(0, 9).tolist(), self.mem.getFocalPlanesRaw(0, 9).tolist())
+        eq_(cube.getFocalPlanesRaw(2, 5).tolist(), self.mem.getFocalPlanesRaw(2, 5).tolist())
+        eq_(cube.getBandsRaw(1, 4).tolist(), self.mem.getBandsRaw(1, 4).tolist())
+        for band in range(5):
+            eq_(cube.getBandRaw(band).tolist(), self.mem.getBandRaw(band).tolist())
+            eq_(cube.getFocalPlaneDepthRaw(3, band).tolist(), self.mem.getFocalPlaneDepthRaw(3, band).tolist())
+        eq_(cube.getBandTile(1, 8, 2, -1, 3).tolist(), self.mem.getBandTile(1, 8, 2, -1, 3).tolist())
+        for line in range(9):
+            eq_(cube.getFocalPlaneRaw(line).tolist(), self.mem.getFocalPlaneRaw(line).tolist())
+            for sample in range(7):
+                eq_(cube.getSpectraRaw(line, sample).tolist(), self.mem.getSpectraRaw(line, sample).tolist())
+        eq_(cube.getPixel(4, 5, 2), self.mem.getPixel(4, 5, 2))
+    
+    def testSmallTiles(self):
+        cube = self.export(tile_lines=2, tile_bands=2)
+        eq_(cube.cube_io.layout.line_groups, 5)
+        eq_(cube.cube_io.layout.band_groups, 3)
+        self.checkCube(cube)
+        cube.cube_io.fh.close()
+    
+    def testByteOrder(self):
+        cube = self.export(byte_order=HSI.BigEndian, compression='none')
+        eq_(cube.byte_order, HSI.BigEndian)
+        self.checkCube(cube)
+        cube.cube_io.fh.close()
+        eq_(os.path.getsize(self.filename) > 9 * 7 * 5 * 2, True)
+    
+    def testCompression(self):
+        sparse = HSI.createCube('bsq', 100, 100, 1, numpy.int16)
+        sparse.getBandRaw(0)[40:60, 30:50] = 3
+        ChunkedDataset.export(self.filename, sparse)
+        assert os.path.getsize(self.filename) * 10 < 100 * 100 * 2
+        cube = ChunkedDataset(self.filename).getCube()
+        eq_(cube.getBandRaw(0).tolist(), sparse.getBandRaw(0).tolist())
+        cube.cube_io.fh.close()
+    
+    def testUnknownCompression(self):
+        assert_raises(ValueError, ChunkedDataset.export, self.filename, self.mem, {'compression': 'bogus'})
+
+
+class testSpectralShadow(baseFileCube):
+    interleave = 'bsq'
+    byte_order = 1 - HSI.nativeByteOrder
+    
+    def setUp(self):
+        baseFileCube.setUp(self)
+        self.save = (SpectralShadow.cache_dir, SpectralShadow.max_bytes)
+        SpectralShadow.cache_dir = os.path.join(self.dirname, "spectra")
+    
+    def tearDown(self):
+        SpectralShadow.cache_dir, SpectralShadow.max_bytes = self.save
+        baseFileCube.tearDown(self)
+    
+    def testDisabled(self):
+        SpectralShadow.cache_dir = None
+        assert not SpectralShadow.isUseful(self.cube)
+        assert not SpectralShadow(self.cube).build()
+    
+    def testBuild(self):
+        assert SpectralShadow.isUseful(self.cube)
+        shadow = SpectralShadow(self.cube)
+        assert not shadow.open()
+        shadow.block_bytes = 2 * 5 * 3 * 2
+        assert shadow.build()
+        self.cube.spectral_shadow = shadow
+        self.cube.cube_io.getSpectraRaw = None
+        for line in range(7):
+            for sample in range(5):
+                eq_(self.cube.getSpectraRaw(line, sample).tolist(), self.mem.getSpectraRaw(line, sample).tolist())
+        eq_(self.cube.getSpectraAtPointsRaw([6, 1], [0, 4]).tolist(), [self.mem.getSpectraRaw(6, 0).tolist(), self.mem.getSpectraRaw(1, 4).tolist()])
+        
+        # a new copy should be loaded from disk
+        assert SpectralShadow(self.cube).open()
+    
+    def testStale(self):
+        shadow = SpectralShadow(self.cube)
+        assert shadow.build()
+        fh = open(shadow.getFilename() + ".key", "w")
+        fh.write("old")
+        fh.close()
+        assert not SpectralShadow(self.cube).open()
+    
+    def testCacheSize(self):
+        shadow = SpectralShadow(self.cube)
+        SpectralShadow.max_bytes = shadow.getSize() - 1
+        assert not shadow.build()
+        
+        # an old copy is removed to make room for the new one
+        SpectralShadow.max_bytes = shadow.getSize() + 10
+        os.makedirs(SpectralShadow.cache_dir)
+        old = os.path.join(SpectralShadow.cache_dir, "old.spectra")
+        fh = open(old, "wb")
+        fh.write("x" * 20)
+        fh.close()
+        assert shadow.build()
+        assert not os.path.exists(old)
+        assert os.path.dirname(shadow.getFilename()) == SpectralShadow.cache_dir
+        assert not os.path.exists(str(self.cube.url.path) + ".spectra")
+
+
+class testTileCache(baseFileCube):
+    interleave = 'bip'
+    
+    def setUp(self):
+        baseFileCube.setUp(self)
+        self.cache = HSI.Cube.tile_cache
+        self.save_size = self.cache.max_bytes
+        self.cache.clear()
+    
+    def tearDown(self):
+        self.cache.clear()
+        self.cache.setMaxBytes(self.save_size)
+        baseFileCube.tearDown(self)
+    
+    def testHits(self):
+        band1 = self.cube.getBandRaw(1)
+        eq_(self.cache.getStats()['misses'], 1)
+        band2 = self.cube.getBandRaw(1)
+        eq_(self.cache.getStats()['hits'], 1)
+        assert band1 is band2
+        eq_(band1.flags.writeable, False)
+        
+    def testEvict(self):
+        # room for only two bands
+        self.cache.setMaxBytes(2 * 7 * 5 * 2)
+        self.cube.getBandRaw(0)
+        self.cube.getBandRaw(1)
+        self.cube.getBandRaw(0)
+        self.cube.getBandRaw(2)
+        eq_(len(self.cache), 2)
+        assert (self.cube.cube_io, 'band', 0, None) in self.cache
+        assert (self.cube.cube_io, 'band', 1, None) not in self.cache
+        eq_(self.cube.getBandRaw(1).tolist(), self.mem.getBandRaw(1).tolist())
+
+    def testMemoryCubeNotCached(self):
+        self.mem.getBandRaw(1)
+        eq_(len(self.cache), 0)
+
+    def testPrefetch(self):
+        prefetcher = BandPrefetcher(self.cube, 'band')
+        prefetcher.start()
+        try:
+            prefetcher.navigate([0])
+            prefetcher.navigate([1])
+            # wait for the background thread to load the next band
+            key = self.cube.getCacheKey('band', 2, None)
+            for i in range(100):
+                if key in self.cache:
+                    break
+                time.sleep(.05)
+            prefetcher.waitIfLoading(2)
+            assert key in self.cache
+        finally:
+            prefetcher.stop()
+        eq_(self.cube.getBandRaw(2).tolist(), self.mem.getBandRaw(2).tolist())
+        eq_(self.cache.getStats()['hits'], 1)
+
+class testMemoryBudget(object):
+    def setUp(self):
+        self.budget = HSI.Cube.memory_budget
+        self.save_size = self.budget.max_bytes
+        self.budget.clear()
+        # room for two 4x5x3 int16 cubes
+        self.budget.setMaxBytes(2 * 4 * 5 * 3 * 2)
+    
+    def tearDown(self):
+        self.budget.clear()
+        self.budget.setMaxBytes(self.save_size)
+    
+    def createCube(self, value):
+        cube = HSI.createCube('bil', 4, 5, 3, numpy.int16)
+        cube.getNumpyArray()[:] = value
+        return cube
+    
+    def testWithinBudget(self):
+        cube1 = self.createCube(1)
+        cube2 = self.createCube(2)
+        assert not isinstance(cube1.getNumpyArray(), numpy.memmap)
+        assert not isinstance(cube2.getNumpyArray(), numpy.memmap)
+        eq_(self.budget.getStats()['bytes'], 240)
+    
+    def testOverBudget(self):
+        cube1 = self.createCube(1)
+        band = cube1.getBandRaw(0)
+        cube2 = self.createCube(2)
+        cube3 = self.createCube(3)
+        # existing cubes stay in memory, so views of them remain valid
+        assert cube1 in self.budget
+        assert cube2 in self.budget
+        assert cube3 not in self.budget
+        assert not isinstance(cube1.getNumpyArray(), numpy.memmap)
+        assert isinstance(cube3.getNumpyArray(), numpy.memmap)
+        band[:] = 7
+        eq_(cube1.getBandRaw(0).max(), 7)
+        eq_(cube3.getBandRaw(1).tolist(), [[3] * 5] * 4)
+        eq_(self.budget.getStats()['on_disk'], 1)
+    
+    def testTooLarge(self):
+        cube = HSI.createCube('bsq', 10, 10, 3, numpy.int16)
+        raw = cube.getNumpyArray()
+        assert isinstance(raw, numpy.memmap)
+        eq_(raw.sum(), 0)
+        eq_(len(self.budget), 0)
+    
+    def testReleased(self):
+        cube1 = self.createCube(1)
+        eq_(len(self.budget), 1)
+        del cube1
+        eq_(len(self.budget), 0)
+        eq_(self.budget.getStats()['bytes'], 0)
+    
+    def testShrink(self):
+        cube1 = self.createCube(1)
+        self.budget.setMaxBytes(60)
+        assert not isinstance(cube1.getNumpyArray(), numpy.memmap)
+        cube2 = self.createCube(2)
+        assert isinstance(cube2.getNumpyArray(), numpy.memmap)
+        eq_(cube2.getFocalPlaneRaw(3).tolist(), [[2] * 5] * 3)
+
+class testIdentifyCache(baseFileCube):
+    interleave = 'bil'
+    
+    def setUp(self):
+        baseFileCube.setUp(self)
+        self.filename = os.path.join(self.dirname, "test.bil")
+        self.url = vfs.normalize(self.filename)
+        HSI.HyperspectralFileFormat.identify_cache.clear()
+        ENVI.Header.parsed_headers.clear()
+    
+    def testProbe(self):
+        matches = HSI.HyperspectralFileFormat.probe(self.url)
+        eq_([format.format_id for format, info in matches], ['ENVI'])
+        eq_(matches[0][1], (vfs.normalize(self.filename + ".hdr"), self.url))
+        cache = HSI.HyperspectralFileFormat.identify_cache
+        eq_(cache.hits, 0)
+        eq_(HSI.HyperspectralFileFormat.identify(self.filename).format_id, 'ENVI')
+        eq_(cache.hits, 1)
+        
+        # the header itself isn't a cube
+        eq_(HSI.HyperspectralFileFormat.identifyall(self.filename + ".hdr"), [])
+    
+    def testChangedFile(self):
+        HSI.HyperspectralFileFormat.probe(self.url)
+        fh = open(self.filename, "wb")
+        fh.write("SIMPLE  =                    T".ljust(80) + "BITPIX  = ".ljust(2800))
+        fh.close()
+        formats = HSI.HyperspectralFileFormat.identifyall(self.url)
+        eq_([format.format_id for format in formats], ['ENVI', 'FITS'])
+        eq_(HSI.HyperspectralFileFormat.identify_cache.hits, 0)
+    
+    def testHeaderAddedLater(self):
+        other = os.path.join(self.dirname, "other.bil")
+        shutil.copy(self.filename, other)
+        eq_(HSI.HyperspectralFileFormat.identifyall(other), [])
+        shutil.copy(self.filename + ".hdr", other + ".hdr")
+        eq_([format.format_id for format in HSI.HyperspectralFileFormat.identifyall(other)], ['ENVI'])
+    
+    def testHeaderRemoved(self):
+        eq_([format.format_id for format in HSI.HyperspectralFileFormat.identifyall(self.url)], ['ENVI'])
+        os.remove(self.filename + ".hdr")
+        eq_(HSI.HyperspectralFileFormat.identifyall(self.url), [])
+        eq_(HSI.HyperspectralFileFormat.load(self.url), None)
+    
+    def testParsedHeader(self):
+        dataset = HSI.HyperspectralFileFormat.load(self.filename)
+        eq_(dataset['interleave'], 'bil')
+        eq_(ENVI.Header.parsed_headers.misses, 1)
+        dataset = HSI.HyperspectralFileFormat.load(self.filename)
+        eq_(ENVI.Header.parsed_headers.hits, 1)
+        eq_(dataset.getCube().getBandRaw(1).tolist(), self.mem.getBandRaw(1).tolist())
+        
+        # changing the header causes it to be parsed again
+        fh = open(self.filename + ".hdr", "a")
+        fh.write("description = {changed}\n")
+        fh.close()
+        dataset = HSI.HyperspectralFileFormat.load(self.filename)
+        eq_(dataset['description'], 'changed')
+        eq_(ENVI.Header.parsed_headers.misses, 2)
+    
+    def testNewHeader(self):
+        other = os.path.join(self.dirname, "other.bil")
+        shutil.copy(self.filename, other)
+        eq_(ENVI.findHeaders(other), [])
+        shutil.copy(self.filename + ".hdr", other + ".hdr")
+        eq_(ENVI.findHeaders(other), [vfs.normalize(other + ".hdr")])
+
+def fitsHeader(cards):
+    text = ""
+    for keyword, value in cards:
+        text += ("%-8s= %20s" % (keyword, value)).ljust(80)
+    text += "END".ljust(80)
+    return text.ljust(((len(text) + 2879) / 2880) * 2880)
+
+def fitsData(data):
+    text = data.tostring()
+    return text.ljust(((len(text) + 2879) / 2880) * 2880, "\0")
+
+class testFITSIndex(object):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dirname, "test.fits")
+        self.image = numpy.arange(3 * 7 * 5).astype('>i2').reshape(3, 7, 5)
+        self.plane = (numpy.arange(4 * 6) / 2.0).astype('>f4').reshape(4, 6)
+        fh = open(self.filename, "wb")
+        fh.write(fitsHeader([('SIMPLE', 'T'), ('BITPIX', 8), ('NAXIS', 0), ('EXTEND', 'T')]))
+        # binary table with a heap that must be skipped
+        fh.write(fitsHeader([('XTENSION', "'BINTABLE'"), ('BITPIX', 8), ('NAXIS', 2), ('NAXIS1', 8), ('NAXIS2', 400), ('PCOUNT', 3000), ('GCOUNT', 1), ('TFIELDS', 1)]))
+        fh.write(fitsData(numpy.zeros(8 * 400 + 3000, dtype=numpy.uint8) + 1))
+        fh.write(fitsHeader([('XTENSION', "'IMAGE   '"), ('BITPIX', 16), ('NAXIS', 3), ('NAXIS1', 5), ('NAXIS2', 7), ('NAXIS3', 3), ('PCOUNT', 0), ('GCOUNT', 1), ('EXTNAME', "'CUBE'")]))
+        fh.write(fitsData(self.image))
+        fh.write(fitsHeader([('XTENSION', "'IMAGE   '"), ('BITPIX', -32), ('NAXIS', 2), ('NAXIS1', 6), ('NAXIS2', 4), ('PCOUNT', 0), ('GCOUNT', 1)]))
+        fh.write(fitsData(self.plane))
+        fh.close()
+        FITS.FITSDataset.index_cache.clear()
+    
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+    
+    def testIndex(self):
+        dataset = HSI.HyperspectralFileFormat.load(self.filename)
+        eq_(dataset.format_id, 'FITS')
+        eq_(len(dataset.hdus), 4)
+        eq_(dataset.hdus[1].data_size, 8 * 400 + 3000)
+        eq_(dataset.hdus[2].image_offset, 6 * 2880)
+        eq_(dataset.getCubeNames(), ['CUBE', 'HDU 3'])
+        eq_(dataset.getNumCubes(), 2)
+        
+        dataset = FITS.FITSDataset(self.filename)
+        eq_(FITS.FITSDataset.index_cache.hits, 1)
+        assert_raises(IndexError, dataset.getCube, index=2)
+    
+    def testCubes(self):
+        dataset = FITS.FITSDataset(self.filename)
+        cube = dataset.getCube(index=0)
+        assert isinstance(cube.cube_io, HSI.MMapCubeReader)
+        eq_((cube.lines, cube.samples, cube.bands), (7, 5, 3))
+        for band in range(3):
+            eq_(cube.getBandRaw(band).tolist(), self.image[band].tolist())
+        cube = dataset.getCube(index=1)
+        eq_((cube.lines, cube.samples, cube.bands), (4, 6, 1))
+        eq_(cube.getBandRaw(0).tolist(), self.plane.tolist())